@@ -1,21 +1,50 @@
-from flask import Flask
+import atexit
+
+from flask import Flask, Response, jsonify
 from flask_socketio import SocketIO, emit, disconnect
 
 import settings
+# before anything opens a Mongo client, so its commands are timed
+from src.util import metrics
 from src.namespaces.main import MainNamespace
+from src.services import startup, write_behind
+from src.util.client_manager import create_client_manager
 
 app = Flask(__name__)
 
-socket_io = SocketIO(app, cors_allowed_origins="*")
+socket_io = SocketIO(app, cors_allowed_origins="*",
+                     client_manager=create_client_manager(settings.SOCKETIO_MESSAGE_QUEUE))
 
 socket_io.on_namespace(MainNamespace(''))
 
 
+def start():
+    # in the background, so the port is bound while Mongo and the REST service are still being reached
+    startup.run(socket_io.sleep)
+    if settings.WRITE_BEHIND:
+        write_behind.run(socket_io.sleep)
+
+
+socket_io.start_background_task(start)
+if settings.WRITE_BEHIND:
+    atexit.register(write_behind.flush)
+
+
 @app.route('/')
 def index():
     return 'Server is running!'
 
 
+@app.route('/ready')
+def ready():
+    return jsonify(startup.status()), 200 if startup.ready() else 503
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
 @socket_io.on_error_default
 def default_error_handler(e):
     if isinstance(e, ConnectionRefusedError):
@@ -0,0 +1,62 @@
+import asyncio
+import threading
+import time
+
+import socketio
+from aiohttp import web
+
+import settings
+# before anything opens a Mongo client, so its commands are timed
+from src.util import metrics
+from src.namespaces.async_main import AsyncMainNamespace
+from src.services import auth_service, offload, startup, write_behind
+from src.util.client_manager import create_async_client_manager
+
+sio = socketio.AsyncServer(async_mode='aiohttp', cors_allowed_origins='*',
+                           client_manager=create_async_client_manager(settings.SOCKETIO_MESSAGE_QUEUE))
+sio.register_namespace(AsyncMainNamespace('/'))
+
+app = web.Application()
+sio.attach(app)
+
+
+async def index(request):
+    return web.Response(text='Server is running!')
+
+
+async def ready(request):
+    return web.json_response(startup.status(), status=200 if startup.ready() else 503)
+
+
+async def metrics_endpoint(request):
+    return web.Response(text=metrics.render(), headers={'Content-Type': 'text/plain; version=0.0.4'})
+
+
+async def start(app):
+    # not awaited, so the port is bound while Mongo and the REST service are still being reached
+    app['startup'] = asyncio.ensure_future(run_startup())
+
+
+async def run_startup():
+    await startup.run_async(offload.run)
+    if settings.WRITE_BEHIND:
+        # flushes block on Mongo, so they get a thread of their own rather than the event loop
+        threading.Thread(target=write_behind.run, args=(time.sleep,), name='write-behind', daemon=True).start()
+
+
+async def stop(app):
+    app['startup'].cancel()
+    await auth_service.close_async()
+    if settings.WRITE_BEHIND:
+        await offload.run(write_behind.flush)
+
+
+app.router.add_get('/', index)
+app.router.add_get('/ready', ready)
+app.router.add_get('/metrics', metrics_endpoint)
+app.on_startup.append(start)
+app.on_cleanup.append(stop)
+
+
+if __name__ == '__main__':
+    web.run_app(app, port=settings.APP_PORT)
@@ -0,0 +1,87 @@
+"""
+Memory per connection of the state the server keeps for a socket joined to a diagram.
+
+Compares what used to be stored in each socket's session (its own copy of the user document and of the
+Diagram with its models id list) with a room_registry.Connection record plus one Diagram shared by the room.
+Run it from the repository root, next to the server's .env:
+
+    python -m bench.connections --connections 1000 10000 --diagram-models 2000
+"""
+from __future__ import annotations
+
+import argparse
+import copy
+import gc
+import tracemalloc
+from types import SimpleNamespace
+from typing import Callable
+
+from bson import ObjectId
+
+from src.services import room_registry
+
+USER = {
+    '_id': str(ObjectId()),
+    'name': 'Bench User',
+    'email': 'bench.user@example.com',
+    'workspaces': [str(ObjectId()) for _ in range(5)],
+    'createdAt': '2021-11-01T12:00:00',
+}
+
+
+def diagram(models: int, diagram_id: ObjectId) -> SimpleNamespace:
+    return SimpleNamespace(id=diagram_id, projectId=ObjectId(), title='Bench', path='/bench',
+                           models=[ObjectId() for _ in range(models)])
+
+
+def session_per_socket(connections: int, models: int) -> list:
+    diagram_id = ObjectId()
+    sessions = []
+    for i in range(connections):
+        # the auth cache hands out a copy, and every join read the diagram again
+        user = copy.deepcopy(USER)
+        user['id'] = str(user['_id'])
+        sessions.append({'user': user, 'diagram': diagram(models, diagram_id), 'room': str(diagram_id),
+                         'format': 'json'})
+    return sessions
+
+
+def shared_registry(connections: int, models: int) -> list:
+    shared = diagram(models, ObjectId())
+    records = []
+    for i in range(connections):
+        sid = f'{i:020d}'
+        records.append(room_registry.connect(sid, copy.deepcopy(USER), 'json'))
+        room_registry.join(shared, sid)
+    return records
+
+
+def measure(build: Callable[[int, int], list], connections: int, models: int) -> float:
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    kept = build(connections, models)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    del kept
+    for sid in list(room_registry._connections):
+        room_registry.disconnect(sid)
+    return allocated / connections
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--connections', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--diagram-models', type=int, default=2000)
+    options = parser.parse_args()
+
+    print(f'bytes per connection, diagram with {options.diagram_models} models')
+    for connections in options.connections:
+        old = measure(session_per_socket, connections, options.diagram_models)
+        new = measure(shared_registry, connections, options.diagram_models)
+        print(f'  {connections:>6} sockets  session per socket {old:12,.0f}  shared registry {new:10,.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""
+Runs bench.run against the gevent server (app.py) and the asyncio server (async_app.py) with the same
+arguments and seed, and prints their reports side by side. Any bench.run argument is passed through:
+
+    python -m bench.modes --clients 50 --ops 200 --json modes_output.json
+"""
+from __future__ import annotations
+
+import json
+import sys
+
+from bench import run
+
+MODES = ('gevent', 'asyncio')
+SUMMARY_KEYS = ('ops', 'throughput_ops_s', 'mongo_ops_per_event', 'rss_per_connection_kb', 'time_to_ready_s',
+                'first_join_ms')
+
+
+def compare(argv) -> dict:
+    if '--json' in argv:
+        index = argv.index('--json')
+        json_path, argv = argv[index + 1], argv[:index] + argv[index + 2:]
+    else:
+        json_path = None
+    results = {}
+    for mode in MODES:
+        print(f'--- {mode}', flush=True)
+        results[mode] = run.main([*argv, '--server-mode', mode])
+    print_comparison(results)
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+def print_comparison(results: dict) -> None:
+    print()
+    print(f'{"":<26}' + ''.join(f'{m:>22}' for m in MODES))
+    events = sorted(set().union(*(r['events'] for r in results.values())))
+    for event in events:
+        for key in ('p50_ms', 'p95_ms', 'p99_ms'):
+            cells = [results[m]['events'].get(event, {}).get(key) for m in MODES]
+            print(f'{event + " " + key[:-3]:<26}' + ''.join(__cell(c) for c in cells))
+    for key in SUMMARY_KEYS:
+        print(f'{key:<26}' + ''.join(__cell(results[m][key]) for m in MODES))
+
+
+def __cell(value) -> str:
+    return f'{"-" if value is None else round(value, 2):>22}'
+
+
+if __name__ == '__main__':
+    compare(sys.argv[1:])
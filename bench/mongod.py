@@ -0,0 +1,66 @@
+from __future__ import annotations
+
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+
+from pymongo import MongoClient
+
+USER = 'bench'
+PASSWORD = 'bench'
+DATABASE = 'bench'
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class LocalMongod:
+    """
+    Throwaway mongod in a temporary directory, with the bench user the server authenticates as.
+    """
+
+    def __init__(self, binary: str = 'mongod'):
+        self.binary = binary
+        self.port = free_port()
+        self.dbpath = None
+        self.process = None
+
+    @property
+    def host(self) -> str:
+        return f'127.0.0.1:{self.port}'
+
+    @property
+    def uri(self) -> str:
+        return f'mongodb://{USER}:{PASSWORD}@{self.host}/{DATABASE}'
+
+    def __enter__(self) -> LocalMongod:
+        self.dbpath = tempfile.mkdtemp(prefix='bench-mongod-')
+        self.process = subprocess.Popen([self.binary, '--dbpath', self.dbpath, '--port', str(self.port),
+                                         '--bind_ip', '127.0.0.1', '--quiet'],
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        client = MongoClient(self.host, serverSelectionTimeoutMS=500)
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                client.admin.command('ping')
+                break
+            except Exception:
+                if time.monotonic() > deadline or self.process.poll() is not None:
+                    self.__exit__()
+                    raise RuntimeError(f'{self.binary} did not start')
+                time.sleep(0.2)
+        client[DATABASE].command('createUser', USER, pwd=PASSWORD, roles=['readWrite'])
+        client.close()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait(10)
+        if self.dbpath is not None:
+            shutil.rmtree(self.dbpath, ignore_errors=True)
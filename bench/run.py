@@ -0,0 +1,362 @@
+"""
+Socket-level load test of the server.
+
+Starts a stub REST /users endpoint, a throwaway mongod (or uses --mongo-uri) and the server itself
+(or uses --server-url), then drives N python-socketio clients through a generated or recorded trace.
+Reports p50/p95/p99 latency per event type (emit -> room broadcast received back by the sender),
+throughput, Mongo operations per event and server memory per connection.
+
+    python -m bench.run --clients 50 --ops 200
+    python -m bench.run --clients 50 --ops 200 --record trace.jsonl
+    python -m bench.run --replay trace.jsonl --json bench_output.json
+"""
+from __future__ import annotations
+
+import argparse
+import copy
+import json
+import math
+import os
+import queue
+import shlex
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import ExitStack
+from typing import Dict, List, Optional, Tuple
+
+import requests
+import socketio
+from bson import ObjectId
+from pymongo import MongoClient, uri_parser
+
+from bench import stub_rest, workload
+from bench.mongod import LocalMongod, free_port
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER_CMDS = {
+    'gevent': f'{sys.executable} -m gunicorn -k geventwebsocket.gunicorn.workers.GeventWebSocketWorker '
+              f'-w 1 -b 127.0.0.1:{{port}} app:app',
+    'asyncio': f'{sys.executable} -m gunicorn -k aiohttp.GunicornWebWorker -w 1 -b 127.0.0.1:{{port}} async_app:app',
+}
+LISTENED_EVENTS = sorted({e for events in workload.RESPONSE_EVENTS.values() for e in events} | {'error'})
+# answered to the sender only, so any matching event is the answer
+REQUESTER_ONLY = {'join_diagram'}
+REFERENCE_KEYS = ('_id', 'modelId', 'modelRepId', 'title', 'batchId')
+
+
+class Shared:
+    def __init__(self, diagram_id: str, keys: List[str]):
+        self.diagram_id = diagram_id
+        self.keys = keys
+        self.models: Dict[str, str] = {}
+        self.changed = threading.Condition()
+
+    def publish_model(self, key: str, model_id: str) -> None:
+        with self.changed:
+            self.models[key] = model_id
+            self.changed.notify_all()
+
+    def peer_model(self, key: str, timeout: float) -> Optional[str]:
+        peer = self.keys[(self.keys.index(key) + 1) % len(self.keys)]
+        with self.changed:
+            self.changed.wait_for(lambda: peer in self.models, timeout)
+            return self.models.get(peer, self.models.get(key))
+
+
+class BenchClient:
+    def __init__(self, key: str, shared: Shared, timeout: float):
+        self.key = key
+        self.shared = shared
+        self.timeout = timeout
+        self.ids: Dict[str, str] = {}
+        self.samples: List[tuple] = []
+        self.inbox = queue.Queue()
+        self.sio = socketio.Client(reconnection=False)
+        for event in LISTENED_EVENTS:
+            self.sio.on(event, self.__receiver(event))
+
+    def connect(self, url: str, transport: str) -> None:
+        self.sio.connect(url, headers={'Authorization': f'Bearer {self.key}'}, transports=[transport])
+
+    def run(self, entries: List[dict], paced: bool, started_at: float) -> None:
+        for entry in entries:
+            if paced:
+                time.sleep(max(0.0, started_at + entry['t'] - time.perf_counter()))
+            self.__execute(entry)
+        self.sio.disconnect()
+
+    def __execute(self, entry: dict) -> None:
+        event = entry['event']
+        args = self.__resolve(copy.deepcopy(entry['args']))
+        if args is None:
+            self.samples.append((event, 'skipped', None))
+            return
+        expected = workload.RESPONSE_EVENTS.get(event)
+        references = [] if event in REQUESTER_ONLY else \
+            [str(a[k]) for a in args if isinstance(a, dict) for k in REFERENCE_KEYS if k in a]
+        while not self.inbox.empty():
+            self.inbox.get_nowait()
+
+        sent = time.perf_counter()
+        self.sio.emit(event, tuple(args))
+        if expected is None:
+            self.samples.append((event, 'sent', None))
+            return
+
+        deadline = sent + self.timeout
+        while True:
+            try:
+                received, name, payload = self.inbox.get(timeout=max(0.0, deadline - time.perf_counter()))
+            except queue.Empty:
+                self.samples.append((event, 'timeout', None))
+                return
+            if name == 'error':
+                self.samples.append((event, 'error', received - sent))
+                return
+            text = payload if isinstance(payload, str) else json.dumps(payload, default=str)
+            if name in expected and (not references or any(r in text for r in references)):
+                self.__learn(name, text)
+                self.samples.append((event, 'ok', received - sent))
+                return
+
+    def __resolve(self, value):
+        if isinstance(value, list):
+            resolved = [self.__resolve(v) for v in value]
+            return None if any(v is None for v in resolved) else resolved
+        if isinstance(value, dict):
+            resolved = {k: self.__resolve(v) for k, v in value.items()}
+            return None if any(v is None for v in resolved.values()) else resolved
+        if value == '$diagram':
+            return self.shared.diagram_id
+        if value == '$peer_model':
+            return self.shared.peer_model(self.key, self.timeout)
+        if isinstance(value, str) and value in workload.PLACEHOLDERS:
+            return self.ids.get(value)
+        return value
+
+    def __learn(self, name: str, text: str) -> None:
+        payload = json.loads(text) if text[:1] in '{[' else None
+        if name == 'model_added' and isinstance(payload, dict):
+            self.ids['$rep'] = str(payload['_id'])
+            self.ids['$model'] = str(payload['modelId'])
+            self.shared.publish_model(self.key, self.ids['$model'])
+        elif name == 'model_patched' and isinstance(payload, dict):
+            if payload.get('op') == 'attribute_added':
+                self.ids['$attr'] = str(payload['item']['_id'])
+            elif payload.get('op') == 'relation_added':
+                self.ids['$relation'] = str(payload['item']['_id'])
+
+    def __receiver(self, event: str):
+        def receive(*args):
+            self.inbox.put((time.perf_counter(), event, args[0] if args else None))
+        return receive
+
+
+def percentile(values: List[float], p: float) -> float:
+    # nearest rank
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def tree_rss_kb(pid: int) -> int:
+    total = 0
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            total += next(int(line.split()[1]) for line in f if line.startswith('VmRSS:'))
+        for task in os.listdir(f'/proc/{pid}/task'):
+            with open(f'/proc/{pid}/task/{task}/children') as f:
+                total += sum(tree_rss_kb(int(child)) for child in f.read().split())
+    except (OSError, StopIteration):
+        pass
+    return total
+
+
+def mongo_ops(admin: Optional[MongoClient]) -> Optional[int]:
+    if admin is None:
+        return None
+    try:
+        counters = admin.admin.command('serverStatus')['opcounters']
+    except Exception:
+        return None
+    return sum(counters[k] for k in ('insert', 'query', 'update', 'delete', 'getmore', 'command'))
+
+
+def start_server(cmd: str, port: int, env: dict) -> Tuple[subprocess.Popen, float]:
+    """
+    returns the server process once its /ready answers 200, and the seconds that took from spawning it
+    """
+    started = time.monotonic()
+    process = subprocess.Popen(shlex.split(cmd.format(port=port)), cwd=REPO_ROOT, env={**os.environ, **env})
+    deadline = started + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'Server exited with {process.returncode}')
+        try:
+            if requests.get(f'http://127.0.0.1:{port}/ready', timeout=1).status_code == 200:
+                return process, time.monotonic() - started
+        except requests.RequestException:
+            pass
+        time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError('Server did not become ready')
+
+
+def startup_status(url: str) -> dict:
+    try:
+        return requests.get(f'{url}/ready', timeout=1).json()
+    except (requests.RequestException, ValueError):
+        return {}
+
+
+def report(clients: List[BenchClient], duration: float, ops_delta: Optional[int], rss_delta_kb: Optional[int],
+           ready_s: Optional[float] = None, startup: Optional[dict] = None) -> dict:
+    latencies = defaultdict(list)
+    outcomes = defaultdict(lambda: defaultdict(int))
+    for client in clients:
+        for event, outcome, latency in client.samples:
+            outcomes[event][outcome] += 1
+            if outcome == 'ok':
+                latencies[event].append(latency * 1000)
+    total = sum(sum(o.values()) for o in outcomes.values())
+    events = {}
+    for event, counts in sorted(outcomes.items()):
+        values = latencies[event]
+        events[event] = {
+            **counts,
+            'p50_ms': percentile(values, 50) if values else None,
+            'p95_ms': percentile(values, 95) if values else None,
+            'p99_ms': percentile(values, 99) if values else None,
+        }
+    return {
+        'events': events,
+        'ops': total,
+        'duration_s': duration,
+        'throughput_ops_s': total / duration if duration else None,
+        'mongo_ops_per_event': ops_delta / total if ops_delta is not None and total else None,
+        'rss_per_connection_kb': rss_delta_kb / len(clients) if rss_delta_kb is not None and clients else None,
+        'time_to_ready_s': ready_s,
+        'first_join_ms': startup['firstJoinSeconds'] * 1000 if (startup or {}).get('firstJoinSeconds') else None,
+    }
+
+
+def print_report(result: dict) -> None:
+    print(f'{"event":<26}{"ok":>8}{"error":>8}{"timeout":>9}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}')
+    for event, stats in result['events'].items():
+        row = [stats.get('ok', 0), stats.get('error', 0), stats.get('timeout', 0)]
+        ms = ['-' if stats[k] is None else f'{stats[k]:.1f}' for k in ('p50_ms', 'p95_ms', 'p99_ms')]
+        print(f'{event:<26}{row[0]:>8}{row[1]:>8}{row[2]:>9}{ms[0]:>10}{ms[1]:>10}{ms[2]:>10}')
+    for key in ('ops', 'duration_s', 'throughput_ops_s', 'mongo_ops_per_event', 'rss_per_connection_kb',
+                'time_to_ready_s', 'first_join_ms'):
+        value = result[key]
+        print(f'{key:<26}{"-" if value is None else round(value, 2)}')
+
+
+def main(argv=None) -> dict:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=20)
+    parser.add_argument('--ops', type=int, default=100, help='generated operations per client')
+    parser.add_argument('--interval', type=float, default=0.05, help='seconds between generated operations')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--mix', help='event=weight,... instead of the default mix, e.g. batch_ops=1')
+    parser.add_argument('--closed-loop', action='store_true', help='ignore trace timing, send as fast as answered')
+    parser.add_argument('--stream-join', action='store_true', help='join with diagram_models_chunk streaming')
+    parser.add_argument('--record', help='write the generated trace to this file')
+    parser.add_argument('--replay', help='replay this trace (bench --record or EVENT_TRACE_FILE of a server)')
+    parser.add_argument('--diagram-id', help='use this diagram instead of seeding one')
+    parser.add_argument('--mongo-uri', help='use this database instead of starting mongod')
+    parser.add_argument('--mongod', default='mongod', help='mongod binary to start')
+    parser.add_argument('--server-url', help='benchmark an already running server')
+    parser.add_argument('--server-mode', default='gevent', choices=sorted(SERVER_CMDS),
+                        help='start app.py under gevent or async_app.py under asyncio')
+    parser.add_argument('--server-cmd', help='command starting the server on {port}, overrides --server-mode')
+    parser.add_argument('--server-env', action='append', default=[], help='extra KEY=VALUE for the server')
+    parser.add_argument('--transport', default='websocket', choices=('websocket', 'polling'))
+    parser.add_argument('--timeout', type=float, default=10)
+    parser.add_argument('--json', help='also write the report to this file')
+    options = parser.parse_args(argv)
+
+    with ExitStack() as stack:
+        if options.mongo_uri:
+            mongo_uri = options.mongo_uri
+            admin = MongoClient(mongo_uri, serverSelectionTimeoutMS=5000)
+        else:
+            mongod = stack.enter_context(LocalMongod(options.mongod))
+            mongo_uri = mongod.uri
+            admin = MongoClient(mongod.host)
+        parsed = uri_parser.parse_uri(mongo_uri)
+        database = MongoClient(mongo_uri)[parsed['database']]
+
+        diagram_id = options.diagram_id or str(database['diagram'].insert_one(
+            {'title': 'bench', 'path': '/', 'projectId': ObjectId(), 'models': []}).inserted_id)
+
+        rest = stub_rest.start()
+        stack.callback(rest.shutdown)
+
+        server_pid = None
+        ready_s = None
+        url = options.server_url
+        if url is None:
+            port = free_port()
+            server, ready_s = start_server(options.server_cmd or SERVER_CMDS[options.server_mode], port, {
+                'APP_PORT': str(port),
+                'REST_DOMAIN': f'http://127.0.0.1:{rest.server_port}',
+                'MONGO_PROTOCOL': mongo_uri.split('://')[0],
+                'MONGO_HOST': ','.join(f'{h}:{p}' for h, p in parsed['nodelist']),
+                'MONGO_USER': parsed['username'] or '',
+                'MONGO_PW': parsed['password'] or '',
+                'MONGO_DEFAULT_DB': parsed['database'],
+                **dict(e.split('=', 1) for e in options.server_env),
+            })
+            stack.callback(server.terminate)
+            server_pid = server.pid
+            url = f'http://127.0.0.1:{port}'
+
+        if options.replay:
+            trace = workload.load(options.replay)
+        else:
+            mix = {e: int(w) for e, w in (item.split('=') for item in options.mix.split(','))} if options.mix else None
+            trace = workload.generate(options.clients, options.ops, options.seed, options.interval, mix)
+        if options.stream_join:
+            for entry in trace:
+                if entry['event'] == 'join_diagram':
+                    entry['args'][0]['stream'] = True
+        if options.record:
+            workload.save(trace, options.record)
+
+        entries = workload.by_client(trace)
+        shared = Shared(diagram_id, list(entries))
+        clients = [BenchClient(key, shared, options.timeout) for key in entries]
+
+        rss_before = tree_rss_kb(server_pid) if server_pid else None
+        for client in clients:
+            client.connect(url, options.transport)
+        rss_connected = tree_rss_kb(server_pid) if server_pid else None
+
+        ops_before = mongo_ops(admin)
+        started_at = time.perf_counter()
+        threads = [threading.Thread(target=c.run, args=(entries[c.key], not options.closed_loop, started_at))
+                   for c in clients]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = time.perf_counter() - started_at
+        ops_after = mongo_ops(admin)
+        startup = startup_status(url)
+
+    result = report(clients, duration,
+                    ops_after - ops_before if ops_before is not None and ops_after is not None else None,
+                    rss_connected - rss_before if rss_before is not None else None,
+                    ready_s, startup)
+    print_report(result)
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump(result, f, indent=2)
+    return result
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+Microbenchmark of the all_diagram_models payload of a 500 model diagram, as sent to a room of N clients.
+
+Compares json.dumps(..., default=str) followed by one Socket.IO packet encoding per recipient (how payloads
+were sent before src/util/serialization.py) with the serializer's json and msgpack formats encoded once, and
+their zlib variants at COMPRESSION_LEVEL. Every compressed payload is decoded again and checked against the
+diagram it was made from. Run it from the repository root, next to the server's .env:
+
+    python -m bench.serialization --models 500 --recipients 50
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import random
+import timeit
+from datetime import datetime
+
+from bson import ObjectId
+from socketio import packet
+
+from src.util import serialization
+
+
+def diagram_models(models: int, seed: int = 0) -> list:
+    rng = random.Random(seed)
+    diagram_id = ObjectId()
+    representations = []
+    ids = [ObjectId() for _ in range(models)]
+    for model_id in ids:
+        relations = [{'_id': ObjectId(), 'target': rng.choice(ids), 'type': 'association', 'multiplicity': '1'}
+                     for _ in range(rng.randint(0, 3))]
+        representations.append({
+            '_id': ObjectId(),
+            'diagramId': diagram_id,
+            'modelId': model_id,
+            'x': rng.randint(0, 2000), 'y': rng.randint(0, 2000), 'w': 120, 'h': 80,
+            'relations': [{'_id': ObjectId(), 'relationId': r['_id'], 'points': []} for r in relations],
+            'model': {
+                '_id': model_id,
+                'type': 'class',
+                'path': '/bench',
+                'title': f'Model{model_id}',
+                'createdAt': datetime.utcnow(),
+                'attributes': [{'_id': ObjectId(), 'kind': 'field', 'name': f'field{i}', 'type': 'int',
+                                'accessModifier': 'private'} for i in range(rng.randint(2, 8))],
+                'relations': relations,
+            },
+        })
+    return representations
+
+
+def per_recipient(payload, recipients: int) -> None:
+    for _ in range(recipients):
+        packet.Packet(packet.EVENT, data=['all_diagram_models', payload]).encode()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--models', type=int, default=500)
+    parser.add_argument('--recipients', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=20)
+    options = parser.parse_args()
+
+    data = diagram_models(options.models)
+    cases = {
+        'json.dumps(default=str), once':
+            lambda: per_recipient(json.dumps(data, default=str), 1),
+        'json.dumps(default=str), per recipient':
+            lambda: per_recipient(json.dumps(data, default=str), options.recipients),
+        'serialization json, encoded once':
+            lambda: per_recipient(serialization.encode(data, serialization.JSON), 1),
+    }
+    if serialization.MSGPACK in serialization.available_formats():
+        cases['serialization msgpack, encoded once'] = \
+            lambda: per_recipient(serialization.encode(data, serialization.MSGPACK), 1)
+    for payload_format in serialization.available_formats():
+        compressed = f'{payload_format}+{serialization.ZLIB}'
+        cases[f'serialization {compressed}, encoded once'] = \
+            lambda f=compressed: per_recipient(serialization.encode(data, f), 1)
+
+    print(f'{options.models} models, {options.recipients} recipients, best of {options.repeat}')
+    for name, case in cases.items():
+        best = min(timeit.repeat(case, number=1, repeat=options.repeat))
+        print(f'  {name:<42} {best * 1000:8.2f} ms')
+    for payload_format in serialization.available_formats():
+        print(f'  {payload_format} payload {len(serialization.encode(data, payload_format)):>10} bytes')
+        round_trip(data, payload_format)
+
+
+def round_trip(data: list, payload_format: str) -> None:
+    """
+    compresses the payload, decodes it again, and prints its compression ratio and the CPU time deflating took
+    """
+    compressed_format = f'{payload_format}+{serialization.ZLIB}'
+    before = serialization.compression_stats()
+    compressed = serialization.encode(data, compressed_format)
+    after = serialization.compression_stats()
+    if not isinstance(compressed, dict):
+        print(f'  {compressed_format} payload not compressed, below COMPRESSION_THRESHOLD')
+        return
+    expected = serialization.decode(serialization.encode(data, payload_format))
+    if serialization.decode(compressed, compressed_format) != expected:
+        raise SystemExit(f'{compressed_format} payload does not decode to the diagram it was made from')
+    raw = after['input_bytes'] - before['input_bytes']
+    deflated = after['output_bytes'] - before['output_bytes']
+    print(f'  {compressed_format} payload {deflated:>10} bytes, ratio {raw / deflated:.1f}, '
+          f'{(after["cpu_seconds"] - before["cpu_seconds"]) * 1000:.2f} ms to deflate, round trip ok')
+
+
+if __name__ == '__main__':
+    main()
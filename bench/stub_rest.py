@@ -0,0 +1,50 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _UsersHandler(BaseHTTPRequestHandler):
+    """
+    Stands in for the REST service's POST /users: any `Bearer <name>` header is a valid user,
+    with an _id derived from the name so reconnects resolve to the same user.
+    """
+
+    def do_POST(self):
+        authorization = self.headers.get('Authorization', '')
+        if self.path != '/users':
+            self.__reply(404, {'error': 'not found'})
+        elif not authorization.startswith('Bearer '):
+            self.__reply(401, {'error': 'unauthorized'})
+        else:
+            name = authorization[len('Bearer '):]
+            self.__reply(200, {
+                '_id': hashlib.sha1(name.encode()).hexdigest()[:24],
+                'name': name,
+                'email': f'{name}@bench.local'
+            })
+
+    def log_message(self, *args):
+        pass
+
+    def __reply(self, status: int, body: dict) -> None:
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def start(port: int = 0) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(('127.0.0.1', port), _UsersHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    stub = start(5001)
+    print(f'Stub REST service on http://127.0.0.1:{stub.server_port}', flush=True)
+    threading.Event().wait()
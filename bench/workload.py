@@ -0,0 +1,114 @@
+from __future__ import annotations
+
+import json
+import random
+from collections import defaultdict
+from typing import Dict, List
+
+# relative weight of each editing event in the generated mix
+DEFAULT_MIX = {
+    'update_model_rep': 70,
+    'add_model_attribute': 8,
+    'update_model_attribute': 10,
+    'create_model_relation': 4,
+    'update_model_relation': 8,
+}
+
+# broadcasts that complete an event, the first one referring to the same ids is taken as its answer
+RESPONSE_EVENTS = {
+    'join_diagram': ('all_diagram_models', 'diagram_models_done'),
+    'create_model': ('model_added',),
+    'add_model': ('model_added',),
+    'delete_model': ('model_deleted',),
+    'delete_model_rep': ('model_rep_deleted',),
+    'update_model_rep': ('model_rep_patched', 'model_reps_moved'),
+    'add_model_attribute': ('model_patched',),
+    'remove_model_attribute': ('model_patched',),
+    'update_model_attribute': ('model_patched',),
+    'create_model_relation': ('model_patched',),
+    'update_model_relation': ('model_patched',),
+    'remove_model_relation': ('model_patched',),
+    'batch_ops': ('batch_applied',),
+}
+
+# update_model_rep ops in one generated batch_ops event
+BATCH_SIZE = 20
+
+# generated traces refer to ids that only exist once a run has set itself up, run.py resolves them per client:
+# $diagram - the benchmark diagram, $model / $rep - the model the client created, $peer_model - the next
+# client's model, $attr / $relation - the last attribute / relation the client created
+PLACEHOLDERS = ('$diagram', '$model', '$rep', '$peer_model', '$attr', '$relation')
+
+
+def generate(clients: int, ops_per_client: int, seed: int, interval: float, mix: Dict[str, int] = None) -> List[dict]:
+    """
+    returns a trace in the format of src/util/event_trace.py, deterministic for a given seed
+    """
+    mix = mix or DEFAULT_MIX
+    rng = random.Random(seed)
+    events, weights = zip(*mix.items())
+    trace = []
+    for client in range(clients):
+        key = f'bench-{client}'
+        t = rng.uniform(0, interval)
+        setup = [
+            ('join_diagram', [{'diagramId': '$diagram'}]),
+            ('create_model', [{'type': 'class', 'path': '/bench', 'title': key},
+                              {'x': 0, 'y': 0, 'w': 120, 'h': 80}]),
+            ('add_model_attribute', [{'modelId': '$model'}, __attribute(key, 0)]),
+            ('create_model_relation', [{'modelId': '$model', 'modelRepId': '$rep'}, __relation('$peer_model')]),
+        ]
+        for event, args in setup:
+            trace.append({'t': round(t, 6), 'client': key, 'event': event, 'args': args})
+            t += interval
+        for i in range(ops_per_client):
+            event = rng.choices(events, weights)[0]
+            trace.append({'t': round(t, 6), 'client': key, 'event': event, 'args': __args(event, key, i, rng)})
+            t += interval
+    trace.sort(key=lambda e: e['t'])
+    return trace
+
+
+def by_client(trace: List[dict]) -> Dict[str, List[dict]]:
+    clients = defaultdict(list)
+    for entry in trace:
+        if entry['event'] not in ('connect', 'disconnect'):
+            clients[entry['client']].append(entry)
+    return clients
+
+
+def load(path: str) -> List[dict]:
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def save(trace: List[dict], path: str) -> None:
+    with open(path, 'w') as f:
+        for entry in trace:
+            f.write(json.dumps(entry) + '\n')
+
+
+def __args(event: str, key: str, i: int, rng: random.Random) -> list:
+    if event == 'update_model_rep':
+        return [{'_id': '$rep', 'x': rng.randint(0, 2000), 'y': rng.randint(0, 2000), 'w': 120, 'h': 80}]
+    if event == 'add_model_attribute':
+        return [{'modelId': '$model'}, __attribute(key, i)]
+    if event == 'update_model_attribute':
+        return [{'modelId': '$model'}, {**__attribute(key, i), '_id': '$attr'}]
+    if event == 'create_model_relation':
+        return [{'modelId': '$model', 'modelRepId': '$rep'}, __relation('$peer_model')]
+    if event == 'update_model_relation':
+        return [{'modelId': '$model'}, {**__relation('$peer_model'), '_id': '$relation'}]
+    if event == 'batch_ops':
+        moves = [{'event': 'update_model_rep', 'args': __args('update_model_rep', key, i, rng)}
+                 for _ in range(BATCH_SIZE)]
+        return [{'batchId': f'{key}-{i}', 'ops': moves}]
+    raise ValueError(f'No generator for {event}')
+
+
+def __attribute(key: str, i: int) -> dict:
+    return {'kind': 'field', 'name': f'{key}_{i}', 'type': 'int', 'accessModifier': 'private'}
+
+
+def __relation(target: str) -> dict:
+    return {'target': target, 'type': 'association', 'multiplicity': '1'}
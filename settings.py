@@ -14,3 +14,99 @@ MONGO_CONN = {
     'host': os.environ['MONGO_HOST'],
     'user': os.environ['MONGO_USER']
 }
+
+# seconds an unused diagram room stays in the in-memory state cache, 0 disables caching
+DIAGRAM_CACHE_TTL = int(os.environ.get('DIAGRAM_CACHE_TTL', 300))
+
+# merge update_model_rep drag traffic per representation, broadcast it every tick and persist it every flush interval
+GEOMETRY_COALESCING = os.environ.get('GEOMETRY_COALESCING', 'false').lower() == 'true'
+GEOMETRY_TICK_RATE = float(os.environ.get('GEOMETRY_TICK_RATE', 20))
+GEOMETRY_FLUSH_INTERVAL = float(os.environ.get('GEOMETRY_FLUSH_INTERVAL', 2))
+
+# validation of the Authorization header against the REST service
+AUTH_TIMEOUT = float(os.environ.get('AUTH_TIMEOUT', 5))
+AUTH_POOL_SIZE = int(os.environ.get('AUTH_POOL_SIZE', 10))
+AUTH_CACHE_SIZE = int(os.environ.get('AUTH_CACHE_SIZE', 1000))
+AUTH_CACHE_TTL = float(os.environ.get('AUTH_CACHE_TTL', 60))
+
+# pub/sub backend shared by all workers (redis://, amqp://, kafka://, zmq+tcp:// or loopback://<port>,<port> locally),
+# empty for a single in-process worker
+SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE', '')
+# secret the processes of a loopback:// queue authenticate each other with, which it refuses to start without:
+# they unpickle what peers send
+LOOPBACK_AUTHKEY = os.environ.get('LOOPBACK_AUTHKEY', '')
+
+# largest page get_model_history returns
+HISTORY_PAGE_LIMIT = int(os.environ.get('HISTORY_PAGE_LIMIT', 200))
+
+# create missing indexes at startup, and optionally refuse to start when an access path would scan a collection
+ENSURE_INDEXES = os.environ.get('ENSURE_INDEXES', 'true').lower() == 'true'
+VERIFY_QUERY_PLANS = os.environ.get('VERIFY_QUERY_PLANS', 'false').lower() == 'true'
+
+# append every incoming socket event to this file, for replay with bench/run.py --replay
+EVENT_TRACE_FILE = os.environ.get('EVENT_TRACE_FILE', '')
+
+# log socket events and Mongo commands slower than this many seconds (0 disables), for this share of them
+SLOW_EVENT_SECONDS = float(os.environ.get('SLOW_EVENT_SECONDS', 0.5))
+SLOW_EVENT_SAMPLE_RATE = float(os.environ.get('SLOW_EVENT_SAMPLE_RATE', 0.1))
+
+# payload encodings clients may ask for at connect (?format= or X-Payload-Format), the first one is the default;
+# msgpack needs the msgpack package
+PAYLOAD_FORMATS = [f.strip() for f in os.environ.get('PAYLOAD_FORMATS', 'json').split(',') if f.strip()]
+
+# 'zlib' lets clients ask for compressed payloads at connect (?compress=zlib or X-Payload-Compression);
+# payloads of COMPRESSION_THRESHOLD bytes and more are then deflated at COMPRESSION_LEVEL (1 fastest - 9 smallest)
+PAYLOAD_COMPRESSION = os.environ.get('PAYLOAD_COMPRESSION', '')
+COMPRESSION_THRESHOLD = int(os.environ.get('COMPRESSION_THRESHOLD', 16384))
+COMPRESSION_LEVEL = int(os.environ.get('COMPRESSION_LEVEL', 6))
+
+# representations per diagram_models_chunk when a client joins with {'stream': true}
+JOIN_CHUNK_SIZE = int(os.environ.get('JOIN_CHUNK_SIZE', 200))
+
+# set_viewport routing: grid cell size of the per-room spatial index, and how far outside its viewport
+# a client still gets updates, both in diagram coordinates
+VIEWPORT_CELL_SIZE = float(os.environ.get('VIEWPORT_CELL_SIZE', 512))
+VIEWPORT_MARGIN = float(os.environ.get('VIEWPORT_MARGIN', 200))
+
+# numbered room broadcasts kept per room for clients resuming with lastSeq, and how long an idle room's log is kept
+ROOM_LOG_SIZE = int(os.environ.get('ROOM_LOG_SIZE', 500))
+ROOM_LOG_TTL = float(os.environ.get('ROOM_LOG_TTL', 600))
+
+# write-behind: socket mutations of models open in a cached room are journaled to WRITE_BEHIND_JOURNAL, broadcast,
+# and written to Mongo in bulk every WRITE_BEHIND_INTERVAL seconds or WRITE_BEHIND_BATCH_SIZE writes; single worker only
+WRITE_BEHIND = os.environ.get('WRITE_BEHIND', 'false').lower() == 'true'
+WRITE_BEHIND_JOURNAL = os.environ.get('WRITE_BEHIND_JOURNAL', 'write_behind.journal')
+WRITE_BEHIND_INTERVAL = float(os.environ.get('WRITE_BEHIND_INTERVAL', 1))
+WRITE_BEHIND_BATCH_SIZE = int(os.environ.get('WRITE_BEHIND_BATCH_SIZE', 500))
+WRITE_BEHIND_FSYNC = os.environ.get('WRITE_BEHIND_FSYNC', 'false').lower() == 'true'
+
+# token buckets per client and event class (see rate_limiter.EVENT_CLASSES) as class=rate/burst, in events per second;
+# a throttled event is answered with an error of type rate_limited, classes left out are not limited
+RATE_LIMITS = {
+    event_class.strip(): tuple(float(v) for v in limit.split('/'))
+    for event_class, limit in (item.split('=') for item in os.environ.get(
+        'RATE_LIMITS', 'geometry=60/120,edit=20/40,read=20/40,load=2/10,batch=5/10').split(',') if item.strip())
+}
+if any(rate <= 0 or burst < 1 for rate, burst in RATE_LIMITS.values()):
+    raise ValueError('RATE_LIMITS needs a rate above 0 and a burst of at least 1, leave a class out to not limit it')
+
+# a client with more packets than this waiting to go out gets geometry updates late and merged, 0 disables;
+# how often held updates are checked for clients that caught up, in seconds
+SLOW_CONSUMER_QUEUE = int(os.environ.get('SLOW_CONSUMER_QUEUE', 64))
+SLOW_CONSUMER_CHECK_INTERVAL = float(os.environ.get('SLOW_CONSUMER_CHECK_INTERVAL', 0.1))
+
+# asyncio server (async_app.py): threads running the blocking Mongo calls of its services
+ASYNC_WORKER_THREADS = int(os.environ.get('ASYNC_WORKER_THREADS', 16))
+
+# largest number of ops one batch_ops event may carry
+BATCH_MAX_OPS = int(os.environ.get('BATCH_MAX_OPS', 500))
+
+# seconds between attempts of a start-up step (reaching Mongo, the REST service, ...) that failed
+STARTUP_RETRY_INTERVAL = float(os.environ.get('STARTUP_RETRY_INTERVAL', 2))
+# diagrams loaded into the diagram cache before /ready reports ready: these ids, then the PREWARM_RECENT
+# most recently edited ones (0 disables that query)
+PREWARM_DIAGRAMS = [d.strip() for d in os.environ.get('PREWARM_DIAGRAMS', '').split(',') if d.strip()]
+PREWARM_RECENT = int(os.environ.get('PREWARM_RECENT', 0))
+
+# keep one joined snapshot document per diagram in Mongo, updated by every mutation, so a join is a single read
+DIAGRAM_SNAPSHOTS = os.environ.get('DIAGRAM_SNAPSHOTS', 'false').lower() == 'true'
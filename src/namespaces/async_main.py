@@ -0,0 +1,398 @@
+import asyncio
+import time
+from typing import Any, Callable, List, Optional, Tuple
+from urllib.parse import parse_qs
+
+import aiohttp
+import socketio
+import socketio.exceptions
+
+import settings
+from src.namespaces import shared
+from src.services import auth_service, diagram_cache, model_service, offload, rate_limiter, room_log, \
+    room_registry, slow_consumers, startup, viewport_index
+from src.services.geometry_coalescer import GeometryCoalescer, GEOMETRY_FIELDS
+from src.util import metrics
+from src.util.event_trace import open_trace
+from src.util.exceptions import AuthenticationException
+
+
+# noinspection PyMethodMayBeStatic
+class AsyncMainNamespace(socketio.AsyncNamespace):
+    """
+    MainNamespace for the asyncio server: the same events and payloads, with the blocking service calls
+    awaited on the offload thread pool and the REST service called with aiohttp.
+    """
+
+    def __init__(self, namespace=None):
+        super(AsyncMainNamespace, self).__init__(namespace)
+        # persisted from flush(), which runs on the thread pool
+        self.__geometry = GeometryCoalescer(persist=model_service.update_model_reps,
+                                            broadcast=self.__collect_geometry)
+        self.__ticked: List[Tuple[str, List[dict]]] = []
+        self.__geometry_task = None
+        self.__release_task = None
+        self.__trace = open_trace(settings.EVENT_TRACE_FILE)
+
+    async def trigger_event(self, event, *args):
+        # args[0] is the sid, the event data follows
+        sid = args[0]
+        label = shared.event_label(self, event)
+        if self.__trace is not None:
+            self.__trace.record(sid, label, args[1:])
+        retry_after = rate_limiter.acquire(sid, label)
+        if retry_after is not None:
+            await self.emit('error', {'error_type': 'rate_limited', 'event': event,
+                                      'retryAfter': round(retry_after, 3)}, room=sid)
+            return
+        with metrics.timed('socket_event_seconds', event=label):
+            try:
+                return await super(AsyncMainNamespace, self).trigger_event(event, *args)
+            except socketio.exceptions.ConnectionRefusedError:
+                # refuses the connection
+                raise
+            except ConnectionRefusedError:
+                await self.disconnect(sid)
+            except Exception as e:
+                await self.emit('error', {'error_type': 'general', 'error': e.__repr__()}, room=sid)
+
+    async def on_connect(self, sid, environ, auth=None):
+        if not startup.ready():
+            # the load balancer holds traffic back until /ready, this covers clients that come anyway
+            raise socketio.exceptions.ConnectionRefusedError('starting')
+        try:
+            user = await auth_service.authenticate_async(environ.get('HTTP_AUTHORIZATION', ''))
+        except AuthenticationException as e:
+            if e.status_code == 401:
+                print("Auth failed!", flush=True)
+                raise socketio.exceptions.ConnectionRefusedError('unauthorized!')
+            print("Unknown connection error!", flush=True)
+            raise socketio.exceptions.ConnectionRefusedError('unknown connection error!')
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"Auth service unreachable: {e!r}", flush=True)
+            raise socketio.exceptions.ConnectionRefusedError('unknown connection error!')
+        query = parse_qs(environ.get('QUERY_STRING', ''))
+        connection = shared.connect(sid, user,
+                                    query.get('format', [None])[0] or environ.get('HTTP_X_PAYLOAD_FORMAT'),
+                                    query.get('compress', [None])[0] or environ.get('HTTP_X_PAYLOAD_COMPRESSION'))
+        await self.__send(sid, 'connection_response', {'success': True, 'format': connection.format})
+
+    async def on_disconnect(self, sid):
+        connection = shared.disconnect(sid)
+        if connection is not None and connection.room:
+            await self.__broadcast('user_left', shared.presence(connection), connection.room)
+
+    async def on_join_diagram(self, sid, data):
+        started = time.perf_counter()
+        if await self.__validate(sid, data, ['diagramId']):
+            diagram = await offload.diagram_service.get_diagram(data['diagramId'])
+
+            if diagram is not None:
+                connection = room_registry.connection(sid)
+                room, previous = shared.join(diagram, sid)
+                if previous:
+                    await self.__broadcast('user_left', shared.presence(connection), previous)
+                    self.leave_room(sid, shared.format_room(previous, connection))
+                    self.leave_room(sid, previous)
+
+                self.enter_room(sid, room)
+                self.enter_room(sid, shared.format_room(room, connection))
+                if data.get('viewport') and await self.__validate(sid, data['viewport'], ['x', 'y', 'w', 'h']):
+                    viewport_index.set_viewport(room, sid, data['viewport'])
+
+                last_seq = shared.last_seq(data)
+                if last_seq is None or not await self.__resume(sid, data.get('logId'), last_seq):
+                    # broadcasts numbered after this position arrive on top of the load
+                    await self.__send(sid, 'diagram_position', room_log.position(room))
+                    if data.get('stream'):
+                        await self.__stream_diagram_models(sid, diagram.id)
+                    else:
+                        await self.__send_diagram_models(sid, diagram.id)
+
+                await self.__broadcast('user_joined', shared.presence(connection), room)
+                startup.joined(room, time.perf_counter() - started)
+            else:
+                await self.emit('error', {'error_type': 'diagram_not_found'}, room=sid)
+
+    async def on_leave_diagram(self, sid):
+        connection = self.__ensure_client_is_in_room(sid)
+        room = connection.room
+        await self.__broadcast('user_left', shared.presence(connection), room)
+        self.leave_room(sid, shared.format_room(room, connection))
+        self.leave_room(sid, room)
+        shared.leave(room, sid)
+
+    async def on_create_model(self, sid, model, representation):
+        connection = self.__ensure_client_is_in_room(sid)
+        if await self.__validate(sid, model, ['type', 'path']) \
+                and await self.__validate(sid, representation, ['x', 'y', 'w', 'h']):
+            await self.__handle_model_change(sid, offload.model_service.create, 'model_added', 'model_error',
+                                             model=model,
+                                             representation=representation,
+                                             diagram=room_registry.diagram(connection.room),
+                                             user_id=connection.user_id)
+
+    async def on_add_model(self, sid, model_data, representation):
+        connection = self.__ensure_client_is_in_room(sid)
+        if await self.__validate(sid, model_data, ['modelId']) \
+                and await self.__validate(sid, representation, ['x', 'y', 'w', 'h']):
+            await self.__handle_model_change(sid, offload.model_service.add_to_diagram, 'model_added', 'model_error',
+                                             model_id=model_data['modelId'],
+                                             representation=representation,
+                                             diagram=room_registry.diagram(connection.room))
+
+    async def on_delete_model(self, sid, model_data):
+        if await self.__validate(sid, model_data, ['modelId']):
+            active_rooms = room_registry.rooms_for_model(model_data['modelId'])
+            rooms = await offload.model_service.delete_model(model_data['modelId'])
+            if rooms is not None:
+                viewport_index.remove_model(model_data['modelId'])
+                room_registry.remove_model(model_data['modelId'])
+                for room in set(rooms) | set(active_rooms):
+                    await self.__broadcast_plain('model_deleted', {'modelId': model_data['modelId']}, room)
+            else:
+                await self.emit('error', {'error_type': 'deleteModelError',
+                                          'message': f'model not deleted, id: {model_data["modelId"]}'}, room=sid)
+
+    async def on_delete_model_rep(self, sid, model_data):
+        connection = self.__ensure_client_is_in_room(sid)
+        if await self.__validate(sid, model_data, ['modelRepId']):
+            rooms = await offload.model_service.delete_model_rep(model_data['modelRepId'])
+            if rooms is not None:
+                viewport_index.remove_representation(model_data['modelRepId'])
+                room_registry.remove_representation(model_data['modelRepId'])
+                slow_consumers.discard(model_data['modelRepId'])
+                await self.__broadcast_plain('model_rep_deleted', model_data, connection.room)
+            else:
+                await self.emit('error', {'error_type': 'deleteRepresentationError',
+                                          'message': f'could not delete representation based on request: '
+                                                     f'{str(model_data)}'}, room=sid)
+
+    async def on_update_model_rep(self, sid, data):
+        connection = self.__ensure_client_is_in_room(sid)
+        if await self.__validate(sid, data, ['_id', 'x', 'y', 'w', 'h']):
+            drag_end = data.pop('dragEnd', False)
+            if settings.GEOMETRY_COALESCING and not drag_end:
+                self.__geometry.submit(connection.room, data)
+                diagram_cache.update_geometry(data['_id'], {k: data[k] for k in GEOMETRY_FIELDS})
+                if self.__geometry_task is None:
+                    self.__geometry_task = self.server.start_background_task(self.__run_geometry_loop)
+                return
+            self.__geometry.discard(data['_id'])
+            patch = await offload.model_service.update_model_rep(data)
+            if patch is None:
+                await self.emit('error', {'error_type': 'update_model_error'}, room=sid)
+                return
+            await self.__broadcast('model_rep_patched', patch, connection.room,
+                                   viewport_index.move(connection.room, patch['_id'], patch))
+
+    async def on_add_model_attribute(self, sid, references, attribute):
+        connection = self.__ensure_client_is_in_room(sid)
+        if await self.__validate(sid, references, ['modelId']) and await self.__validate_attribute(sid, attribute):
+            await self.__handle_model_patch(sid, offload.model_service.add_attribute,
+                                            model_id=references['modelId'],
+                                            user_id=connection.user_id,
+                                            attribute=attribute)
+
+    async def on_remove_model_attribute(self, sid, references):
+        connection = self.__ensure_client_is_in_room(sid)
+        if await self.__validate(sid, references, ['modelId', 'attributeId']):
+            await self.__handle_model_patch(sid, offload.model_service.remove_attribute,
+                                            model_id=references['modelId'],
+                                            attribute_id=references['attributeId'],
+                                            user_id=connection.user_id)
+
+    async def on_update_model_attribute(self, sid, references, attribute):
+        connection = self.__ensure_client_is_in_room(sid)
+        if await self.__validate(sid, references, ['modelId']) and await self.__validate_attribute(sid, attribute):
+            await self.__handle_model_patch(sid, offload.model_service.update_attribute,
+                                            model_id=references['modelId'],
+                                            user_id=connection.user_id,
+                                            attribute=attribute)
+
+    async def on_create_model_relation(self, sid, references, relation):
+        connection = self.__ensure_client_is_in_room(sid)
+        if await self.__validate(sid, references, ['modelId', 'modelRepId']) \
+                and await self.__validate(sid, relation, ['target']):
+            await self.__handle_model_patch(sid, offload.model_service.create_relation,
+                                            model_id=references['modelId'],
+                                            representation_id=references['modelRepId'],
+                                            user_id=connection.user_id,
+                                            relation=relation)
+
+    async def on_update_model_relation(self, sid, references, relation):
+        connection = self.__ensure_client_is_in_room(sid)
+        if await self.__validate(sid, references, ['modelId']) \
+                and await self.__validate(sid, relation, ['_id', 'target']):
+            await self.__handle_model_patch(sid, offload.model_service.update_relation,
+                                            model_id=references['modelId'],
+                                            user_id=connection.user_id,
+                                            relation=relation)
+
+    async def on_remove_model_relation(self, sid, data):
+        connection = self.__ensure_client_is_in_room(sid)
+        if await self.__validate(sid, data, ['modelId', 'modelRepId', 'relationId', 'deep']):
+            await self.__handle_model_patch(sid, offload.model_service.delete_relation,
+                                            model_id=data['modelId'],
+                                            representation_id=data['modelRepId'],
+                                            relation_id=data['relationId'],
+                                            deep=data['deep'],
+                                            user_id=connection.user_id)
+
+    async def on_batch_ops(self, sid, data):
+        connection = self.__ensure_client_is_in_room(sid)
+        if await self.__validate(sid, data, ['ops']):
+            too_large = shared.batch_too_large(data)
+            if too_large is not None:
+                await self.emit('error', too_large, room=sid)
+                return
+            batch = await offload.model_service.apply_batch(data['ops'], room_registry.diagram(connection.room),
+                                                            connection.user_id)
+            await self.__send(sid, 'batch_result', {'batchId': data.get('batchId'), 'results': batch.results})
+            for room, ops, resync, rects in shared.batch_broadcasts(batch, connection.room, self.__geometry):
+                await self.__broadcast('batch_applied', {'batchId': data.get('batchId'), 'ops': ops,
+                                                         'resync': resync}, room, rects)
+
+    async def on_set_viewport(self, sid, data):
+        connection = self.__ensure_client_is_in_room(sid)
+        if await self.__validate(sid, data, ['x', 'y', 'w', 'h']):
+            entering = shared.entering(sid, connection.room, data)
+            if entering:
+                await self.__send_representations(sid, entering)
+
+    async def on_get_model_reps(self, sid, data):
+        self.__ensure_client_is_in_room(sid)
+        if await self.__validate(sid, data, ['ids']):
+            await self.__send_representations(sid, data['ids'])
+
+    async def on_resync_model(self, sid, data):
+        if await self.__validate(sid, data, ['modelId']):
+            model = await offload.model_service.get_model(data['modelId'])
+            if model is None:
+                await self.emit('error', {'error_type': 'model_not_found'}, room=sid)
+                return
+            await self.__send(sid, 'model_resynced', {'version': model.version, 'model': model})
+
+    async def on_get_model_history(self, sid, data):
+        if await self.__validate(sid, data, ['modelId']):
+            page = await offload.history_service.get_page(data['modelId'],
+                                                          before=data.get('before'),
+                                                          limit=min(int(data.get('limit', 50)),
+                                                                    settings.HISTORY_PAGE_LIMIT))
+            await self.__send(sid, 'model_history', page)
+
+    async def __resume(self, sid: str, log_id: str, last_seq: int) -> bool:
+        connection = room_registry.connection(sid)
+        room = connection.room
+        missed = shared.missed(connection, log_id, last_seq)
+        if missed is None:
+            return False
+        if not room_registry.is_loaded(room):
+            shared.loaded(room, await offload.model_service.get_full_model_representations_for_diagram(room))
+        for seq, event, payload in missed:
+            await self.emit(event, (payload, seq), room=sid)
+            last_seq = seq
+        await self.__send(sid, 'diagram_resumed', {'logId': log_id, 'seq': last_seq, 'missed': len(missed)})
+        return True
+
+    async def __send_diagram_models(self, sid: str, diagram_id) -> None:
+        room = room_registry.connection(sid).room
+        diagram_models = await offload.model_service.get_full_model_representations_for_diagram(diagram_id)
+        shared.loaded(room, diagram_models)
+        diagram_models = shared.in_viewport(sid, room, diagram_models)
+
+        await self.__send(sid, 'all_diagram_models', diagram_models)
+        await self.__send(sid, 'model_versions', shared.versions(diagram_models))
+
+    async def __stream_diagram_models(self, sid: str, diagram_id) -> None:
+        room = room_registry.connection(sid).room
+        seq = 0
+        count = 0
+        chunks = model_service.iter_full_model_representations_for_diagram(diagram_id, settings.JOIN_CHUNK_SIZE)
+        async for chunk in offload.iterate(chunks):
+            shared.loaded(room, chunk)
+            chunk = shared.in_viewport(sid, room, chunk)
+            await self.__send(sid, 'diagram_models_chunk',
+                              {'seq': seq, 'models': chunk, 'versions': shared.versions(chunk)})
+            seq += 1
+            count += len(chunk)
+        await self.__send(sid, 'diagram_models_done', {'chunks': seq, 'count': count})
+
+    async def __send_representations(self, sid: str, representation_ids: list) -> None:
+        representations = await offload.model_service.get_full_model_representations(
+            room_registry.connection(sid).room, representation_ids)
+        await self.__send(sid, 'viewport_models',
+                          {'models': representations, 'versions': shared.versions(representations)})
+
+    async def __run_geometry_loop(self) -> None:
+        last_flush = time.monotonic()
+        while True:
+            await self.server.sleep(1 / settings.GEOMETRY_TICK_RATE)
+            self.__geometry.tick()
+            ticked, self.__ticked = self.__ticked, []
+            for room, geometries in ticked:
+                await self.__broadcast('model_reps_moved', geometries, room, shared.moved_rects(room, geometries))
+            if time.monotonic() - last_flush >= settings.GEOMETRY_FLUSH_INTERVAL:
+                await offload.run(self.__geometry.flush)
+                last_flush = time.monotonic()
+
+    def __collect_geometry(self, room: str, geometries: List[dict]) -> None:
+        # GeometryCoalescer.tick is synchronous, the loop above sends what it hands over
+        self.__ticked.append((room, geometries))
+
+    async def __broadcast(self, event: str, data, room: str, rects: Optional[list] = None) -> None:
+        emits, held = shared.broadcasts(self.server, self.namespace, event, data, room, rects)
+        for members, payload, skip_sid in emits:
+            await self.emit(event, payload, room=members, skip_sid=skip_sid)
+        if held and self.__release_task is None:
+            self.__release_task = self.server.start_background_task(self.__run_release_loop)
+
+    async def __broadcast_plain(self, event: str, data: dict, room: str) -> None:
+        room, payload, _ = shared.plain_broadcast(event, data, room)
+        await self.emit(event, payload, room=room)
+
+    async def __run_release_loop(self) -> None:
+        while True:
+            await self.server.sleep(settings.SLOW_CONSUMER_CHECK_INTERVAL)
+            for sid, payload, _ in shared.released(self.server, self.namespace):
+                await self.emit('model_reps_moved', payload, room=sid)
+
+    async def __send(self, sid: str, event: str, data) -> None:
+        await self.emit(event, shared.encode(room_registry.connection(sid), event, data), room=sid)
+
+    async def __handle_model_change(self, sid: str, func: Callable[..., Any], success_event: str,
+                                    error_event: str, **kwargs) -> None:
+        room = room_registry.connection(sid).room
+        result = await func(**kwargs)
+        if result is None:
+            await self.emit('error', {'error_type': error_event}, room=sid)
+            return
+        shared.loaded(room, [result])
+        await self.__broadcast(success_event, result, room, [viewport_index.rect_of(result)])
+
+    async def __handle_model_patch(self, sid: str, func: Callable[..., Any], **kwargs) -> None:
+        patch = await func(**kwargs)
+        if patch is None:
+            await self.emit('error', {'error_type': 'update_model_error'}, room=sid)
+            return
+        for room in shared.model_patch_rooms(patch, room_registry.connection(sid).room):
+            await self.__broadcast('model_patched', patch, room, shared.model_rects(patch, room))
+
+    @staticmethod
+    def __ensure_client_is_in_room(sid: str) -> room_registry.Connection:
+        connection = room_registry.connection(sid)
+        if connection is None or connection.room is None:
+            raise ConnectionRefusedError('please join a diagram before taking this action!')
+        return connection
+
+    async def __validate_attribute(self, sid: str, to_check: dict) -> bool:
+        return await self.__answer(sid, shared.attribute_error(to_check))
+
+    async def __validate(self, sid: str, to_check: dict, required_keys: list) -> bool:
+        return await self.__answer(sid, shared.validation_error(to_check, required_keys))
+
+    async def __answer(self, sid: str, error: Optional[dict]) -> bool:
+        if error is None:
+            return True
+        await self.emit('error', error, room=sid)
+        return False
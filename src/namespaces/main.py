@@ -1,70 +1,111 @@
-import json
-from typing import Callable, TypeVar, Any
+import time
+from typing import Callable, TypeVar, Any, List, Optional
 
 import requests
-from bpr_data.models.model import FullModelRepresentation
 from bpr_data.models.mongo_document_base import SerializableObject
-from flask import request, session
+from flask import request
 from flask_socketio import emit, join_room, Namespace, leave_room
 
 import settings
-from src.services import diagram_service, model_service
+from src.namespaces import shared
+from src.services import diagram_service, model_service, diagram_cache, auth_service, history_service, \
+    viewport_index, room_log, room_registry, rate_limiter, slow_consumers, startup
+from src.services.geometry_coalescer import GeometryCoalescer, GEOMETRY_FIELDS
+from src.util import metrics
+from src.util.event_trace import open_trace
+from src.util.exceptions import AuthenticationException
 
 
 # noinspection PyMethodMayBeStatic
 class MainNamespace(Namespace):
 
+    def __init__(self, namespace=None):
+        super(MainNamespace, self).__init__(namespace)
+        self.__geometry = GeometryCoalescer(persist=model_service.update_model_reps,
+                                            broadcast=self.__broadcast_geometry)
+        self.__geometry_task = None
+        self.__release_task = None
+        self.__trace = open_trace(settings.EVENT_TRACE_FILE)
+
+    def trigger_event(self, event, *args):
+        # args[0] is the sid, the event data follows
+        label = shared.event_label(self, event)
+        if self.__trace is not None:
+            self.__trace.record(args[0], label, args[1:])
+        retry_after = rate_limiter.acquire(args[0], label)
+        if retry_after is not None:
+            self.socketio.emit('error', {'error_type': 'rate_limited', 'event': event,
+                                         'retryAfter': round(retry_after, 3)},
+                               room=args[0], namespace=self.namespace)
+            return
+        with metrics.timed('socket_event_seconds', event=label):
+            return super(MainNamespace, self).trigger_event(event, *args)
+
     def on_connect(self):
-        headers = {'Authorization': request.headers['Authorization']}
-        response = requests.post(f'{settings.REST_DOMAIN}/users', headers=headers)
-        if response.status_code == 200:
-            session['user'] = response.json()
-            session['user']['id'] = str(session['user']['_id'])
-            emit(
-                'connection_response',
-                json.dumps({
-                    'success': True,
-                }, default=str))
-        elif response.status_code == 401:
-            print("Auth failed!", flush=True)
-            raise ConnectionRefusedError('unauthorized!')
-        else:
+        if not startup.ready():
+            # the load balancer holds traffic back until /ready, this covers clients that come anyway
+            raise ConnectionRefusedError('starting')
+        try:
+            user = auth_service.authenticate(request.headers['Authorization'])
+        except AuthenticationException as e:
+            if e.status_code == 401:
+                print("Auth failed!", flush=True)
+                raise ConnectionRefusedError('unauthorized!')
             print("Unknown connection error!", flush=True)
             raise ConnectionRefusedError('unknown connection error!')
+        except requests.RequestException as e:
+            print(f"Auth service unreachable: {e!r}", flush=True)
+            raise ConnectionRefusedError('unknown connection error!')
+        connection = shared.connect(request.sid, user,
+                                    request.args.get('format') or request.headers.get('X-Payload-Format'),
+                                    request.args.get('compress') or request.headers.get('X-Payload-Compression'))
+        self.__send('connection_response', {'success': True, 'format': connection.format})
 
     def on_disconnect(self):
-        emit('user_left',
-             json.dumps({'id': session['user']['id'], 'name': session['user']['name']}, default=str),
-             to=session['room'])
+        connection = shared.disconnect(request.sid)
+        if connection is not None and connection.room:
+            self.__broadcast('user_left', shared.presence(connection), connection.room)
 
     def on_join_diagram(self, data):
+        started = time.perf_counter()
         if self.__validate(data, ['diagramId']):
             diagram = diagram_service.get_diagram(data['diagramId'])
 
             if diagram is not None:
-                session['diagram'] = diagram
-                session['room'] = str(diagram.id)
-
-                join_room(session['room'])
-
-                diagram_models = model_service.get_full_model_representations_for_diagram(diagram.id)
-
-                emit('all_diagram_models',
-                     FullModelRepresentation.as_json_list(diagram_models))
-
-                emit('user_joined',
-                     json.dumps({'id': session['user']['id'], 'name': session['user']['name']}, default=str),
-                     to=session['room'])
+                connection = self.__connection()
+                room, previous = shared.join(diagram, request.sid)
+                if previous:
+                    self.__broadcast('user_left', shared.presence(connection), previous)
+                    leave_room(shared.format_room(previous, connection))
+                    leave_room(previous)
+
+                join_room(room)
+                join_room(shared.format_room(room, connection))
+                if data.get('viewport') and self.__validate(data['viewport'], ['x', 'y', 'w', 'h']):
+                    viewport_index.set_viewport(room, request.sid, data['viewport'])
+
+                last_seq = shared.last_seq(data)
+                if last_seq is None or not self.__resume(data.get('logId'), last_seq):
+                    # broadcasts numbered after this position arrive on top of the load
+                    self.__send('diagram_position', room_log.position(room))
+                    if data.get('stream'):
+                        self.__stream_diagram_models(diagram.id)
+                    else:
+                        self.__send_diagram_models(diagram.id)
+
+                self.__broadcast('user_joined', shared.presence(connection), room)
+                startup.joined(room, time.perf_counter() - started)
             else:
                 emit('error', {'error_type': 'diagram_not_found'})
 
     def on_leave_diagram(self):
-        session['diagram'] = None
-        emit('user_left',
-             json.dumps({'id': session['user']['id'], 'name': session['user']['name']}, default=str),
-             to=session['room'])
-        leave_room(session['room'])
-        session['room'] = ''
+        self.__ensure_client_is_in_room()
+        connection = self.__connection()
+        room = connection.room
+        self.__broadcast('user_left', shared.presence(connection), room)
+        leave_room(shared.format_room(room, connection))
+        leave_room(room)
+        shared.leave(room, request.sid)
 
     def on_create_model(self, model, representation):
         self.__ensure_client_is_in_room()
@@ -72,8 +113,8 @@ class MainNamespace(Namespace):
             self.__handle_model_add(model_service.create,
                                     model=model,
                                     representation=representation,
-                                    diagram=session['diagram'],
-                                    user_id=session['user']['_id'])
+                                    diagram=room_registry.diagram(self.__connection().room),
+                                    user_id=self.__connection().user_id)
 
     def on_add_model(self, model_data, representation):
         self.__ensure_client_is_in_room()
@@ -81,16 +122,18 @@ class MainNamespace(Namespace):
             self.__handle_model_add(model_service.add_to_diagram,
                                     model_id=model_data['modelId'],
                                     representation=representation,
-                                    diagram=session['diagram'])
+                                    diagram=room_registry.diagram(self.__connection().room))
 
     def on_delete_model(self, model_data):
         if self.__validate(model_data, ['modelId']):
-            affected_diagrams = diagram_service.get_diagrams_for_model(model_data['modelId'])
-            success = model_service.delete_model(model_data['modelId'])
-            if success:
-                rooms = [str(x.id) for x in affected_diagrams]
-                for room in rooms:
-                    emit('model_deleted', {'modelId': model_data['modelId']}, to=room)
+            active_rooms = room_registry.rooms_for_model(model_data['modelId'])
+            rooms = model_service.delete_model(model_data['modelId'])
+            if rooms is not None:
+                viewport_index.remove_model(model_data['modelId'])
+                room_registry.remove_model(model_data['modelId'])
+                # the deleted representations name the diagrams, which reaches rooms active on other workers too
+                for room in set(rooms) | set(active_rooms):
+                    self.__broadcast_plain('model_deleted', {'modelId': model_data['modelId']}, room)
             else:
                 emit('error',
                      {'error_type': 'deleteModelError', 'message': f'model not deleted, id: {model_data["modelId"]}'})
@@ -98,9 +141,12 @@ class MainNamespace(Namespace):
     def on_delete_model_rep(self, model_data):
         self.__ensure_client_is_in_room()
         if self.__validate(model_data, ['modelRepId']):
-            success = model_service.delete_model_rep(model_data['modelRepId'])
-            if success:
-                emit('model_rep_deleted', model_data, to=session['room'])
+            rooms = model_service.delete_model_rep(model_data['modelRepId'])
+            if rooms is not None:
+                viewport_index.remove_representation(model_data['modelRepId'])
+                room_registry.remove_representation(model_data['modelRepId'])
+                slow_consumers.discard(model_data['modelRepId'])
+                self.__broadcast_plain('model_rep_deleted', model_data, self.__connection().room)
             else:
                 emit('error',
                      {'error_type': 'deleteRepresentationError',
@@ -109,104 +155,276 @@ class MainNamespace(Namespace):
     def on_update_model_rep(self, data):
         self.__ensure_client_is_in_room()
         if self.__validate(data, ['_id', 'x', 'y', 'w', 'h']):
-            self.__handle_model_rep_update(model_service.update_model_rep, data)
+            drag_end = data.pop('dragEnd', False)
+            if settings.GEOMETRY_COALESCING and not drag_end:
+                self.__coalesce_model_rep_update(data)
+                return
+            self.__geometry.discard(data['_id'])
+            self.__handle_model_rep_patch(model_service.update_model_rep, data)
 
     def on_add_model_attribute(self, references, attribute):
         self.__ensure_client_is_in_room()
         if self.__validate(references, ['modelId']) \
                 and self.__validate_attribute(attribute):
-            self.__handle_model_update(model_service.add_attribute,
-                                       model_id=references['modelId'],
-                                       user_id=session['user']['_id'],
-                                       attribute=attribute)
+            self.__handle_model_patch(model_service.add_attribute,
+                                      model_id=references['modelId'],
+                                      user_id=self.__connection().user_id,
+                                      attribute=attribute)
 
     def on_remove_model_attribute(self, references):
         self.__ensure_client_is_in_room()
         if self.__validate(references, ['modelId', 'attributeId']):
-            self.__handle_model_update(model_service.remove_attribute,
-                                       model_id=references['modelId'],
-                                       attribute_id=references['attributeId'],
-                                       user_id=session['user']['_id'])
+            self.__handle_model_patch(model_service.remove_attribute,
+                                      model_id=references['modelId'],
+                                      attribute_id=references['attributeId'],
+                                      user_id=self.__connection().user_id)
 
     def on_update_model_attribute(self, references, attribute):
         self.__ensure_client_is_in_room()
         if self.__validate(references, ['modelId']) \
                 and self.__validate_attribute(attribute):
-            self.__handle_model_update(model_service.update_attribute,
-                                       model_id=references['modelId'],
-                                       user_id=session['user']['_id'],
-                                       attribute=attribute)
+            self.__handle_model_patch(model_service.update_attribute,
+                                      model_id=references['modelId'],
+                                      user_id=self.__connection().user_id,
+                                      attribute=attribute)
 
     def on_create_model_relation(self, references, relation):
         self.__ensure_client_is_in_room()
         if self.__validate(references, ['modelId', 'modelRepId']) \
                 and self.__validate(relation, ['target']):
-            self.__handle_model_rep_update(model_service.create_relation,
-                                           model_id=references['modelId'],
-                                           representation_id=references['modelRepId'],
-                                           user_id=session['user']['_id'],
-                                           relation=relation)
+            self.__handle_model_patch(model_service.create_relation,
+                                      model_id=references['modelId'],
+                                      representation_id=references['modelRepId'],
+                                      user_id=self.__connection().user_id,
+                                      relation=relation)
 
     def on_update_model_relation(self, references, relation):
         self.__ensure_client_is_in_room()
         if self.__validate(references, ['modelId']) \
                 and self.__validate(relation, ['_id', 'target']):
-            self.__handle_model_update(model_service.update_relation,
-                                       model_id=references['modelId'],
-                                       user_id=session['user']['_id'],
-                                       relation=relation)
+            self.__handle_model_patch(model_service.update_relation,
+                                      model_id=references['modelId'],
+                                      user_id=self.__connection().user_id,
+                                      relation=relation)
 
     def on_remove_model_relation(self, data):
         self.__ensure_client_is_in_room()
         if self.__validate(data, ['modelId', 'modelRepId', 'relationId', 'deep']):
-            self.__handle_model_rep_update(model_service.delete_relation,
-                                           model_id=data['modelId'],
-                                           representation_id=data['modelRepId'],
-                                           relation_id=data['relationId'],
-                                           deep=data['deep'],
-                                           user_id=session['user']['_id'])
+            self.__handle_model_patch(model_service.delete_relation,
+                                      model_id=data['modelId'],
+                                      representation_id=data['modelRepId'],
+                                      relation_id=data['relationId'],
+                                      deep=data['deep'],
+                                      user_id=self.__connection().user_id)
+
+    def on_batch_ops(self, data):
+        """
+        data is {'ops': [{'event', 'args'}, ...], 'batchId'}, see model_service.apply_batch; the sender gets
+        batch_result with a result per op, the room one batch_applied with the broadcasts of the applied ops
+        """
+        self.__ensure_client_is_in_room()
+        if self.__validate(data, ['ops']):
+            too_large = shared.batch_too_large(data)
+            if too_large is not None:
+                emit('error', too_large)
+                return
+            connection = self.__connection()
+            batch = model_service.apply_batch(data['ops'], room_registry.diagram(connection.room),
+                                              connection.user_id)
+            self.__send('batch_result', {'batchId': data.get('batchId'), 'results': batch.results})
+            for room, ops, resync, rects in shared.batch_broadcasts(batch, connection.room, self.__geometry):
+                self.__broadcast('batch_applied', {'batchId': data.get('batchId'), 'ops': ops, 'resync': resync},
+                                 room, rects)
+
+    def on_set_viewport(self, data):
+        """
+        from then on, geometry and model updates only reach this client when they touch its viewport (plus
+        VIEWPORT_MARGIN); representations it missed while they were out of view are sent as viewport_models
+        """
+        self.__ensure_client_is_in_room()
+        if self.__validate(data, ['x', 'y', 'w', 'h']):
+            entering = shared.entering(request.sid, self.__connection().room, data)
+            if entering:
+                self.__send_representations(entering)
+
+    def on_get_model_reps(self, data):
+        self.__ensure_client_is_in_room()
+        if self.__validate(data, ['ids']):
+            self.__send_representations(data['ids'])
+
+    def on_resync_model(self, data):
+        if self.__validate(data, ['modelId']):
+            model = model_service.get_model(data['modelId'])
+            if model is None:
+                emit('error', {'error_type': 'model_not_found'})
+                return
+            self.__send('model_resynced', {'version': model.version, 'model': model})
+
+    def on_get_model_history(self, data):
+        if self.__validate(data, ['modelId']):
+            page = history_service.get_page(data['modelId'],
+                                            before=data.get('before'),
+                                            limit=min(int(data.get('limit', 50)), settings.HISTORY_PAGE_LIMIT))
+            self.__send('model_history', page)
+
+    def __resume(self, log_id: str, last_seq: int) -> bool:
+        """
+        replays the room broadcasts after last_seq, False when the room log does not reach back that far
+        """
+        room = self.__connection().room
+        missed = shared.missed(self.__connection(), log_id, last_seq)
+        if missed is None:
+            return False
+        if not room_registry.is_loaded(room):
+            # the room's last member left meanwhile, its representations are needed to route model updates
+            shared.loaded(room, model_service.get_full_model_representations_for_diagram(room))
+        for seq, event, payload in missed:
+            emit(event, (payload, seq))
+            last_seq = seq
+        self.__send('diagram_resumed', {'logId': log_id, 'seq': last_seq, 'missed': len(missed)})
+        return True
+
+    def __send_diagram_models(self, diagram_id) -> None:
+        room = self.__connection().room
+        diagram_models = model_service.get_full_model_representations_for_diagram(diagram_id)
+        shared.loaded(room, diagram_models)
+        diagram_models = shared.in_viewport(request.sid, room, diagram_models)
+
+        self.__send('all_diagram_models', diagram_models)
+        self.__send('model_versions', shared.versions(diagram_models))
+
+    def __stream_diagram_models(self, diagram_id) -> None:
+        """
+        diagram_models_chunk events numbered from 0, each with the versions of its models, then diagram_models_done;
+        room broadcasts may arrive in between, their versions tell which side is newer
+        """
+        room = self.__connection().room
+        seq = 0
+        count = 0
+        for chunk in model_service.iter_full_model_representations_for_diagram(diagram_id, settings.JOIN_CHUNK_SIZE):
+            shared.loaded(room, chunk)
+            chunk = shared.in_viewport(request.sid, room, chunk)
+            self.__send('diagram_models_chunk', {'seq': seq, 'models': chunk, 'versions': shared.versions(chunk)})
+            seq += 1
+            count += len(chunk)
+            # lets the chunk go out, and other clients be served, before the next one is read
+            self.socketio.sleep(0)
+        self.__send('diagram_models_done', {'chunks': seq, 'count': count})
+
+    def __send_representations(self, representation_ids: list) -> None:
+        representations = model_service.get_full_model_representations(self.__connection().room, representation_ids)
+        self.__send('viewport_models', {'models': representations, 'versions': shared.versions(representations)})
+
+    def __coalesce_model_rep_update(self, data: dict) -> None:
+        self.__geometry.submit(self.__connection().room, data)
+        diagram_cache.update_geometry(data['_id'], {k: data[k] for k in GEOMETRY_FIELDS})
+        if self.__geometry_task is None:
+            self.__geometry_task = self.socketio.start_background_task(self.__run_geometry_loop)
+
+    def __run_geometry_loop(self) -> None:
+        last_flush = time.monotonic()
+        while True:
+            self.socketio.sleep(1 / settings.GEOMETRY_TICK_RATE)
+            self.__geometry.tick()
+            if time.monotonic() - last_flush >= settings.GEOMETRY_FLUSH_INTERVAL:
+                self.__geometry.flush()
+                last_flush = time.monotonic()
+
+    def __broadcast_geometry(self, room: str, geometries: List[dict]) -> None:
+        self.__broadcast('model_reps_moved', geometries, room, shared.moved_rects(room, geometries))
+
+    def __broadcast(self, event: str, data, room: str, rects: Optional[list] = None) -> None:
+        """
+        see shared.broadcasts
+        """
+        emits, held = shared.broadcasts(self.socketio.server, self.namespace, event, data, room, rects)
+        for members, payload, skip_sid in emits:
+            self.socketio.emit(event, payload, room=members, skip_sid=skip_sid, namespace=self.namespace)
+        if held and self.__release_task is None:
+            self.__release_task = self.socketio.start_background_task(self.__run_release_loop)
+
+    def __run_release_loop(self) -> None:
+        """
+        sends each client that caught up the geometry it was skipped for, merged into one model_reps_moved
+        """
+        while True:
+            self.socketio.sleep(settings.SLOW_CONSUMER_CHECK_INTERVAL)
+            for sid, payload, _ in shared.released(self.socketio.server, self.namespace):
+                self.socketio.emit('model_reps_moved', payload, room=sid, namespace=self.namespace)
+
+    def __broadcast_plain(self, event: str, data: dict, room: str) -> None:
+        room, payload, _ = shared.plain_broadcast(event, data, room)
+        self.socketio.emit(event, payload, room=room, namespace=self.namespace)
+
+    @staticmethod
+    def __send(event: str, data) -> None:
+        emit(event, shared.encode(MainNamespace.__connection(), event, data))
 
     SOType = TypeVar('SOType', bound=SerializableObject)
 
     def __handle_model_add(self, func: Callable[[Any], SOType], *args, **kwargs):
         self.__handle_model_change(func, 'model_added', 'model_error', *args, **kwargs)
 
-    def __handle_model_update(self, func: Callable[[Any], SOType], *args, **kwargs):
-        self.__handle_model_change(func, 'model_updated', 'update_model_error', *args, **kwargs)
+    def __handle_model_patch(self, func: Callable[[Any], dict], *args, **kwargs):
+        patch = func(*args, **kwargs)
+        if patch is None:
+            emit('error', {'error_type': 'update_model_error'})
+            return
+        for room in shared.model_patch_rooms(patch, self.__connection().room):
+            self.__broadcast('model_patched', patch, room, shared.model_rects(patch, room))
 
-    def __handle_model_rep_update(self, func: Callable[[Any], SOType], *args, **kwargs):
-        self.__handle_model_change(func, 'model_rep_updated', 'update_model_error', *args, **kwargs)
+    def __handle_model_rep_patch(self, func: Callable[[Any], dict], *args, **kwargs):
+        self.__handle_patch(func, 'model_rep_patched', 'update_model_error', self.__moved_rects, *args, **kwargs)
 
-    @staticmethod
-    def __handle_model_change(func: Callable[[Any], SOType], success_event: str, error_event: str, *args, **kwargs):
+    def __handle_model_change(self, func: Callable[[Any], SOType], success_event: str, error_event: str,
+                              *args, **kwargs):
         """
         func return value must inherit from SerializableObject
         """
+        room = self.__connection().room
         result = func(*args, **kwargs)
         if result is None:
             emit('error', {'error_type': error_event})
             return
-        emit(success_event, result.as_json(), to=session['room'])
+        shared.loaded(room, [result])
+        self.__broadcast(success_event, result, room, [viewport_index.rect_of(result)])
+
+    def __handle_patch(self, func: Callable[[Any], dict], success_event: str, error_event: str,
+                       affected: Callable[[dict], list], *args, **kwargs):
+        """
+        func must return a delta dict carrying only what changed, and a model version where the model changed;
+        affected returns the rectangles of the representations the patch touches
+        """
+        patch = func(*args, **kwargs)
+        if patch is None:
+            emit('error', {'error_type': error_event})
+            return
+        self.__broadcast(success_event, patch, self.__connection().room, affected(patch))
+
+    @staticmethod
+    def __moved_rects(patch: dict) -> list:
+        return viewport_index.move(MainNamespace.__connection().room, patch['_id'], patch)
+
+    @staticmethod
+    def __connection() -> room_registry.Connection:
+        return room_registry.connection(request.sid)
 
     @staticmethod
     def __ensure_client_is_in_room() -> None:
-        if 'room' not in session or session['room'] is None:
+        if MainNamespace.__connection().room is None:
             raise ConnectionRefusedError('please join a diagram before taking this action!')
 
-    def __validate_attribute(self, to_check: dict) -> bool:
-        if 'kind' not in to_check:
-            emit('error', {'error_type': 'missingParameters', 'message': 'attribute must have `kind` field'})
-            return False
-        if to_check['kind'] == 'field':
-            return self.__validate(to_check, ['kind', 'name', 'type', 'accessModifier'])
-        if to_check['kind'] == 'method':
-            return self.__validate(to_check, ['kind', 'name', 'type', 'accessModifier', 'parameters'])
-        return self.__validate(to_check, ['kind', 'value'])
+    @staticmethod
+    def __validate_attribute(to_check: dict) -> bool:
+        return MainNamespace.__answer(shared.attribute_error(to_check))
 
     @staticmethod
     def __validate(to_check: dict, required_keys: list) -> bool:
-        if all(key in to_check for key in required_keys):
+        return MainNamespace.__answer(shared.validation_error(to_check, required_keys))
+
+    @staticmethod
+    def __answer(error: Optional[dict]) -> bool:
+        if error is None:
             return True
-        emit('error',
-             {'error_type': 'missingParameters', 'message': [i for i in required_keys if i not in list(to_check)]})
+        emit('error', error)
         return False
@@ -0,0 +1,287 @@
+"""
+The parts of the socket events MainNamespace (gevent) and AsyncMainNamespace (asyncio) share. Nothing here
+emits: it keeps the room state and says what to send, the namespaces send it their own way.
+"""
+from typing import Any, List, Optional, Tuple
+
+from bpr_data.models.diagram import Diagram
+from bpr_data.models.model import FullModelRepresentation
+
+import settings
+from src.services import diagram_cache, model_service, rate_limiter, room_log, room_registry, slow_consumers, \
+    viewport_index
+from src.services.geometry_coalescer import GeometryCoalescer
+from src.util import metrics, serialization
+
+# (room, the emitted data, sids to skip) of one emit
+Emit = Tuple[str, Any, Optional[list]]
+
+
+def event_label(namespace, event: str) -> str:
+    """
+    the event name to key metrics, rate limits and traces by: clients choose event names, so all those without
+    an on_<event> handler share 'unknown' rather than each adding a series
+    """
+    return event if hasattr(namespace, f'on_{event}') else 'unknown'
+
+
+def validation_error(to_check: dict, required_keys: list) -> Optional[dict]:
+    """
+    the error to answer with when to_check lacks any of required_keys
+    """
+    if all(key in to_check for key in required_keys):
+        return None
+    return {'error_type': 'missingParameters', 'message': [i for i in required_keys if i not in list(to_check)]}
+
+
+def attribute_error(to_check: dict) -> Optional[dict]:
+    if 'kind' not in to_check:
+        return {'error_type': 'missingParameters', 'message': 'attribute must have `kind` field'}
+    if to_check['kind'] == 'field':
+        return validation_error(to_check, ['kind', 'name', 'type', 'accessModifier'])
+    if to_check['kind'] == 'method':
+        return validation_error(to_check, ['kind', 'name', 'type', 'accessModifier', 'parameters'])
+    return validation_error(to_check, ['kind', 'value'])
+
+
+def connect(sid: str, user, requested_format: Optional[str],
+            requested_compression: Optional[str]) -> room_registry.Connection:
+    return room_registry.connect(sid, user, serialization.negotiate(requested_format, requested_compression))
+
+
+def disconnect(sid: str) -> Optional[room_registry.Connection]:
+    """
+    forgets the client, returns its connection so the namespace can tell its room it left
+    """
+    connection = room_registry.disconnect(sid)
+    rate_limiter.forget(sid)
+    slow_consumers.forget(sid)
+    if connection is not None and connection.room:
+        diagram_cache.remove_member(connection.room)
+        viewport_index.leave(connection.room, sid)
+    return connection
+
+
+def join(diagram: Diagram, sid: str) -> Tuple[str, Optional[str]]:
+    """
+    moves the client from the room it is in to the diagram's, returns that room and the one it left, which the
+    namespace takes the client's sockets out of and tells
+    """
+    previous = room_registry.connection(sid).room
+    if previous:
+        leave(previous, sid)
+    room = room_registry.join(diagram, sid)
+    diagram_cache.add_member(room)
+    viewport_index.join(room, sid)
+    return room, previous
+
+
+def leave(room: str, sid: str) -> None:
+    diagram_cache.remove_member(room)
+    viewport_index.leave(room, sid)
+    room_registry.leave(room, sid)
+    slow_consumers.forget(sid)
+
+
+def format_room(room: str, connection: room_registry.Connection) -> str:
+    # every member is also in <room>/<format>, where broadcasts encoded in its format go
+    return f'{room}/{connection.format}'
+
+
+def loaded(room: str, representations: List[FullModelRepresentation]) -> None:
+    """
+    records representations sent to the room, which route model updates and viewports from then on
+    """
+    viewport_index.index(room, representations)
+    room_registry.add_representations(room, representations)
+
+
+def in_viewport(sid: str, room: str, representations: List[FullModelRepresentation]) -> List[FullModelRepresentation]:
+    visible = viewport_index.visible(room, viewport_index.viewport(room, sid))
+    if visible is None:
+        return representations
+    return [r for r in representations if str(r.id) in visible]
+
+
+def entering(sid: str, room: str, viewport: dict) -> List[str]:
+    """
+    sets the client's viewport, returns the representations that came into it
+    """
+    previous = viewport_index.set_viewport(room, sid, viewport)
+    if previous is None:
+        return []
+    visible = viewport_index.visible(room, viewport_index.viewport(room, sid))
+    return list(visible - viewport_index.visible(room, previous))
+
+
+def versions(representations: List[FullModelRepresentation]) -> dict:
+    return {str(r.modelId): getattr(r.model, 'version', 0) for r in representations}
+
+
+def presence(connection: room_registry.Connection) -> dict:
+    return {'id': connection.user_id, 'name': connection.name}
+
+
+def last_seq(data: dict) -> Optional[int]:
+    """
+    the lastSeq a join resumes after, None when there is none or it is not a sequence number, which loads in full
+    """
+    try:
+        seq = int(data['lastSeq'])
+    except (KeyError, TypeError, ValueError, OverflowError):
+        return None
+    return seq if seq >= 0 and not isinstance(data['lastSeq'], (bool, float)) else None
+
+
+def missed(connection: room_registry.Connection, log_id: str,
+           last_seq: int) -> Optional[List[Tuple[int, str, Any]]]:
+    """
+    (seq, event, payload in the client's format) of the room broadcasts after last_seq, None when the room log
+    does not reach back that far
+    """
+    broadcasts = room_log.since(connection.room, log_id, last_seq)
+    if broadcasts is None:
+        return None
+    return [(seq, event, payloads.get(connection.format, next(iter(payloads.values()))))
+            for seq, event, payloads in broadcasts]
+
+
+def encode(connection: room_registry.Connection, event: str, data) -> Any:
+    """
+    data for the one client, in its format
+    """
+    payload = serialization.encode(data, connection.format)
+    metrics.payload(event, payload)
+    return payload
+
+
+def broadcasts(server, namespace: str, event: str, data, room: str, rects: list = None) -> Tuple[List[Emit], bool]:
+    """
+    the emits of a room broadcast, data encoded once per payload format for the members that asked for it,
+    compressed formats deflating that one encoding; with rects, members whose viewport misses all of them are
+    skipped. Also whether lagging members were held geometry instead, which the release loop sends them later
+    """
+    skip_sid = viewport_index.outside(room, rects) if rects else []
+    payloads = serialization.encode_all(data)
+    # state changes go out as (payload, seq), see room_log
+    seq = room_log.append(room, event, payloads) if event in room_log.LOGGED_EVENTS else None
+    emits = []
+    held = False
+    for payload_format, payload in payloads.items():
+        members = f'{room}/{payload_format}'
+        skipped = skip_sid
+        if event in slow_consumers.VOLATILE_EVENTS:
+            lagging = __lagging(server, namespace, members, skip_sid)
+            for sid in lagging:
+                slow_consumers.hold(sid, room, data if isinstance(data, list) else [data], seq)
+            held = held or bool(lagging)
+            skipped = skip_sid + lagging
+        metrics.payload(event, payload)
+        emits.append((members, payload if seq is None else (payload, seq), skipped or None))
+    return emits, held
+
+
+def plain_broadcast(event: str, data: dict, room: str) -> Emit:
+    # the same dict for every payload format
+    seq = room_log.append(room, event, {f: data for f in serialization.enabled_formats()})
+    return room, (data, seq), None
+
+
+def released(server, namespace: str) -> List[Emit]:
+    """
+    a model_reps_moved per client that caught up, with the geometry it was skipped for merged
+    """
+    emits = []
+    for sid, room, geometries, seq in slow_consumers.release(lambda s: __caught_up(server, namespace, s)):
+        connection = room_registry.connection(sid)
+        if connection is None or connection.room != room or not geometries:
+            continue
+        payload = serialization.encode(geometries, connection.format)
+        metrics.payload('model_reps_moved', payload)
+        emits.append((sid, payload if seq is None else (payload, seq), None))
+    return emits
+
+
+def moved_rects(room: str, geometries: List[dict]) -> list:
+    return [r for g in geometries for r in viewport_index.move(room, g['_id'], g)]
+
+
+def model_patch_rooms(patch: dict, room: str) -> List[str]:
+    """
+    a model can be shown in several diagrams, the patch goes to every active room showing it
+    """
+    rooms = room_registry.rooms_for_model(patch['modelId'])
+    if room not in rooms:
+        rooms.append(room)
+    return rooms
+
+
+def model_rects(patch: dict, room: str) -> list:
+    # a relation is drawn between both ends
+    model_ids = [patch['modelId']]
+    item = patch.get('item')
+    if isinstance(item, dict) and item.get('target'):
+        model_ids.append(item['target'])
+    return viewport_index.model_rects(room, model_ids)
+
+
+def batch_broadcasts(batch: model_service.BatchResult, room: str, geometry: GeometryCoalescer) -> list:
+    """
+    (room, ops, resync, rects) per room to tell: the sender's room gets every applied op, other rooms showing
+    a patched model get its model_patched ops; rects is None when some op's rectangles are unknown
+    """
+    loaded(room, [data for event, data in batch.applied if event == 'model_added'])
+    rects = []
+    unknown = False
+    for event, data in batch.applied:
+        if event == 'model_rep_patched':
+            geometry.discard(data['_id'])
+            rects.extend(viewport_index.move(room, data['_id'], data))
+        elif event == 'model_added':
+            rects.append(viewport_index.rect_of(data))
+        else:
+            patch_rects = model_rects(data, room)
+            unknown = unknown or not patch_rects
+            rects.extend(patch_rects)
+    result = []
+    if batch.applied or batch.resync:
+        result.append((room, [{'event': e, 'data': d} for e, d in batch.applied], batch.resync,
+                       None if unknown else rects))
+
+    others = {}
+    for event, data in batch.applied:
+        if event == 'model_patched':
+            for other in room_registry.rooms_for_model(data['modelId']):
+                if other != room:
+                    others.setdefault(other, []).append(data)
+    for other, patches in others.items():
+        resync = [m for m in batch.resync if other in room_registry.rooms_for_model(m)]
+        other_rects = [r for p in patches for r in model_rects(p, other)]
+        result.append((other, [{'event': 'model_patched', 'data': p} for p in patches], resync, other_rects or None))
+    return result
+
+
+def batch_too_large(data: dict) -> Optional[dict]:
+    if len(data['ops']) > settings.BATCH_MAX_OPS:
+        return {'error_type': 'batchTooLarge', 'message': f'at most {settings.BATCH_MAX_OPS} ops'}
+    return None
+
+
+def __lagging(server, namespace: str, room: str, skip_sid: list) -> list:
+    """
+    members of the room connected to this worker with more than SLOW_CONSUMER_QUEUE packets waiting to go out
+    """
+    if settings.SLOW_CONSUMER_QUEUE <= 0 or namespace not in server.manager.rooms:
+        return []
+    sockets = server.eio.sockets
+    lagging = []
+    for sid, eio_sid in server.manager.get_participants(namespace, room):
+        socket = sockets.get(eio_sid)
+        if sid not in skip_sid and socket is not None and socket.queue.qsize() > settings.SLOW_CONSUMER_QUEUE:
+            lagging.append(sid)
+    return lagging
+
+
+def __caught_up(server, namespace: str, sid: str) -> bool:
+    socket = server.eio.sockets.get(server.manager.eio_sid_from_sid(sid, namespace))
+    return socket is None or socket.queue.qsize() <= settings.SLOW_CONSUMER_QUEUE // 2
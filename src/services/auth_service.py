@@ -0,0 +1,202 @@
+from __future__ import annotations
+
+import asyncio
+import copy
+import time
+from collections import OrderedDict
+from threading import Event, Lock
+from typing import Dict, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import settings
+from src.util import metrics
+from src.util.exceptions import AuthenticationException
+
+try:
+    import aiohttp
+except ImportError:  # pragma: no cover
+    aiohttp = None
+
+_session = requests.Session()
+_session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=settings.AUTH_POOL_SIZE))
+_session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=settings.AUTH_POOL_SIZE))
+
+_lock = Lock()
+# Authorization header -> (expires_at, user document), least recently used first
+_cache: OrderedDict[str, Tuple[float, dict]] = OrderedDict()
+_in_flight: Dict[str, '_Call'] = {}
+# the asyncio server's calls to the REST service, awaited by every connection presenting the same header
+_async_in_flight: Dict[str, asyncio.Future] = {}
+_async_session: Optional['aiohttp.ClientSession'] = None
+_hits = 0
+_misses = 0
+_upstream_calls = 0
+_upstream_seconds = 0.0
+_upstream_max_seconds = 0.0
+
+
+class _Call:
+    __slots__ = ('done', 'user', 'error')
+
+    def __init__(self):
+        self.done = Event()
+        self.user = None
+        self.error = None
+
+
+def authenticate(authorization: str) -> dict:
+    """
+    returns the user document the REST service resolves the Authorization header to,
+    raises AuthenticationException when it does not accept it
+    """
+    with _lock:
+        cached = __cached(authorization)
+        if cached is not None:
+            return cached
+        call = _in_flight.get(authorization)
+        leader = call is None
+        if leader:
+            call = _in_flight[authorization] = _Call()
+
+    if leader:
+        try:
+            call.user = __fetch_user(authorization)
+        except Exception as e:
+            call.error = e
+        finally:
+            with _lock:
+                del _in_flight[authorization]
+                if call.user is not None:
+                    __store(authorization, call.user)
+            call.done.set()
+    else:
+        call.done.wait()
+
+    if call.error is not None:
+        raise call.error
+    return copy.deepcopy(call.user)
+
+
+async def authenticate_async(authorization: str) -> dict:
+    """
+    authenticate for the asyncio server, sharing the cache; raises AuthenticationException like it,
+    aiohttp.ClientError or asyncio.TimeoutError when the REST service cannot be reached
+    """
+    with _lock:
+        cached = __cached(authorization)
+    if cached is not None:
+        return cached
+    call = _async_in_flight.get(authorization)
+    if call is None:
+        call = _async_in_flight[authorization] = asyncio.ensure_future(__fetch_user_async(authorization))
+        call.add_done_callback(lambda _: _async_in_flight.pop(authorization, None))
+    # a connection going away does not cancel the call the others are waiting for
+    return copy.deepcopy(await asyncio.shield(call))
+
+
+def warm_up() -> None:
+    """
+    opens a pooled connection to the REST service, so the first connect does not pay for the handshake;
+    any response will do, raises requests.RequestException when it cannot be reached
+    """
+    _session.head(settings.REST_DOMAIN, timeout=settings.AUTH_TIMEOUT).close()
+
+
+async def warm_up_async() -> None:
+    """
+    warm_up for the asyncio server's client, raises aiohttp.ClientError or asyncio.TimeoutError
+    """
+    async with __async_session().head(settings.REST_DOMAIN):
+        pass
+
+
+async def close_async() -> None:
+    global _async_session
+    if _async_session is not None:
+        await _async_session.close()
+        _async_session = None
+
+
+def stats() -> dict:
+    with _lock:
+        return {
+            'cached': len(_cache),
+            'hits': _hits,
+            'misses': _misses,
+            'hit_rate': _hits / (_hits + _misses) if _hits + _misses else 0.0,
+            'upstream_calls': _upstream_calls,
+            'upstream_avg_seconds': _upstream_seconds / _upstream_calls if _upstream_calls else 0.0,
+            'upstream_max_seconds': _upstream_max_seconds
+        }
+
+
+def __cached(authorization: str) -> Optional[dict]:
+    # under _lock
+    global _hits, _misses
+    cached = _cache.get(authorization)
+    if cached is not None and cached[0] > time.monotonic():
+        _cache.move_to_end(authorization)
+        _hits += 1
+        return copy.deepcopy(cached[1])
+    _misses += 1
+    return None
+
+
+def __fetch_user(authorization: str) -> dict:
+    started = time.perf_counter()
+    try:
+        response = _session.post(f'{settings.REST_DOMAIN}/users', headers={'Authorization': authorization},
+                                 timeout=settings.AUTH_TIMEOUT)
+    finally:
+        __record_upstream(time.perf_counter() - started)
+    if response.status_code != 200:
+        raise AuthenticationException(response.status_code)
+    return response.json()
+
+
+async def __fetch_user_async(authorization: str) -> dict:
+    started = time.perf_counter()
+    try:
+        async with __async_session().post(f'{settings.REST_DOMAIN}/users',
+                                          headers={'Authorization': authorization}) as response:
+            if response.status != 200:
+                raise AuthenticationException(response.status)
+            user = await response.json(content_type=None)
+    finally:
+        __record_upstream(time.perf_counter() - started)
+    with _lock:
+        __store(authorization, user)
+    return user
+
+
+def __async_session() -> 'aiohttp.ClientSession':
+    global _async_session
+    if _async_session is None:
+        _async_session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=settings.AUTH_TIMEOUT),
+            connector=aiohttp.TCPConnector(limit=settings.AUTH_POOL_SIZE))
+    return _async_session
+
+
+def __record_upstream(elapsed: float) -> None:
+    global _upstream_calls, _upstream_seconds, _upstream_max_seconds
+    metrics.observe('auth_upstream_seconds', elapsed)
+    with _lock:
+        _upstream_calls += 1
+        _upstream_seconds += elapsed
+        _upstream_max_seconds = max(_upstream_max_seconds, elapsed)
+
+
+def __store(authorization: str, user: dict) -> None:
+    if settings.AUTH_CACHE_SIZE <= 0:
+        return
+    _cache[authorization] = (time.monotonic() + settings.AUTH_CACHE_TTL, user)
+    _cache.move_to_end(authorization)
+    while len(_cache) > settings.AUTH_CACHE_SIZE:
+        _cache.popitem(last=False)
+
+
+metrics.collect('auth_cache_hits_total', lambda: {(): _hits}, 'Connections authorized from the token cache', 'counter')
+metrics.collect('auth_cache_misses_total', lambda: {(): _misses}, 'Connections that needed the REST service', 'counter')
@@ -0,0 +1,70 @@
+from __future__ import annotations
+
+from typing import List, Optional, Union
+
+from bpr_data.repository import Collection
+from bson import ObjectId
+
+from src.services import history_service, snapshot_service
+from src.util import mongo
+
+# TODO: Move to data module
+MongoId = Union[ObjectId, str]
+
+# delete cascade is partially handled in triggers, but we are at the limit for free tier, so it is done here,
+# with a constant number of round trips no matter how many diagrams or representations are affected
+
+
+def delete_model(model_id: MongoId) -> Optional[List[str]]:
+    """
+    deletes the model, its history, its representations, their entries in diagram.models and any relation
+    representation pointing at one of its relations; returns the ids of the affected diagrams, None if the model
+    did not exist
+    """
+    model = mongo.get_collection(Collection.MODEL).find_one_and_delete({'_id': ObjectId(model_id)},
+                                                                       projection={'relations._id': 1})
+    if model is None:
+        return None
+    history_service.delete_for_model(model_id)
+
+    representations = list(mongo.get_collection(Collection.MODEL_REPRESENTATION)
+                           .find({'modelId': ObjectId(model_id)}, projection={'diagramId': 1}))
+    rep_ids = [r['_id'] for r in representations]
+    relation_ids = [r['_id'] for r in model.get('relations', [])]
+
+    if rep_ids:
+        __pull_from_diagrams(rep_ids)
+        mongo.get_collection(Collection.MODEL_REPRESENTATION).delete_many({'_id': {'$in': rep_ids}})
+    snapshot_changes = snapshot_service.model_removed(model_id, rep_ids)
+    if relation_ids:
+        query = {'relations.relationId': {'$in': relation_ids}}
+        if snapshot_service.enabled():
+            # snapshots are updated by representation id, so the representations are read first
+            pointing = [r['_id'] for r in
+                        mongo.get_collection(Collection.MODEL_REPRESENTATION).find(query, projection={'_id': 1})]
+            snapshot_changes += snapshot_service.relation_representations_removed(pointing, relation_ids)
+            query = {'_id': {'$in': pointing}}
+        mongo.get_collection(Collection.MODEL_REPRESENTATION).update_many(
+            query, {'$pull': {'relations': {'relationId': {'$in': relation_ids}}}})
+    snapshot_service.write(snapshot_changes)
+
+    return list({str(r['diagramId']) for r in representations})
+
+
+def delete_model_rep(representation_id: MongoId) -> Optional[List[str]]:
+    """
+    returns the ids of the affected diagrams, None if the representation did not exist
+    """
+    representation = mongo.get_collection(Collection.MODEL_REPRESENTATION).find_one_and_delete(
+        {'_id': ObjectId(representation_id)}, projection={'diagramId': 1})
+    if representation is None:
+        return None
+
+    __pull_from_diagrams([representation['_id']])
+    snapshot_service.write(snapshot_service.representation_removed(representation['_id']))
+    return [str(representation['diagramId'])]
+
+
+def __pull_from_diagrams(rep_ids: List[ObjectId]) -> None:
+    mongo.get_collection(Collection.DIAGRAM).update_many({'models': {'$in': rep_ids}},
+                                                         {'$pullAll': {'models': rep_ids}})
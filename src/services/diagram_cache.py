@@ -0,0 +1,314 @@
+from __future__ import annotations
+
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
+
+from bpr_data.models.model import FullModelRepresentation, Model
+from bson import ObjectId
+
+import settings
+from src.util import metrics
+
+# TODO: Move to data module
+MongoId = Union[ObjectId, str]
+
+
+class _RoomState:
+    __slots__ = ('representations', 'last_access')
+
+    def __init__(self, representations: List[FullModelRepresentation]):
+        self.representations: Dict[str, FullModelRepresentation] = {str(r.id): r for r in representations}
+        self.last_access = time.monotonic()
+
+
+_lock = Lock()
+_rooms: Dict[str, _RoomState] = {}
+# model id -> (room, representation id) of every cached representation showing it, kept by __add/__drop
+_by_model: Dict[str, Set[Tuple[str, str]]] = {}
+_members: Dict[str, int] = {}
+# bumped on every write-through; each diagram, representation and model id a write-through touched maps to the
+# generation and time of that, so a join that raced a mutation of what it read does not cache a stale snapshot,
+# while joins of other diagrams still do
+_generation = 0
+_touched: OrderedDict[str, Tuple[int, float]] = OrderedDict()
+# ids are forgotten after this many seconds, a join that took longer is not cached
+_TOUCHED_SECONDS = 60.0
+_forgotten = 0
+_hits = 0
+_misses = 0
+
+
+def generation() -> int:
+    """
+    read before querying what is later passed to put() or changed_since()
+    """
+    return _generation
+
+
+def changed_since(loaded_at_generation: int, ids: Iterable[MongoId]) -> bool:
+    """
+    whether a write-through touched any of the diagram, representation or model ids after loaded_at_generation
+    """
+    with _lock:
+        return __changed_since(loaded_at_generation, ids)
+
+
+def get(diagram_id: MongoId) -> Optional[List[FullModelRepresentation]]:
+    global _hits, _misses
+    key = str(diagram_id)
+    with _lock:
+        __evict_idle()
+        state = _rooms.get(key)
+        if state is None:
+            _misses += 1
+            return None
+        _hits += 1
+        state.last_access = time.monotonic()
+        return list(state.representations.values())
+
+
+def put(diagram_id: MongoId, representations: List[FullModelRepresentation], loaded_at_generation: int) -> None:
+    """
+    loaded_at_generation must be read with generation() before the representations were queried
+    """
+    key = str(diagram_id)
+    ids = [key] + [r.id for r in representations] + [r.modelId for r in representations]
+    with _lock:
+        if settings.DIAGRAM_CACHE_TTL <= 0 or __changed_since(loaded_at_generation, ids):
+            return
+        __drop_room(key)
+        _rooms[key] = _RoomState(representations)
+        for representation in representations:
+            __index(key, representation)
+
+
+def add_member(diagram_id: MongoId) -> None:
+    key = str(diagram_id)
+    with _lock:
+        _members[key] = _members.get(key, 0) + 1
+
+
+def remove_member(diagram_id: MongoId) -> None:
+    key = str(diagram_id)
+    with _lock:
+        remaining = _members.get(key, 0) - 1
+        if remaining > 0:
+            _members[key] = remaining
+            return
+        _members.pop(key, None)
+        __drop_room(key)
+
+
+def evict(diagram_id: MongoId) -> None:
+    with _lock:
+        __touch(diagram_id)
+        __drop_room(str(diagram_id))
+
+
+def upsert_representation(representation: FullModelRepresentation) -> None:
+    with _lock:
+        __touch(representation.diagramId, representation.id, representation.modelId)
+        if str(representation.diagramId) in _rooms:
+            __add(str(representation.diagramId), representation)
+        if representation.model is not None:
+            __set_model(representation.model)
+
+
+def has_representation(representation_id: MongoId) -> bool:
+    key = str(representation_id)
+    with _lock:
+        return any(key in state.representations for state in _rooms.values())
+
+
+def get_model(model_id: MongoId) -> Optional[Model]:
+    with _lock:
+        for rep in __representations_of(model_id):
+            if rep.model is not None:
+                return rep.model
+
+
+def next_version(model_id: MongoId) -> Optional[int]:
+    """
+    claims the model's next version on every cached copy, None when no room has the model
+    """
+    with _lock:
+        models = {id(rep.model): rep.model for rep in __representations_of(model_id) if rep.model is not None}
+        if not models:
+            return None
+        version = max(getattr(m, 'version', 0) for m in models.values()) + 1
+        for model in models.values():
+            model.version = version
+        return version
+
+
+def update_geometry(representation_id: MongoId, geometry: dict) -> None:
+    key = str(representation_id)
+    with _lock:
+        __touch(key)
+        for state in _rooms.values():
+            rep = state.representations.get(key)
+            if rep is not None:
+                for field, value in geometry.items():
+                    setattr(rep, field, value)
+
+
+def apply_model_patch(patch: dict, only_newer: bool = False) -> None:
+    """
+    patch is a model_patched delta as returned by the model_service mutations; with only_newer, models already at
+    the patch's version or past it are left alone, for patches another worker broadcast to every room of the model
+    """
+    model_key = str(patch['modelId'])
+    with _lock:
+        __touch(model_key, *([patch['representationId']] if patch.get('representationId') else []))
+        models = {}
+        for rep in __representations_of(model_key):
+            if only_newer and 'version' in patch and getattr(rep.model, 'version', 0) >= patch['version']:
+                continue
+            models[id(rep.model)] = rep.model
+            if str(rep.id) == str(patch.get('representationId')):
+                __patch_representation(rep, patch)
+        for model in models.values():
+            __patch_model(model, patch)
+
+
+def remove_representation(representation_id: MongoId) -> None:
+    key = str(representation_id)
+    with _lock:
+        __touch(key)
+        for room in list(_rooms):
+            __remove(room, key)
+
+
+def remove_model(model_id: MongoId) -> None:
+    key = str(model_id)
+    with _lock:
+        __touch(key)
+        for room, rep_id in list(_by_model.get(key, ())):
+            __remove(room, rep_id)
+
+
+def evict_model(model_id: MongoId) -> None:
+    """
+    drops every cached room showing the model, for when its cached state can no longer be trusted
+    """
+    with _lock:
+        for room in {room for room, _ in _by_model.get(str(model_id), ())}:
+            __drop_room(room)
+
+
+def members() -> Dict[str, int]:
+    with _lock:
+        return dict(_members)
+
+
+def stats() -> dict:
+    with _lock:
+        return {
+            'rooms': len(_rooms),
+            'hits': _hits,
+            'misses': _misses,
+            'hit_rate': _hits / (_hits + _misses) if _hits + _misses else 0.0
+        }
+
+
+def __set_model(model: Model) -> None:
+    for rep in __representations_of(model.id):
+        rep.model = model
+
+
+def __representations_of(model_id: MongoId) -> List[FullModelRepresentation]:
+    return [_rooms[room].representations[rep_id] for room, rep_id in _by_model.get(str(model_id), ())]
+
+
+def __add(room: str, representation: FullModelRepresentation) -> None:
+    __remove(room, str(representation.id))
+    _rooms[room].representations[str(representation.id)] = representation
+    __index(room, representation)
+
+
+def __remove(room: str, representation_id: str) -> None:
+    representation = _rooms[room].representations.pop(representation_id, None)
+    if representation is not None:
+        __unindex(room, representation)
+
+
+def __drop_room(room: str) -> None:
+    state = _rooms.pop(room, None)
+    for representation in state.representations.values() if state is not None else []:
+        __unindex(room, representation)
+
+
+def __index(room: str, representation: FullModelRepresentation) -> None:
+    _by_model.setdefault(str(representation.modelId), set()).add((room, str(representation.id)))
+
+
+def __unindex(room: str, representation: FullModelRepresentation) -> None:
+    showing = _by_model.get(str(representation.modelId), set())
+    showing.discard((room, str(representation.id)))
+    if not showing:
+        _by_model.pop(str(representation.modelId), None)
+
+
+def __patch_model(model: Model, patch: dict) -> None:
+    op = patch['op']
+    if 'version' in patch:
+        model.version = patch['version']
+    if op == 'attribute_added':
+        model.attributes.append(patch['item'])
+    elif op == 'attribute_removed':
+        model.attributes = [a for a in model.attributes if str(a['_id']) != str(patch['itemId'])]
+    elif op == 'attribute_updated':
+        model.attributes = [patch['item'] if str(a['_id']) == str(patch['item']['_id']) else a
+                            for a in model.attributes]
+    elif op == 'relation_added':
+        model.relations.append(patch['item'])
+    elif op == 'relation_updated':
+        model.relations = [patch['item'] if str(r['_id']) == str(patch['item']['_id']) else r
+                           for r in model.relations]
+    elif op == 'relation_removed' and patch['deep']:
+        model.relations = [r for r in model.relations if str(r['_id']) != str(patch['itemId'])]
+
+
+def __patch_representation(rep: FullModelRepresentation, patch: dict) -> None:
+    if patch['op'] == 'relation_added':
+        rep.relations = rep.relations + [patch['relationRepresentation']]
+    elif patch['op'] == 'relation_removed':
+        rep.relations = [r for r in rep.relations if str(r['relationId']) != str(patch['itemId'])]
+
+
+def __touch(*ids: MongoId) -> None:
+    global _generation, _forgotten
+    _generation += 1
+    now = time.monotonic()
+    for key in ids:
+        _touched[str(key)] = (_generation, now)
+        _touched.move_to_end(str(key))
+    while _touched:
+        key, (touched_at, at) = next(iter(_touched.items()))
+        if at >= now - _TOUCHED_SECONDS:
+            break
+        del _touched[key]
+        _forgotten = touched_at
+
+
+def __changed_since(loaded_at_generation: int, ids: Iterable[MongoId]) -> bool:
+    if loaded_at_generation < _forgotten:
+        return True
+    return any(_touched.get(str(key), (0, 0.0))[0] > loaded_at_generation for key in ids)
+
+
+def __evict_idle() -> None:
+    # rooms with members are dropped by remove_member when the last one leaves, write-throughs do not refresh
+    # last_access, so only rooms nobody is in expire
+    deadline = time.monotonic() - settings.DIAGRAM_CACHE_TTL
+    for key in [k for k, s in _rooms.items() if s.last_access < deadline and not _members.get(k)]:
+        __drop_room(key)
+
+
+metrics.collect('socket_rooms_active', lambda: {(): len(_members)}, 'Diagram rooms with at least one member')
+metrics.collect('socket_room_connections', lambda: {(('room', k),): v for k, v in members().items()},
+                'Members per diagram room')
+metrics.collect('diagram_cache_hits_total', lambda: {(): _hits}, 'Joins served from the room cache', 'counter')
+metrics.collect('diagram_cache_misses_total', lambda: {(): _misses}, 'Joins that ran the diagram join', 'counter')
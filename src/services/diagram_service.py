@@ -3,25 +3,43 @@ from __future__ import annotations
 from typing import List, Union
 
 from bpr_data.models.model import ModelRepresentation
-from bpr_data.repository import Repository, Collection
+from bpr_data.repository import Collection
 from bpr_data.models.diagram import Diagram
 from bson import ObjectId
 
-import settings
+from src.services import history_service
+from src.util import mongo
 
 # TODO: Move to data module
 MongoId = Union[ObjectId, str]
 
-db = Repository.get_instance(**settings.MONGO_CONN)
+# history entries read to find the most recently edited diagrams
+RECENT_ACTIVITY_SCAN = 2000
 
 
 def get_diagram(diagram_id: MongoId) -> Diagram:
-    diagram = db.find_one(Collection.DIAGRAM, id=diagram_id)
+    diagram = mongo.get_repository().find_one(Collection.DIAGRAM, id=diagram_id)
     if diagram is not None:
         return Diagram.from_dict(diagram)
 
 
 def get_diagrams_for_model(model_id: MongoId) -> List[Diagram]:
+    db = mongo.get_repository()
     representation_ids = \
         [r.id for r in db.find(Collection.MODEL_REPRESENTATION, ModelRepresentation, modelId=ObjectId(model_id))]
     return db.find(Collection.DIAGRAM, Diagram, models={'$in': representation_ids})
+
+
+def get_recently_active_diagram_ids(limit: int) -> List[str]:
+    """
+    the diagrams showing the most recently edited models, most recent first
+    """
+    model_ids = history_service.get_recent_model_ids(RECENT_ACTIVITY_SCAN)
+    rank = {model_id: i for i, model_id in enumerate(model_ids)}
+    representations = mongo.get_collection(Collection.MODEL_REPRESENTATION) \
+        .find({'modelId': {'$in': model_ids}}, projection={'modelId': 1, 'diagramId': 1})
+    last_edited = {}
+    for representation in representations:
+        diagram_id = str(representation['diagramId'])
+        last_edited[diagram_id] = min(last_edited.get(diagram_id, len(rank)), rank[representation['modelId']])
+    return sorted(last_edited, key=last_edited.get)[:limit]
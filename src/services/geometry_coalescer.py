@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+import time
+from threading import Lock
+from typing import Callable, Dict, List, Any
+
+GEOMETRY_FIELDS = ('x', 'y', 'w', 'h')
+# stored with the geometry, a write carrying an older one than the representation has is dropped
+GEOMETRY_SEQ = 'geometrySeq'
+
+_seq_lock = Lock()
+_last_seq = 0
+
+
+def next_seq() -> int:
+    """
+    nanoseconds since the epoch, strictly increasing within the process; writes of other workers order by their clocks
+    """
+    global _last_seq
+    with _seq_lock:
+        _last_seq = max(_last_seq + 1, time.time_ns())
+        return _last_seq
+
+
+class GeometryCoalescer:
+    """
+    Merges rapid update_model_rep traffic per representation id, latest update wins.
+    tick() hands the merged geometry of each room to `broadcast`, flush() hands every
+    dirty representation to `persist` once, no matter how many updates it received, all in one list.
+    Each carries the GEOMETRY_SEQ of its latest update, so persist can skip what a later write replaced.
+    """
+
+    def __init__(self, persist: Callable[[List[dict]], Any], broadcast: Callable[[str, List[dict]], Any]):
+        self.__persist = persist
+        self.__broadcast = broadcast
+        self.__lock = Lock()
+        self.__to_broadcast: Dict[str, Dict[str, dict]] = {}
+        self.__to_persist: Dict[str, dict] = {}
+
+    def submit(self, room: str, data: dict) -> None:
+        rep_id = str(data['_id'])
+        with self.__lock:
+            self.__to_persist.setdefault(rep_id, {}).update(data, **{GEOMETRY_SEQ: next_seq()})
+            self.__to_broadcast.setdefault(room, {})[rep_id] = \
+                {'_id': rep_id, **{k: data[k] for k in GEOMETRY_FIELDS}}
+
+    def discard(self, representation_id: str) -> None:
+        rep_id = str(representation_id)
+        with self.__lock:
+            self.__to_persist.pop(rep_id, None)
+            for pending in self.__to_broadcast.values():
+                pending.pop(rep_id, None)
+
+    def pending_writes(self) -> int:
+        return len(self.__to_persist)
+
+    def tick(self) -> None:
+        with self.__lock:
+            to_broadcast, self.__to_broadcast = self.__to_broadcast, {}
+        for room, geometries in to_broadcast.items():
+            if geometries:
+                self.__broadcast(room, list(geometries.values()))
+
+    def flush(self) -> None:
+        with self.__lock:
+            to_persist, self.__to_persist = self.__to_persist, {}
+        if not to_persist:
+            return
+        try:
+            self.__persist(list(to_persist.values()))
+        except Exception as e:
+            print(f'Could not persist geometry of {len(to_persist)} representations: {e!r}', flush=True)
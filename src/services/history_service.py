@@ -0,0 +1,135 @@
+from __future__ import annotations
+
+import hashlib
+from typing import List, Optional, Tuple, Union
+
+from bpr_data.models.model import HistoryActionType
+from bpr_data.repository import Collection
+from bson import ObjectId
+from pymongo import DESCENDING, UpdateOne
+from pymongo.errors import PyMongoError
+
+from src.services import write_behind
+from src.util import metrics, mongo
+
+# TODO: Move to data module
+MongoId = Union[ObjectId, str]
+
+# append-only, one document per action, so model documents stop growing with every edit
+HISTORY_COLLECTION = 'modelHistory'
+# between the timestamp and the _id of the last entry of a page in its `next` cursor
+CURSOR_SEPARATOR = '|'
+
+
+def append(model_id: MongoId, action: HistoryActionType) -> None:
+    if write_behind.enabled():
+        write_behind.insert_one(HISTORY_COLLECTION, {'_id': ObjectId(), 'modelId': ObjectId(model_id),
+                                                     **action.as_dict()})
+        return
+    __insert([{'modelId': ObjectId(model_id), **action.as_dict()}])
+
+
+def append_many(actions: List[Tuple[MongoId, HistoryActionType]]) -> None:
+    """
+    (model id, action) pairs, written with one insert
+    """
+    if write_behind.enabled():
+        for model_id, action in actions:
+            append(model_id, action)
+        return
+    if actions:
+        __insert([{'modelId': ObjectId(model_id), **action.as_dict()} for model_id, action in actions])
+
+
+def delete_for_model(model_id: MongoId) -> None:
+    """
+    the model's entries, for when the model is deleted
+    """
+    mongo.get_collection(HISTORY_COLLECTION).delete_many({'modelId': ObjectId(model_id)})
+
+
+def get_page(model_id: MongoId, before: Optional[str] = None, limit: int = 50) -> dict:
+    """
+    newest first; pass the returned `next` as `before` to get the following page
+    """
+    write_behind.flush()
+    query = {'modelId': ObjectId(model_id)}
+    if before is not None:
+        query.update(__before(before))
+    items = list(mongo.get_collection(HISTORY_COLLECTION)
+                 .find(query, projection={'modelId': 0})
+                 .sort([('timestamp', DESCENDING), ('_id', DESCENDING)])
+                 .limit(limit))
+    return {
+        'modelId': str(model_id),
+        'items': items,
+        # the _id as well, the actions of one batch share their timestamp
+        'next': f'{items[-1]["timestamp"]}{CURSOR_SEPARATOR}{items[-1]["_id"]}' if len(items) == limit else None
+    }
+
+
+def get_recent_model_ids(scan: int) -> List[ObjectId]:
+    """
+    the models edited in the newest `scan` history entries, most recently edited first;
+    entry _ids are ObjectIds made at insert, so the _id index gives the insertion order
+    """
+    model_ids = []
+    seen = set()
+    for entry in mongo.get_collection(HISTORY_COLLECTION) \
+            .find({}, projection={'modelId': 1}).sort('_id', DESCENDING).limit(scan):
+        if entry['modelId'] not in seen:
+            seen.add(entry['modelId'])
+            model_ids.append(entry['modelId'])
+    return model_ids
+
+
+def migrate_embedded_history(batch_size: int = 100) -> int:
+    """
+    moves Model.history arrays into the history collection, returns the number of migrated models;
+    safe to run again after it was cut short, entries already copied are not copied twice
+    """
+    models = mongo.get_collection(Collection.MODEL)
+    history = mongo.get_collection(HISTORY_COLLECTION)
+    migrated = 0
+    cursor = models.find({'history.0': {'$exists': True}}, projection={'history': 1}, batch_size=batch_size)
+    for model in cursor:
+        entries: List[dict] = [{'_id': __migrated_id(model['_id'], i), 'modelId': model['_id'], **entry}
+                               for i, entry in enumerate(model['history'])]
+        history.bulk_write([UpdateOne({'_id': e['_id']}, {'$setOnInsert': e}, upsert=True) for e in entries],
+                           ordered=False)
+        # only clear the array if nothing was appended to it while we copied
+        models.update_one({'_id': model['_id'], 'history': {'$size': len(entries)}}, {'$set': {'history': []}})
+        migrated += 1
+    return migrated
+
+
+def __insert(entries: List[dict]) -> None:
+    try:
+        mongo.get_collection(HISTORY_COLLECTION).insert_many(entries, ordered=False)
+    except PyMongoError as e:
+        # the mutation the entries record is written already and is broadcast next, failing the event would hide it
+        print(f'Could not write {len(entries)} history entries: {e!r}', flush=True)
+        metrics.inc('history_write_errors_total')
+
+
+def __before(cursor: str) -> dict:
+    timestamp, _, entry_id = cursor.partition(CURSOR_SEPARATOR)
+    if not entry_id:
+        # a bare timestamp, as `next` was before it carried the _id
+        return {'timestamp': {'$lt': timestamp}}
+    return {'$or': [{'timestamp': {'$lt': timestamp}}, {'timestamp': timestamp, '_id': {'$lt': ObjectId(entry_id)}}]}
+
+
+def __migrated_id(model_id: ObjectId, index: int) -> ObjectId:
+    # the same for an entry on every run; dated like the model's _id, so the entry sorts before anything appended
+    # since it was created (see get_recent_model_ids)
+    return ObjectId(model_id.binary[:4] + hashlib.sha1(f'{model_id}:{index}'.encode()).digest()[:8])
+
+
+metrics.describe('history_write_errors_total', 'History inserts Mongo rejected, the mutations they record were applied')
+
+
+if __name__ == '__main__':
+    from src.services import index_service
+    index_service.ensure_indexes()
+    print(f'Migrated history of {migrate_embedded_history()} models', flush=True)
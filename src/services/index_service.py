@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+from typing import Iterator, List
+
+from bpr_data.repository import Collection
+from bson import ObjectId
+from pymongo import ASCENDING, IndexModel
+
+from src.services.history_service import HISTORY_COLLECTION
+from src.services.snapshot_service import SNAPSHOT_COLLECTION
+from src.util import mongo
+from src.util.exceptions import QueryPlanException
+
+# every index the socket server's queries rely on, per collection
+INDEXES = {
+    Collection.MODEL_REPRESENTATION.value: [
+        # diagram joins (model_service.__join_models)
+        IndexModel([('diagramId', ASCENDING)], name='diagramId_1'),
+        # representations of a model (cascade_service.delete_model, diagram_service.get_diagrams_for_model)
+        IndexModel([('modelId', ASCENDING)], name='modelId_1'),
+        # relation representations pointing at deleted relations (cascade_service.delete_model)
+        IndexModel([('relations.relationId', ASCENDING)], name='relations.relationId_1'),
+    ],
+    Collection.DIAGRAM.value: [
+        # diagrams containing a representation (cascade_service.__pull_from_diagrams, get_diagrams_for_model)
+        IndexModel([('models', ASCENDING)], name='models_1'),
+    ],
+    HISTORY_COLLECTION: [
+        # history pages (history_service.get_page)
+        IndexModel([('modelId', ASCENDING), ('timestamp', ASCENDING), ('_id', ASCENDING)],
+                   name='modelId_1_timestamp_1__id_1'),
+    ],
+    SNAPSHOT_COLLECTION: [
+        # snapshots showing a model or representation (snapshot_service changes)
+        IndexModel([('modelIds', ASCENDING)], name='modelIds_1'),
+        IndexModel([('representationIds', ASCENDING)], name='representationIds_1'),
+    ],
+}
+
+# representative filter of every access path, as (collection, filter); positional updates on
+# attributes._id / relations._id always filter on the model _id as well, so the _id index serves them
+ACCESS_PATHS = {
+    'join representations of a diagram': (Collection.MODEL_REPRESENTATION.value, {'diagramId': ObjectId()}),
+    'join a single representation': (Collection.MODEL_REPRESENTATION.value, {'_id': ObjectId()}),
+    'representations of a model': (Collection.MODEL_REPRESENTATION.value, {'modelId': ObjectId()}),
+    'relation representations of relations': (Collection.MODEL_REPRESENTATION.value,
+                                              {'relations.relationId': {'$in': [ObjectId()]}}),
+    'diagram by id': (Collection.DIAGRAM.value, {'_id': ObjectId()}),
+    'diagrams containing representations': (Collection.DIAGRAM.value, {'models': {'$in': [ObjectId()]}}),
+    'model by id': (Collection.MODEL.value, {'_id': ObjectId()}),
+    'attribute positional update': (Collection.MODEL.value, {'_id': ObjectId(), 'attributes._id': ObjectId()}),
+    'relation positional update': (Collection.MODEL.value, {'_id': ObjectId(), 'relations._id': ObjectId()}),
+    'history page': (HISTORY_COLLECTION, {'modelId': ObjectId(),
+                                          '$or': [{'timestamp': {'$lt': '~'}},
+                                                  {'timestamp': '~', '_id': {'$lt': ObjectId()}}]}),
+    'snapshots showing a model': (SNAPSHOT_COLLECTION, {'modelIds': ObjectId()}),
+    'snapshots showing a representation': (SNAPSHOT_COLLECTION, {'representationIds': ObjectId()}),
+}
+
+
+def ensure_indexes() -> List[str]:
+    """
+    creates the declared indexes that do not exist yet, returns their names
+    """
+    created = []
+    for collection_name, indexes in INDEXES.items():
+        collection = mongo.get_collection(collection_name)
+        existing = collection.index_information()
+        missing = [i for i in indexes if i.document['name'] not in existing]
+        if missing:
+            created += collection.create_indexes(missing)
+    return created
+
+
+def verify_query_plans() -> None:
+    """
+    raises QueryPlanException for every access path the server would answer with a collection scan
+    """
+    scans = []
+    for access_path, (collection_name, query) in ACCESS_PATHS.items():
+        plan = mongo.get_collection(collection_name).find(query).explain()['queryPlanner']['winningPlan']
+        if 'COLLSCAN' in __stages(plan):
+            scans.append(access_path)
+    if scans:
+        raise QueryPlanException(scans)
+
+
+def __stages(plan: dict) -> Iterator[str]:
+    yield plan.get('stage')
+    for key in ('inputStage', 'queryPlan'):
+        if key in plan:
+            yield from __stages(plan[key])
+    for child in plan.get('inputStages', []):
+        yield from __stages(child)
+
+
+if __name__ == '__main__':
+    print(f'Created indexes: {ensure_indexes()}', flush=True)
+    verify_query_plans()
+    print('All access paths are indexed', flush=True)
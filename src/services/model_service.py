@@ -1,224 +1,705 @@
 from __future__ import annotations
 
 from datetime import datetime
-from typing import Union, List
+from typing import Union, List, Optional, Iterator, Dict, Tuple
 
 from bpr_data.models.diagram import Diagram
 from bpr_data.models.model import Model, ModelRepresentation, FullModelRepresentation, CreateModelAction, \
     AddAttributeAction, AttributeType, RemoveAttributeAction, HistoryActionType, UpdateAttributeAction, \
     AttributeBase, Relation, CreateRelationAction, RemoveRelationAction, RelationRepresentation, UpdateRelationAction
-from bpr_data.repository import Repository, Collection
+from bpr_data.repository import Collection
 from bson import ObjectId
+from pymongo import ReturnDocument, InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
 
-import settings
+from src.services import diagram_cache, history_service, cascade_service, snapshot_service, write_behind
+from src.services.geometry_coalescer import GEOMETRY_FIELDS, GEOMETRY_SEQ, next_seq
+from src.util import mongo
 from src.util.exceptions import ListItemNotFoundException, MissingPropertyException
 
-db = Repository.get_instance(**settings.MONGO_CONN)
-
 # TODO: Move to data module
 MongoId = Union[ObjectId, str]
 
-
-def get_model(model_id: MongoId) -> Model:
-    model = db.find_one(Collection.MODEL, id=model_id)
-    return Model.from_dict(model, True)
+# socket events apply_batch accepts, with the keys their arguments must have
+BATCH_EVENTS = {
+    'update_model_rep': (['_id', 'x', 'y', 'w', 'h'],),
+    'create_model': (['type', 'path'], ['x', 'y', 'w', 'h']),
+    'add_model_attribute': (['modelId'], ['kind']),
+    'remove_model_attribute': (['modelId', 'attributeId'],),
+    'update_model_attribute': (['modelId'], ['_id', 'kind']),
+}
+ATTRIBUTE_KEYS = {
+    'field': ['kind', 'name', 'type', 'accessModifier'],
+    'method': ['kind', 'name', 'type', 'accessModifier', 'parameters'],
+}
+
+
+class BatchResult:
+    """
+    What apply_batch did: per op {'ok': True} or the error its single event would have sent, the room broadcasts
+    of the applied ops in order as (event, data), and the models that changed concurrently or whose write was
+    rejected and must be reloaded.
+    """
+    __slots__ = ('results', 'applied', 'resync')
+
+    def __init__(self, size: int):
+        self.results: List[dict] = [{'ok': True} for _ in range(size)]
+        self.applied: List[Tuple[str, Union[dict, FullModelRepresentation]]] = []
+        self.resync: List[str] = []
+
+    def fail(self, index: int, error_type: str, message) -> None:
+        self.results[index] = {'ok': False, 'error_type': error_type, 'message': message}
+
+
+def get_model(model_id: MongoId) -> Optional[Model]:
+    write_behind.flush()
+    model = mongo.get_collection(Collection.MODEL).find_one({'_id': ObjectId(model_id)}, projection={'history': 0})
+    if model is None:
+        return None
+    return __with_version(Model.from_dict(__without_history(model), True), model)
 
 
 def get_full_model_representation(representation_id: MongoId) -> FullModelRepresentation:
-    result = db.join(
-        local_collection=Collection.MODEL_REPRESENTATION,
-        local_field='modelId',
-        foreign_collection=Collection.MODEL,
-        foreign_field='_id',
-        to_field='model',
-        unwind=True,
-        id=representation_id
-    )
+    write_behind.flush()
+    result = __join_models({'_id': ObjectId(representation_id)})
     if len(result) >= 1:
-        return FullModelRepresentation.from_dict(result[0])
+        representation = FullModelRepresentation.from_dict(result[0])
+        __with_version(representation.model, result[0]['model'])
+        return representation
 
 
 def get_full_model_representations_for_diagram(diagram_id: str | ObjectId) -> list:
-    result = db.join(
-        local_collection=Collection.MODEL_REPRESENTATION,
-        local_field='modelId',
-        foreign_collection=Collection.MODEL,
-        foreign_field='_id',
-        to_field='model',
-        unwind=True,
-        diagramId=ObjectId(diagram_id)
-    )
-    return FullModelRepresentation.from_dict_list(result, True)
+    cached = diagram_cache.get(diagram_id)
+    if cached is not None:
+        return cached
+
+    write_behind.flush()
+    generation = diagram_cache.generation()
+    representations = __full_representations(__load_diagram(diagram_id, generation))
+    diagram_cache.put(diagram_id, representations, generation)
+    return representations
+
+
+def rebuild_snapshot(diagram_id: MongoId, attempts: int = 3) -> bool:
+    """
+    replaces the diagram's snapshot with the $lookup join, retried when a change lands on it meanwhile;
+    returns whether it was stored
+    """
+    write_behind.flush()
+    for _ in range(attempts):
+        version = snapshot_service.reserve(diagram_id)
+        if version is not None and snapshot_service.save(diagram_id, __join_models({'diagramId': ObjectId(diagram_id)}),
+                                                         version):
+            return True
+    return False
+
+
+def get_full_model_representations(diagram_id: str | ObjectId,
+                                   representation_ids: List[MongoId]) -> List[FullModelRepresentation]:
+    cached = diagram_cache.get(diagram_id)
+    if cached is not None:
+        keys = {str(i) for i in representation_ids}
+        return [r for r in cached if str(r.id) in keys]
+    write_behind.flush()
+    return __full_representations(__join_models({'diagramId': ObjectId(diagram_id),
+                                                 '_id': {'$in': [ObjectId(i) for i in representation_ids]}}))
+
+
+def iter_full_model_representations_for_diagram(diagram_id: str | ObjectId,
+                                                chunk_size: int) -> Iterator[List[FullModelRepresentation]]:
+    """
+    yields the diagram's representations chunk_size at a time straight off the aggregation cursor, so only one
+    chunk is held at a time; served from the room cache when it has the diagram, and never filling it
+    """
+    cached = diagram_cache.get(diagram_id)
+    if cached is not None:
+        for start in range(0, len(cached), chunk_size):
+            yield cached[start:start + chunk_size]
+        return
+
+    write_behind.flush()
+    if snapshot_service.enabled():
+        chunks = snapshot_service.load_chunks(diagram_id, chunk_size, lambda ids: __join_models({'_id': {'$in': ids}}))
+        if chunks is not None:
+            for joined in chunks:
+                yield __full_representations(joined)
+            return
+    chunk = []
+    with mongo.get_collection(Collection.MODEL_REPRESENTATION).aggregate(
+            __join_pipeline({'diagramId': ObjectId(diagram_id)}), batchSize=chunk_size) as cursor:
+        for raw in cursor:
+            __without_history(raw['model'])
+            representation = FullModelRepresentation.from_dict(raw, True)
+            __with_version(representation.model, raw['model'])
+            chunk.append(representation)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
 
 
 def create(model: dict, representation: dict, diagram: Diagram, user_id: MongoId) -> FullModelRepresentation:
     created_model = __create_model(model, diagram.projectId, user_id)
     created_representation = __create_representation(representation, created_model.id, diagram.id)
-    db.push(Collection.DIAGRAM, diagram.id, 'models', item=created_representation.id)
-    return get_full_model_representation(created_representation.id)
-
-
-def delete_model(model_id: MongoId) -> bool:
-    __on_model_delete_cleanup(model_id)
-    return db.delete(Collection.MODEL, id=model_id)
-
+    mongo.get_repository().push(Collection.DIAGRAM, diagram.id, 'models', item=created_representation.id)
+    full_representation = __cache_representation(__full_representation(created_representation, created_model))
+    snapshot_service.write(snapshot_service.representation_added(diagram.id, full_representation))
+    return full_representation
 
-def delete_model_rep(representation_id: MongoId):
-    __on_model_rep_delete_cleanup([ObjectId(representation_id)])
-    return db.delete(Collection.MODEL_REPRESENTATION, id=representation_id)
 
+def delete_model(model_id: MongoId) -> Optional[List[str]]:
+    """
+    returns the ids of the diagrams that showed the model, None if it was not deleted
+    """
+    write_behind.flush()
+    affected_diagrams = cascade_service.delete_model(model_id)
+    diagram_cache.remove_model(model_id)
+    return affected_diagrams
 
-def __on_model_delete_cleanup(model_id: MongoId) -> None:
-    # delete cascade is partially handled in triggers, but we are at the limit for free tier, so here we go:
-    # delete diagram.models affected
-    rep_ids = [r.id for r in db.find(Collection.MODEL_REPRESENTATION, ModelRepresentation, modelId=ObjectId(model_id))]
-    __on_model_rep_delete_cleanup(rep_ids)
-    # diagrams = db.find(Collection.DIAGRAM, Diagram, models={'$in': representation_ids})
-    # for diagram in diagrams:
-    #     for rep in representation_ids:
-    #         db.pull(Collection.DIAGRAM, diagram.id, 'models', rep)
 
-
-def __on_model_rep_delete_cleanup(rep_ids: List[ObjectId]) -> None:
-    # delete cascade is partially handled in triggers, but we are at the limit for free tier, so here we go:
-    # delete diagram.models affected
-    diagrams = db.find(Collection.DIAGRAM, Diagram, models={'$in': rep_ids})
-    for diagram in diagrams:
-        for rep in rep_ids:
-            db.pull(Collection.DIAGRAM, diagram.id, 'models', rep)
+def delete_model_rep(representation_id: MongoId) -> Optional[List[str]]:
+    write_behind.flush()
+    affected_diagrams = cascade_service.delete_model_rep(representation_id)
+    diagram_cache.remove_representation(representation_id)
+    return affected_diagrams
 
 
 def add_to_diagram(model_id: str | ObjectId, representation: dict, diagram: Diagram) -> FullModelRepresentation:
     model = get_model(model_id)
+    if model is None:
+        return None
     created_representation = __create_representation(representation, model.id, diagram.id)
-    return get_full_model_representation(created_representation.id)
-
-
-def update_model_rep(data: dict) -> FullModelRepresentation:
-    if 'modelId' not in data or 'diagramId' not in data:
-        ref_model = db.find_one(Collection.MODEL_REPRESENTATION, id=data['_id'])
-        data['modelId'] = ref_model['modelId']
-        data['diagramId'] = ref_model['diagramId']
-        data['relations'] = ref_model['relations']
-
-    to_update = ModelRepresentation.from_dict(data)
-
-    db.update(Collection.MODEL_REPRESENTATION, to_update)
-
-    return get_full_model_representation(to_update.id)
+    full_representation = __cache_representation(__full_representation(created_representation, model))
+    snapshot_service.write(snapshot_service.representation_added(diagram.id, full_representation))
+    return full_representation
+
+
+def update_model_rep(data: dict) -> dict:
+    geometry = {k: data[k] for k in GEOMETRY_FIELDS}
+    if __update_representation(data['_id'], {'$set': {**geometry, GEOMETRY_SEQ: next_seq()}}):
+        diagram_cache.update_geometry(data['_id'], geometry)
+        return {'_id': str(data['_id']), **geometry}
+
+
+def update_model_reps(geometries: List[dict]) -> None:
+    """
+    the geometry a GeometryCoalescer flushes, with one unordered bulk write; a representation written with a later
+    GEOMETRY_SEQ meanwhile, such as at the end of the drag, keeps that geometry
+    """
+    requests = []
+    snapshot_changes = []
+    for data in geometries:
+        query = {GEOMETRY_SEQ: {'$not': {'$gte': data[GEOMETRY_SEQ]}}}
+        update = {'$set': {**{k: data[k] for k in GEOMETRY_FIELDS}, GEOMETRY_SEQ: data[GEOMETRY_SEQ]}}
+        snapshot_changes += snapshot_service.representation_updated(data['_id'], update, query)
+        if write_behind.enabled() and diagram_cache.has_representation(data['_id']):
+            write_behind.update_one(Collection.MODEL_REPRESENTATION, {'_id': ObjectId(data['_id']), **query}, update)
+        else:
+            requests.append(UpdateOne({'_id': ObjectId(data['_id']), **query}, update))
+    if requests:
+        write_behind.flush()
+        mongo.get_collection(Collection.MODEL_REPRESENTATION).bulk_write(requests, ordered=False)
+    snapshot_service.write(snapshot_changes)
 
 
 def add_attribute(model_id: MongoId,
                   user_id: MongoId,
-                  attribute: dict) -> Model:
+                  attribute: dict) -> dict:
     attr = __construct_attribute(attribute)
-    success = db.push(Collection.MODEL, ObjectId(model_id), 'attributes', attr.as_dict())
+    version = __patch_model({'_id': ObjectId(model_id)}, {'$push': {'attributes': attr.as_dict()}})
 
-    if success:
+    if version is not None:
         __add_to_history(model_id,
                          AddAttributeAction(item=attr, timestamp=str(datetime.utcnow()), userId=ObjectId(user_id)))
 
-        return get_model(model_id)
+        return __cache_patch({'modelId': str(model_id), 'version': version, 'op': 'attribute_added',
+                              'item': attr.as_dict()})
 
 
 def remove_attribute(model_id: MongoId,
                      attribute_id: MongoId,
-                     user_id: MongoId) -> Model:
-    success = db.pull(Collection.MODEL, ObjectId(model_id), 'attributes', {'_id': ObjectId(attribute_id)})
+                     user_id: MongoId) -> dict:
+    version = __patch_model({'_id': ObjectId(model_id), 'attributes._id': ObjectId(attribute_id)},
+                            {'$pull': {'attributes': {'_id': ObjectId(attribute_id)}}})
 
-    if success:
+    if version is not None:
         __add_to_history(model_id, RemoveAttributeAction(timestamp=str(datetime.utcnow()), userId=ObjectId(user_id),
                                                          itemId=ObjectId(attribute_id)))
-        return get_model(model_id)
+        return __cache_patch({'modelId': str(model_id), 'version': version, 'op': 'attribute_removed',
+                              'itemId': ObjectId(attribute_id)})
 
 
 def update_attribute(model_id: MongoId,
                      user_id: MongoId,
-                     attribute: dict) -> Model:
+                     attribute: dict) -> dict:
     if '_id' not in attribute:
         raise MissingPropertyException(prop='_id')
 
-    model = get_model(model_id)
     new_attr = __construct_attribute(attribute)
-    old_attr = next((AttributeBase.parse(a, True) for a in model.attributes if a['_id'] == new_attr.id), None)
-
-    if old_attr is not None and old_attr != new_attr:
-        __add_to_history(ObjectId(model_id),
-                         UpdateAttributeAction(oldItem=old_attr, newItem=new_attr, userId=ObjectId(user_id),
-                                               timestamp=str(datetime.utcnow())))
+    before = __replace_list_item(model_id, 'attributes', new_attr)
 
-        db.update_list_item(collection=Collection.MODEL,
-                            document_id=ObjectId(model_id),
-                            field_name='attributes',
-                            field_query={'attributes._id': new_attr.id},
-                            item=new_attr)
+    if before is not None:
+        old_attr = AttributeBase.parse(before['attributes'][0], True)
+        if old_attr != new_attr:
+            __add_to_history(ObjectId(model_id),
+                             UpdateAttributeAction(oldItem=old_attr, newItem=new_attr, userId=ObjectId(user_id),
+                                                   timestamp=str(datetime.utcnow())))
 
-        return get_model(model_id)
+        return __cache_patch({'modelId': str(model_id), 'version': before.get('version', 0) + 1,
+                              'op': 'attribute_updated', 'item': new_attr.as_dict()})
 
 
 def create_relation(model_id: MongoId,
                     representation_id: MongoId,
                     user_id: MongoId,
-                    relation: dict) -> FullModelRepresentation:
-    rel = __create_relation(relation, model_id)
+                    relation: dict) -> dict:
+    rel = __construct_relation(relation)
+    version = __patch_model({'_id': ObjectId(model_id)}, {'$push': {'relations': rel.as_dict()}})
 
-    if rel is not None:
+    if version is not None:
         relation_rep = RelationRepresentation.from_dict({'_id': ObjectId(), 'relationId': rel.id})
-        db.push(Collection.MODEL_REPRESENTATION, ObjectId(representation_id), 'relations', relation_rep.as_dict())
+        __update_representation(representation_id, {'$push': {'relations': relation_rep.as_dict()}})
 
         __add_to_history(model_id, CreateRelationAction(item=rel, timestamp=str(datetime.utcnow()),
                                                         userId=ObjectId(user_id)))
 
-        return get_full_model_representation(representation_id)
+        return __cache_patch({'modelId': str(model_id), 'version': version, 'op': 'relation_added',
+                              'item': rel.as_dict(), 'representationId': ObjectId(representation_id),
+                              'relationRepresentation': relation_rep.as_dict()})
 
 
 def update_relation(model_id: MongoId,
                     user_id: MongoId,
-                    relation: dict) -> Model:
+                    relation: dict) -> dict:
     if '_id' not in relation:
         raise MissingPropertyException(prop='_id')
 
-    model = get_model(model_id)
+    updated_rel = __construct_relation(relation)
+    before = __replace_list_item(model_id, 'relations', updated_rel)
 
-    old_rel = next((r for r in model.relations if str(r['_id']) == str(relation['_id'])), None)
-    if old_rel is None:
-        raise ListItemNotFoundException(document_id=model.id, list_field='relation',
+    if before is None:
+        raise ListItemNotFoundException(document_id=model_id, list_field='relation',
                                         item_identifier=f'_id={relation["_id"]}')
 
-    updated_rel = __construct_relation(relation)
-    db.update_list_item(collection=Collection.MODEL,
-                        document_id=ObjectId(model_id),
-                        field_name='relations',
-                        field_query={'relations._id': updated_rel.id},
-                        item=updated_rel)
-
     __add_to_history(model_id,
-                     UpdateRelationAction(timestamp=str(datetime.utcnow()), userId=ObjectId(user_id), oldItem=old_rel,
-                                          newItem=updated_rel))
+                     UpdateRelationAction(timestamp=str(datetime.utcnow()), userId=ObjectId(user_id),
+                                          oldItem=before['relations'][0], newItem=updated_rel))
 
-    return get_model(model_id)
+    return __cache_patch({'modelId': str(model_id), 'version': before.get('version', 0) + 1,
+                          'op': 'relation_updated', 'item': updated_rel.as_dict()})
 
 
 def delete_relation(model_id: MongoId,
                     representation_id: MongoId,
                     relation_id: MongoId,
                     deep: bool,
-                    user_id: MongoId):
-    db.pull(Collection.MODEL_REPRESENTATION,
-            ObjectId(representation_id),
-            'relations',
-            {'relationId': ObjectId(relation_id)})
-
+                    user_id: MongoId) -> Optional[dict]:
+    """
+    None when the representation does not show the relation
+    """
+    if not __update_representation(representation_id,
+                                   {'$pull': {'relations': {'relationId': ObjectId(relation_id)}}},
+                                   {'relations.relationId': ObjectId(relation_id)}):
+        return None
+
+    patch = {'modelId': str(model_id), 'op': 'relation_removed', 'itemId': ObjectId(relation_id),
+             'representationId': ObjectId(representation_id), 'deep': deep}
     if deep:
-        db.pull(Collection.MODEL, ObjectId(model_id), 'relations', {'_id': ObjectId(relation_id)})
-        __add_to_history(model_id, RemoveRelationAction(timestamp=str(datetime.utcnow()), userId=ObjectId(user_id),
-                                                        itemId=ObjectId(relation_id)))
-
-    return get_full_model_representation(representation_id)
+        version = __patch_model({'_id': ObjectId(model_id)}, {'$pull': {'relations': {'_id': ObjectId(relation_id)}}})
+        if version is not None:
+            patch['version'] = version
+            __add_to_history(model_id, RemoveRelationAction(timestamp=str(datetime.utcnow()),
+                                                            userId=ObjectId(user_id), itemId=ObjectId(relation_id)))
+
+    return __cache_patch(patch)
+
+
+def apply_batch(ops: List[dict], diagram: Diagram, user_id: MongoId) -> BatchResult:
+    """
+    applies ops, each {'event', 'args'} with the arguments the single socket event takes, in order;
+    all ops are validated first and every collection is written with one bulk_write, so a batch costs
+    a few round trips however many ops it holds
+    """
+    write_behind.flush()
+    result = BatchResult(len(ops))
+    planned = []
+    for index, op in enumerate(ops):
+        error = __batch_op_error(op)
+        if error is not None:
+            result.fail(index, *error)
+        else:
+            planned.append((index, op['event'], op['args']))
+
+    models = __batch_models([args[0]['modelId'] for _, event, args in planned if event != 'update_model_rep'
+                             and event != 'create_model'])
+    model_requests: List[Union[InsertOne, UpdateOne]] = []
+    # the op indexes each model request writes, by position
+    model_request_ops: List[List[int]] = []
+    representation_requests: List[Union[InsertOne, UpdateOne]] = []
+    # the op index each representation request writes, by position
+    representation_request_ops: List[int] = []
+    # op index -> (model id, action) of its history entry
+    history: Dict[int, Tuple[MongoId, HistoryActionType]] = {}
+    # op index -> what it broadcasts, for the ops that could still fail once written
+    applied: Dict[int, Tuple[str, Union[dict, FullModelRepresentation]]] = {}
+    # op index -> (query, update) of a model patch, repeated on the snapshots showing the model
+    patch_updates: Dict[int, Tuple[dict, dict]] = {}
+    # model id -> its version before the batch, for the models it patches
+    patched: Dict[str, int] = {}
+    # model id -> the indexes of the ops patching it
+    patch_ops: Dict[str, List[int]] = {}
+    moved: Dict[str, List[int]] = {}
+    # op index -> the GEOMETRY_SEQ of a geometry update
+    geometry_seqs: Dict[int, int] = {}
+    timestamp = str(datetime.utcnow())
+    for index, event, args in planned:
+        if event == 'update_model_rep':
+            geometry = {k: args[0][k] for k in GEOMETRY_FIELDS}
+            geometry_seqs[index] = next_seq()
+            representation_requests.append(UpdateOne({'_id': ObjectId(args[0]['_id'])},
+                                                      {'$set': {**geometry, GEOMETRY_SEQ: geometry_seqs[index]}}))
+            representation_request_ops.append(index)
+            moved.setdefault(str(args[0]['_id']), []).append(index)
+            applied[index] = ('model_rep_patched', {'_id': str(args[0]['_id']), **geometry})
+        elif event == 'create_model':
+            model = __with_version(__new_model(dict(args[0]), diagram.projectId, ObjectId()), {})
+            representation = __new_representation(dict(args[1]), model.id, diagram.id, ObjectId())
+            model_requests.append(InsertOne(model.as_dict()))
+            model_request_ops.append([index])
+            representation_requests.append(InsertOne(representation.as_dict()))
+            representation_request_ops.append(index)
+            history[index] = (model.id, CreateModelAction(timestamp=timestamp, userId=ObjectId(user_id)))
+            applied[index] = ('model_added', __full_representation(representation, model))
+        else:
+            model_id = str(args[0]['modelId'])
+            state = models.get(model_id)
+            change = __batch_attribute_change(event, args, state, user_id, timestamp)
+            if change is None:
+                result.fail(index, 'update_model_error', f'no such model or attribute: {args[0]}')
+                continue
+            patch, query, update, action = change
+            patched.setdefault(model_id, state['version'])
+            patch_ops.setdefault(model_id, []).append(index)
+            version = state['version'] + 1
+            state['version'] = version
+            patch_updates[index] = (query, update)
+            history[index] = (model_id, action)
+            applied[index] = ('model_patched', {'modelId': model_id, 'version': version, **patch})
+
+    # one update per model with the attributes its ops leave, so they are written or rejected together
+    for model_id, version in patched.items():
+        model_requests.append(UpdateOne({'_id': ObjectId(model_id), 'version': __version_filter(version)},
+                                        {'$set': {'attributes': list(models[model_id]['attributes'].values()),
+                                                  'version': models[model_id]['version']}}))
+        model_request_ops.append(patch_ops[model_id])
+    if model_requests:
+        matched, rejected = __bulk_write(Collection.MODEL, model_requests)
+        # op index -> why it failed
+        failed = {index: message for position, message in rejected.items() for index in model_request_ops[position]}
+        # a rejected model insert takes its representation insert with it
+        kept = [p for p, index in enumerate(representation_request_ops) if index not in failed]
+        representation_requests = [representation_requests[p] for p in kept]
+        representation_request_ops = [representation_request_ops[p] for p in kept]
+        result.resync = [m for m in patched if patch_ops[m][0] in failed]
+        written = [m for m in patched if m not in result.resync]
+        if matched < len(written):
+            # another writer changed some of the models since they were read, their ops fail and everyone reloads them
+            for model_id in __unwritten_models(models, written):
+                result.resync.append(model_id)
+                failed.update((index, f'model changed meanwhile: {model_id}') for index in patch_ops[model_id])
+        result.resync.sort()
+        __fail_applied(result, applied, failed)
+    if representation_requests:
+        matched, rejected = __bulk_write(Collection.MODEL_REPRESENTATION, representation_requests)
+        failed = {representation_request_ops[position]: message for position, message in rejected.items()}
+        if matched < sum(1 for indexes in moved.values() for index in indexes if index not in failed):
+            for missing in __missing_representations(list(moved)):
+                failed.update((index, f'no such representation: {missing}') for index in moved[missing])
+        __fail_applied(result, applied, failed)
+    created = [data.id for event, data in (applied[i] for i in sorted(applied)) if event == 'model_added']
+    if created:
+        mongo.get_collection(Collection.DIAGRAM).update_one({'_id': ObjectId(diagram.id)},
+                                                            {'$push': {'models': {'$each': created}}})
+    history_service.append_many([history[index] for index in sorted(history) if index in applied])
+
+    snapshot_changes = snapshot_service.models_stale(result.resync)
+    for index in sorted(applied):
+        event, data = applied[index]
+        if event == 'model_rep_patched':
+            geometry = {k: data[k] for k in GEOMETRY_FIELDS}
+            diagram_cache.update_geometry(data['_id'], geometry)
+            snapshot_changes += snapshot_service.representation_updated(
+                data['_id'], {'$set': {**geometry, GEOMETRY_SEQ: geometry_seqs[index]}})
+        elif event == 'model_added':
+            __cache_representation(data)
+            snapshot_changes += snapshot_service.representation_added(diagram.id, data)
+        else:
+            __cache_patch(data)
+            snapshot_changes += snapshot_service.model_patched(data['modelId'], *patch_updates[index],
+                                                               data['version'])
+        result.applied.append((event, data))
+    snapshot_service.write(snapshot_changes)
+    for model_id in result.resync:
+        diagram_cache.evict_model(model_id)
+    return result
+
+
+def __batch_op_error(op: dict) -> Tuple[str, object] | None:
+    if not isinstance(op, dict) or op.get('event') not in BATCH_EVENTS:
+        return 'unsupportedOperation', op.get('event') if isinstance(op, dict) else op
+    required = BATCH_EVENTS[op['event']]
+    args = op.get('args')
+    if not isinstance(args, list) or len(args) != len(required) or not all(isinstance(a, dict) for a in args):
+        return 'missingParameters', f'{op["event"]} takes {len(required)} object arguments'
+    missing = [k for arg, keys in zip(args, required) for k in keys if k not in arg]
+    if op['event'] in ('add_model_attribute', 'update_model_attribute') and not missing:
+        missing = [k for k in ATTRIBUTE_KEYS.get(args[1]['kind'], ['kind', 'value']) if k not in args[1]]
+    if missing:
+        return 'missingParameters', missing
+
+
+def __batch_models(model_ids: List[MongoId]) -> Dict[str, dict]:
+    """
+    model id -> {'version', 'attributes': attribute id -> attribute} of the models the batch patches, one query
+    """
+    if not model_ids:
+        return {}
+    found = mongo.get_collection(Collection.MODEL).find({'_id': {'$in': [ObjectId(i) for i in set(model_ids)]}},
+                                                        projection={'version': 1, 'attributes': 1})
+    return {str(m['_id']): {'version': m.get('version', 0),
+                            'attributes': {str(a['_id']): a for a in m.get('attributes', [])}}
+            for m in found}
+
+
+def __bulk_write(collection: Collection, requests: list) -> Tuple[int, Dict[int, str]]:
+    """
+    writes the requests unordered, so a rejected one (a duplicate key, a failed validation) does not stop the
+    others; returns how many updates matched and position -> error of the rejected requests
+    """
+    try:
+        return mongo.get_collection(collection).bulk_write(requests, ordered=False).matched_count, {}
+    except BulkWriteError as e:
+        return e.details['nMatched'], {error['index']: error['errmsg'] for error in e.details['writeErrors']}
+
+
+def __fail_applied(result: BatchResult, applied: Dict[int, Tuple[str, Union[dict, FullModelRepresentation]]],
+                   failed: Dict[int, str]) -> None:
+    """
+    takes the ops whose writes failed out of applied, their results say why
+    """
+    for index in sorted(failed):
+        event, _ = applied.pop(index)
+        result.fail(index, 'model_error' if event == 'model_added' else 'update_model_error', failed[index])
+
+
+def __unwritten_models(models: Dict[str, dict], model_ids: List[str]) -> List[str]:
+    """
+    the models whose attributes are not what the batch wrote; the version cannot tell, other writers increment it
+    """
+    found = mongo.get_collection(Collection.MODEL).find({'_id': {'$in': [ObjectId(i) for i in model_ids]}},
+                                                        projection={'attributes': 1})
+    attributes = {str(m['_id']): m.get('attributes', []) for m in found}
+    return sorted(i for i in model_ids if attributes.get(i) != list(models[i]['attributes'].values()))
+
+
+def __batch_attribute_change(event: str, args: list, state: Optional[dict], user_id: MongoId,
+                             timestamp: str) -> Tuple[dict, dict, dict, HistoryActionType] | None:
+    """
+    the patch fields, the extra filter, the Mongo update and the history action of an attribute op, checked against
+    and applied to the model state the batch has built up so far; None when the model or attribute does not exist
+    """
+    if state is None:
+        return None
+    if event == 'add_model_attribute':
+        attr = __construct_attribute(dict(args[1]))
+        state['attributes'][str(attr.id)] = attr.as_dict()
+        return {'op': 'attribute_added', 'item': attr.as_dict()}, {}, {'$push': {'attributes': attr.as_dict()}}, \
+            AddAttributeAction(item=attr, timestamp=timestamp, userId=ObjectId(user_id))
+    if event == 'remove_model_attribute':
+        attribute_id = ObjectId(args[0]['attributeId'])
+        if state['attributes'].pop(str(attribute_id), None) is None:
+            return None
+        return {'op': 'attribute_removed', 'itemId': attribute_id}, {}, \
+            {'$pull': {'attributes': {'_id': attribute_id}}}, \
+            RemoveAttributeAction(timestamp=timestamp, userId=ObjectId(user_id), itemId=attribute_id)
+    new_attr = __construct_attribute(dict(args[1]))
+    before = state['attributes'].get(str(new_attr.id))
+    if before is None:
+        return None
+    state['attributes'][str(new_attr.id)] = new_attr.as_dict()
+    return {'op': 'attribute_updated', 'item': new_attr.as_dict()}, {'attributes._id': new_attr.id}, \
+        {'$set': {'attributes.$': new_attr.as_dict()}}, \
+        UpdateAttributeAction(oldItem=AttributeBase.parse(before, True), newItem=new_attr, userId=ObjectId(user_id),
+                              timestamp=timestamp)
+
+
+def __missing_representations(representation_ids: List[str]) -> List[str]:
+    found = mongo.get_collection(Collection.MODEL_REPRESENTATION).find(
+        {'_id': {'$in': [ObjectId(i) for i in representation_ids]}}, projection={'_id': 1})
+    return sorted(set(representation_ids) - {str(r['_id']) for r in found})
+
+
+def __patch_model(query: dict, update: dict) -> int | None:
+    """
+    applies the update and bumps the model version in one round trip, returns the new version
+    """
+    if write_behind.enabled() and diagram_cache.get_model(query['_id']) is not None:
+        return __journal_model_update(query, update)
+    # its room may have left the cache with journaled updates pending, they go first
+    write_behind.flush()
+    after = mongo.get_collection(Collection.MODEL).find_one_and_update(query,
+                                                                       {**update, '$inc': {'version': 1}},
+                                                                       projection={'version': 1},
+                                                                       return_document=ReturnDocument.AFTER)
+    if after is not None:
+        snapshot_service.write(snapshot_service.model_patched(query['_id'], query, update, after['version']))
+        return after['version']
+
+
+def __replace_list_item(model_id: MongoId, field: str, item) -> dict | None:
+    """
+    replaces the element of the model's list field with the item's _id and bumps the model version,
+    returns the version and the element before the update as {'version', field: [element]}
+    """
+    query = {'_id': ObjectId(model_id), f'{field}._id': item.id}
+    update = {'$set': {f'{field}.$': item.as_dict()}}
+    if write_behind.enabled() and diagram_cache.get_model(model_id) is not None:
+        old_item = __cached_item(diagram_cache.get_model(model_id), field, item.id)
+        version = __journal_model_update(query, update)
+        if version is not None:
+            return {'version': version - 1, field: [old_item]}
+        return None
+    write_behind.flush()
+    before = mongo.get_collection(Collection.MODEL).find_one_and_update(query,
+                                                                        {**update, '$inc': {'version': 1}},
+                                                                        projection={'version': 1, f'{field}.$': 1},
+                                                                        return_document=ReturnDocument.BEFORE)
+    if before is not None:
+        snapshot_service.write(snapshot_service.model_patched(model_id, query, update, before.get('version', 0) + 1))
+    return before
+
+
+def __journal_model_update(query: dict, update: dict) -> int | None:
+    """
+    write-behind variant of __patch_model against the cached model, which is authoritative while journaled writes
+    are pending; the journaled update is filtered on the version it replaces, so a replay never applies it twice
+    """
+    model = diagram_cache.get_model(query['_id'])
+    for path, item_id in query.items():
+        if path != '_id' and __cached_item(model, path.split('.')[0], item_id) is None:
+            return None
+    version = diagram_cache.next_version(query['_id'])
+    write_behind.update_one(Collection.MODEL, {**query, 'version': __version_filter(version - 1)},
+                            {**update, '$set': {**update.get('$set', {}), 'version': version}})
+    snapshot_service.write(snapshot_service.model_patched(query['_id'], query, update, version))
+    return version
+
+
+def __version_filter(version: int):
+    # models written before versioning have no version field
+    return version if version else {'$in': [0, None]}
+
+
+def __update_representation(representation_id: MongoId, update: dict, query: dict = None) -> bool:
+    """
+    journaled when the representation is cached and write-behind is on, returns whether it exists
+    """
+    snapshot_changes = snapshot_service.representation_updated(representation_id, update, query)
+    query = {'_id': ObjectId(representation_id), **(query or {})}
+    if write_behind.enabled() and diagram_cache.has_representation(representation_id):
+        write_behind.update_one(Collection.MODEL_REPRESENTATION, query, update)
+        snapshot_service.write(snapshot_changes)
+        return True
+    write_behind.flush()
+    if mongo.get_collection(Collection.MODEL_REPRESENTATION).update_one(query, update).matched_count == 1:
+        snapshot_service.write(snapshot_changes)
+        return True
+    return False
+
+
+def __cached_item(model: Model, field: str, item_id: MongoId) -> dict | None:
+    for item in getattr(model, field):
+        item = item if isinstance(item, dict) else item.as_dict()
+        if str(item['_id']) == str(item_id):
+            return item
+
+
+def __with_version(model: Model, raw: dict) -> Model:
+    # the version is not part of the shared Model dataclass, it rides along as a plain attribute
+    model.version = raw.get('version', 0)
+    return model
+
+
+def __cache_patch(patch: dict) -> dict:
+    diagram_cache.apply_model_patch(patch)
+    return patch
+
+
+def __cache_representation(representation: FullModelRepresentation) -> FullModelRepresentation:
+    if representation is not None:
+        diagram_cache.upsert_representation(representation)
+    return representation
 
 
 def __add_to_history(model_id: MongoId, action: HistoryActionType):
-    db.push(Collection.MODEL, ObjectId(model_id), 'history', action.as_dict())
+    history_service.append(model_id, action)
+
+
+def __full_representation(representation: ModelRepresentation, model: Model) -> FullModelRepresentation:
+    # both documents were just written, so the joined view is assembled here instead of read back
+    full_representation = FullModelRepresentation.from_dict({**representation.as_dict(), 'model': None})
+    full_representation.model = model
+    return full_representation
+
+
+def __full_representations(result: List[dict]) -> List[FullModelRepresentation]:
+    representations = FullModelRepresentation.from_dict_list(result, True)
+    for representation, raw in zip(representations, result):
+        __with_version(representation.model, raw['model'])
+    return representations
+
+
+def __load_diagram(diagram_id: MongoId, generation: int) -> List[dict]:
+    """
+    the diagram's joined representations, read from its snapshot when there is a current one; otherwise joined,
+    and stored as its snapshot unless a mutation raced the join
+    """
+    if not snapshot_service.enabled():
+        return __join_models({'diagramId': ObjectId(diagram_id)})
+    joined = snapshot_service.load(diagram_id)
+    if joined is None:
+        # reserved before the join, so a change applied to the snapshot in between is seen by save()
+        version = snapshot_service.reserve(diagram_id)
+        joined = __join_models({'diagramId': ObjectId(diagram_id)})
+        ids = [diagram_id] + [r['_id'] for r in joined] + [r['modelId'] for r in joined]
+        if version is not None and not diagram_cache.changed_since(generation, ids):
+            snapshot_service.save(diagram_id, joined, version)
+    return joined
+
+
+def __join_models(query: dict) -> List[dict]:
+    result = list(mongo.get_collection(Collection.MODEL_REPRESENTATION).aggregate(__join_pipeline(query)))
+    for representation in result:
+        __without_history(representation['model'])
+    return result
+
+
+def __join_pipeline(query: dict) -> List[dict]:
+    # like db.join, but the history array never leaves the database
+    return [
+        {'$match': query},
+        {'$lookup': {'from': Collection.MODEL.value, 'localField': 'modelId', 'foreignField': '_id', 'as': 'model'}},
+        {'$unwind': '$model'},
+        {'$project': {'model.history': 0}}
+    ]
+
+
+def __without_history(model: dict) -> dict:
+    # history lives in its own collection, see history_service
+    if model is not None:
+        model['history'] = []
+    return model
 
 
 def __construct_attribute(d: dict) -> AttributeType:
@@ -243,13 +724,6 @@ def __construct_relation(d: dict) -> Relation:
     return Relation.from_dict(d, True)
 
 
-def __create_relation(d: dict, model_id: MongoId) -> Relation:
-    relation = __construct_relation(d)
-    success = db.push(Collection.MODEL, ObjectId(model_id), 'relations', relation.as_dict())
-    if success:
-        return relation
-
-
 def __construct_relation_representation(d: dict) -> Relation:
     # ensure that an id is present
     # if existing _id, ensure that it is ObjectId
@@ -262,7 +736,14 @@ def __construct_relation_representation(d: dict) -> Relation:
 
 
 def __create_model(model: dict, project_id: MongoId, user_id: MongoId) -> Model:
-    model['_id'] = None
+    created_model = mongo.get_repository().insert(Collection.MODEL, __new_model(model, project_id),
+                                                  return_type=Model)
+    __add_to_history(created_model.id, CreateModelAction(timestamp=str(datetime.utcnow()), userId=ObjectId(user_id)))
+    return __with_version(created_model, {})
+
+
+def __new_model(model: dict, project_id: MongoId, model_id: ObjectId = None) -> Model:
+    model['_id'] = model_id
     model['projectId'] = ObjectId(project_id)
 
     if 'attributes' in model:
@@ -277,13 +758,18 @@ def __create_model(model: dict, project_id: MongoId, user_id: MongoId) -> Model:
     else:
         model['relations'] = []
 
-    action = CreateModelAction(timestamp=str(datetime.utcnow()), userId=ObjectId(user_id))
-    model['history'] = [action]
-    return db.insert(Collection.MODEL, Model.from_dict(model), return_type=Model)
+    model['history'] = []
+    return Model.from_dict(model)
 
 
 def __create_representation(representation: dict, model_id: str | ObjectId, diagram_id: str | ObjectId):
-    representation['_id'] = None
+    return ModelRepresentation.from_dict(mongo.get_repository().insert(
+        Collection.MODEL_REPRESENTATION, __new_representation(representation, model_id, diagram_id)))
+
+
+def __new_representation(representation: dict, model_id: str | ObjectId, diagram_id: str | ObjectId,
+                         representation_id: ObjectId = None) -> ModelRepresentation:
+    representation['_id'] = representation_id
     representation['modelId'] = ObjectId(model_id)
     representation['diagramId'] = ObjectId(diagram_id)
     if 'relations' in representation:
@@ -291,10 +777,9 @@ def __create_representation(representation: dict, model_id: str | ObjectId, diag
         representation['relations'] = relations
     else:
         representation['relations'] = []
-    return ModelRepresentation.from_dict(
-        db.insert(Collection.MODEL_REPRESENTATION, ModelRepresentation.from_dict(representation)))
+    return ModelRepresentation.from_dict(representation)
 
 
 def __get_raw_model_representation(model_representation_id: MongoId) -> ModelRepresentation:
-    model = db.find_one(Collection.MODEL_REPRESENTATION, id=model_representation_id)
+    model = mongo.get_repository().find_one(Collection.MODEL_REPRESENTATION, id=model_representation_id)
     return ModelRepresentation.from_dict(model, True)
@@ -0,0 +1,68 @@
+from __future__ import annotations
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from types import ModuleType
+from typing import Any, AsyncIterator, Callable, Iterator
+
+import settings
+from src.services import diagram_service as _diagram_service, history_service as _history_service, \
+    model_service as _model_service
+from src.util import metrics
+
+# blocking pymongo calls of the asyncio server run here, at most ASYNC_WORKER_THREADS at a time
+_executor = ThreadPoolExecutor(max_workers=settings.ASYNC_WORKER_THREADS, thread_name_prefix='offload')
+_queued = 0
+
+
+async def run(func: Callable, *args, **kwargs) -> Any:
+    """
+    awaits func(*args, **kwargs) run on the thread pool, the event loop goes on serving other clients meanwhile
+    """
+    global _queued
+    _queued += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+    finally:
+        _queued -= 1
+
+
+async def iterate(iterator: Iterator) -> AsyncIterator:
+    """
+    steps a blocking iterator, such as one reading a Mongo cursor, on the thread pool
+    """
+    done = object()
+    while True:
+        item = await run(next, iterator, done)
+        if item is done:
+            return
+        yield item
+
+
+class _Offloaded:
+    """
+    The functions of a service module as coroutine functions run on the thread pool.
+    """
+
+    def __init__(self, module: ModuleType):
+        self.__module = module
+
+    def __getattr__(self, name: str) -> Callable:
+        func = getattr(self.__module, name)
+
+        async def call(*args, **kwargs):
+            return await run(func, *args, **kwargs)
+
+        call.__name__ = name
+        call.__doc__ = func.__doc__
+        setattr(self, name, call)
+        return call
+
+
+model_service = _Offloaded(_model_service)
+diagram_service = _Offloaded(_diagram_service)
+history_service = _Offloaded(_history_service)
+
+metrics.collect('offload_calls_in_progress', lambda: {(): _queued},
+                'Service calls of the asyncio server running on or waiting for the thread pool')
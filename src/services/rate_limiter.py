@@ -0,0 +1,76 @@
+from __future__ import annotations
+
+import time
+from threading import Lock
+from typing import Dict, Optional, Tuple
+
+import settings
+from src.util import metrics
+
+# socket event -> the class whose token bucket it draws from, events not listed are not limited
+EVENT_CLASSES = {
+    'update_model_rep': 'geometry',
+    'create_model': 'edit',
+    'add_model': 'edit',
+    'delete_model': 'edit',
+    'delete_model_rep': 'edit',
+    'add_model_attribute': 'edit',
+    'remove_model_attribute': 'edit',
+    'update_model_attribute': 'edit',
+    'create_model_relation': 'edit',
+    'update_model_relation': 'edit',
+    'remove_model_relation': 'edit',
+    'batch_ops': 'batch',
+    'join_diagram': 'load',
+    'get_model_reps': 'read',
+    'set_viewport': 'read',
+    'resync_model': 'read',
+    'get_model_history': 'read',
+}
+
+
+class _Bucket:
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, burst: float):
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+
+_lock = Lock()
+# sid -> event class -> bucket
+_buckets: Dict[str, Dict[str, _Bucket]] = {}
+
+
+def acquire(sid: str, event: str) -> Optional[float]:
+    """
+    takes a token for the event, returns None when the client may go on,
+    otherwise the seconds until its next token
+    """
+    event_class = EVENT_CLASSES.get(event)
+    limit: Optional[Tuple[float, float]] = settings.RATE_LIMITS.get(event_class)
+    if limit is None:
+        return None
+    rate, burst = limit
+    now = time.monotonic()
+    with _lock:
+        buckets = _buckets.setdefault(sid, {})
+        bucket = buckets.get(event_class)
+        if bucket is None:
+            bucket = buckets[event_class] = _Bucket(burst)
+        bucket.tokens = min(burst, bucket.tokens + (now - bucket.updated) * rate)
+        bucket.updated = now
+        if bucket.tokens >= 1:
+            bucket.tokens -= 1
+            return None
+        retry_after = (1 - bucket.tokens) / rate
+    metrics.inc('socket_events_throttled_total', event_class=event_class)
+    return retry_after
+
+
+def forget(sid: str) -> None:
+    with _lock:
+        _buckets.pop(sid, None)
+
+
+metrics.describe('socket_events_throttled_total', 'Socket events refused because the client exceeded its rate limit')
@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+import time
+import uuid
+from collections import deque
+from threading import Lock
+from typing import Deque, Dict, List, Optional, Tuple, Union
+
+import settings
+from src.services import diagram_cache
+from src.util import metrics
+
+# room broadcasts that change diagram state, these are numbered and kept for resuming clients
+LOGGED_EVENTS = ('model_added', 'model_patched', 'model_rep_patched', 'model_reps_moved',
+                 'model_deleted', 'model_rep_deleted', 'batch_applied')
+
+# payload format -> payload as it was sent, a plain dict for events sent the same way to every format
+Payloads = Dict[str, Union[str, bytes, dict]]
+
+
+class _Op:
+    __slots__ = ('seq', 'event', 'payloads', 'origin')
+
+    def __init__(self, seq: int, event: str, payloads: Payloads, origin: Optional[Tuple[str, int]]):
+        self.seq = seq
+        self.event = event
+        self.payloads = payloads
+        self.origin = origin
+
+
+class _RoomLog:
+    __slots__ = ('id', 'seq', 'ops', 'origins', 'last_append')
+
+    def __init__(self):
+        # a new id whenever numbering starts over, so a client never resumes against another log's numbers
+        self.id = uuid.uuid4().hex
+        self.seq = 0
+        self.ops: Deque[_Op] = deque()
+        # (host id, seq) of an op another worker broadcast -> the op, for its other payload formats
+        self.origins: Dict[Tuple[str, int], _Op] = {}
+        self.last_append = time.monotonic()
+
+
+_lock = Lock()
+_logs: Dict[str, _RoomLog] = {}
+_resumed = 0
+_reloaded = 0
+
+
+def append(room: str, event: str, payloads: Payloads, origin: Tuple[str, int] = None) -> int:
+    """
+    returns the sequence number of the op; origin identifies an op numbered by another worker, whose
+    payload formats arrive one by one and share a number here
+    """
+    with _lock:
+        log = __log(room)
+        log.last_append = time.monotonic()
+        op = log.origins.get(origin) if origin is not None else None
+        if op is not None:
+            op.payloads.update(payloads)
+            return op.seq
+        log.seq += 1
+        op = _Op(log.seq, event, dict(payloads), origin)
+        log.ops.append(op)
+        if origin is not None:
+            log.origins[origin] = op
+        while len(log.ops) > settings.ROOM_LOG_SIZE:
+            dropped = log.ops.popleft()
+            if dropped.origin is not None:
+                log.origins.pop(dropped.origin, None)
+        return op.seq
+
+
+def position(room: str) -> dict:
+    """
+    what a client has seen once it loaded the room now, to be sent back as logId / lastSeq on rejoin
+    """
+    with _lock:
+        log = __log(room)
+        return {'logId': log.id, 'seq': log.seq}
+
+
+def since(room: str, log_id: str, last_seq: int) -> Optional[List[Tuple[int, str, Payloads]]]:
+    """
+    the ops after last_seq, None when they are no longer all in the buffer and the client has to reload
+    """
+    global _resumed, _reloaded
+    with _lock:
+        log = _logs.get(room)
+        oldest = log.ops[0].seq if log is not None and log.ops else None
+        if log is None or log.id != log_id or last_seq > log.seq \
+                or (oldest is not None and last_seq + 1 < oldest):
+            _reloaded += 1
+            return None
+        _resumed += 1
+        return [(op.seq, op.event, op.payloads) for op in log.ops if op.seq > last_seq]
+
+
+def __log(room: str) -> _RoomLog:
+    __evict_idle()
+    log = _logs.get(room)
+    if log is None:
+        log = _logs[room] = _RoomLog()
+    return log
+
+
+def __evict_idle() -> None:
+    # a room with members keeps its log, they are counting on its numbers
+    deadline = time.monotonic() - settings.ROOM_LOG_TTL
+    idle = [k for k, log in _logs.items() if log.last_append < deadline]
+    if idle:
+        members = diagram_cache.members()
+        for key in idle:
+            if key not in members:
+                del _logs[key]
+
+
+metrics.collect('room_log_resumed_total', lambda: {(): _resumed}, 'Rejoins served by replaying the room log', 'counter')
+metrics.collect('room_log_reloaded_total', lambda: {(): _reloaded},
+                'Rejoins that had to reload the diagram because the room log did not reach back far enough',
+                'counter')
@@ -0,0 +1,160 @@
+from __future__ import annotations
+
+from threading import Lock
+from typing import Dict, Iterable, List, Optional, Set, Union
+
+from bpr_data.models.diagram import Diagram
+from bson import ObjectId
+
+from src.util import metrics
+
+# TODO: Move to data module
+MongoId = Union[ObjectId, str]
+
+
+class Connection:
+    """
+    Everything kept per socket, the user document and the diagram stay with the auth service and the room.
+    """
+    __slots__ = ('sid', 'user_id', 'name', 'room', 'format')
+
+    def __init__(self, sid: str, user_id: str, name: str, payload_format: str):
+        self.sid = sid
+        self.user_id = user_id
+        self.name = name
+        self.room: Optional[str] = None
+        self.format = payload_format
+
+
+class _Room:
+    __slots__ = ('diagram', 'members', 'representations')
+
+    def __init__(self, diagram: Diagram):
+        # shared by all members, refreshed by every join
+        self.diagram = diagram
+        self.members: Set[str] = set()
+        # representation id -> model id, for the representations the room's members were sent
+        self.representations: Dict[str, str] = {}
+
+
+_lock = Lock()
+_connections: Dict[str, Connection] = {}
+_rooms: Dict[str, _Room] = {}
+# model id -> active rooms showing it, the reverse of _Room.representations
+_model_rooms: Dict[str, Set[str]] = {}
+
+
+def connect(sid: str, user: dict, payload_format: str) -> Connection:
+    connection = Connection(sid, str(user['_id']), user['name'], payload_format)
+    with _lock:
+        _connections[sid] = connection
+    return connection
+
+
+def connection(sid: str) -> Optional[Connection]:
+    return _connections.get(sid)
+
+
+def disconnect(sid: str) -> Optional[Connection]:
+    """
+    forgets the connection and takes it out of its room, returns it as it was
+    """
+    with _lock:
+        connection = _connections.pop(sid, None)
+    if connection is not None and connection.room is not None:
+        leave(connection.room, sid)
+    return connection
+
+
+def join(diagram: Diagram, sid: str) -> str:
+    """
+    returns the room of the diagram
+    """
+    room = str(diagram.id)
+    with _lock:
+        state = _rooms.get(room)
+        if state is None:
+            state = _rooms[room] = _Room(diagram)
+        state.diagram = diagram
+        state.members.add(sid)
+        connection = _connections.get(sid)
+        if connection is not None:
+            connection.room = room
+    return room
+
+
+def leave(room: str, sid: str) -> None:
+    with _lock:
+        connection = _connections.get(sid)
+        if connection is not None and connection.room == room:
+            connection.room = None
+        state = _rooms.get(room)
+        if state is None:
+            return
+        state.members.discard(sid)
+        if not state.members:
+            for model_id in set(state.representations.values()):
+                __unlink(model_id, room)
+            del _rooms[room]
+
+
+def diagram(room: str) -> Optional[Diagram]:
+    state = _rooms.get(room)
+    return state.diagram if state is not None else None
+
+
+def is_loaded(room: str) -> bool:
+    with _lock:
+        state = _rooms.get(room)
+        return state is not None and bool(state.representations)
+
+
+def add_representations(room: str, representations: Iterable) -> None:
+    """
+    representations are FullModelRepresentations or their dicts
+    """
+    with _lock:
+        state = _rooms.get(room)
+        if state is None:
+            return
+        for representation in representations:
+            if isinstance(representation, dict):
+                rep_id, model_id = str(representation['_id']), str(representation['modelId'])
+            else:
+                rep_id, model_id = str(representation.id), str(representation.modelId)
+            state.representations[rep_id] = model_id
+            _model_rooms.setdefault(model_id, set()).add(room)
+
+
+def remove_representation(representation_id: MongoId) -> None:
+    key = str(representation_id)
+    with _lock:
+        for room, state in _rooms.items():
+            model_id = state.representations.pop(key, None)
+            if model_id is not None and model_id not in state.representations.values():
+                __unlink(model_id, room)
+
+
+def remove_model(model_id: MongoId) -> None:
+    key = str(model_id)
+    with _lock:
+        for room in _model_rooms.pop(key, ()):
+            state = _rooms[room]
+            state.representations = {r: m for r, m in state.representations.items() if m != key}
+
+
+def rooms_for_model(model_id: MongoId) -> List[str]:
+    with _lock:
+        return list(_model_rooms.get(str(model_id), ()))
+
+
+def __unlink(model_id: str, room: str) -> None:
+    rooms = _model_rooms.get(model_id)
+    if rooms is not None:
+        rooms.discard(room)
+        if not rooms:
+            del _model_rooms[model_id]
+
+
+metrics.collect('socket_connections', lambda: {(): len(_connections)}, 'Authenticated socket connections')
+metrics.collect('room_registry_models', lambda: {(): len(_model_rooms)}, 'Models shown in at least one active room')
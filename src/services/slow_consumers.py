@@ -0,0 +1,73 @@
+from __future__ import annotations
+
+from threading import Lock
+from typing import Callable, Dict, List, Optional, Tuple
+
+from src.util import metrics
+
+# room broadcasts that only carry the latest geometry of representations, a lagging client may get them late and merged
+VOLATILE_EVENTS = ('model_rep_patched', 'model_reps_moved')
+
+
+class _Held:
+    __slots__ = ('room', 'geometries', 'seq')
+
+    def __init__(self, room: str):
+        self.room = room
+        # representation id -> latest geometry the client was not sent
+        self.geometries: Dict[str, dict] = {}
+        self.seq: Optional[int] = None
+
+
+_lock = Lock()
+_held: Dict[str, _Held] = {}
+_coalesced = 0
+
+
+def hold(sid: str, room: str, geometries: List[dict], seq: Optional[int]) -> None:
+    """
+    keeps the geometries a lagging client was skipped for, later ones of the same representation replace them
+    """
+    global _coalesced
+    with _lock:
+        held = _held.get(sid)
+        if held is None or held.room != room:
+            held = _held[sid] = _Held(room)
+        for geometry in geometries:
+            rep_id = str(geometry['_id'])
+            if rep_id in held.geometries:
+                _coalesced += 1
+            held.geometries[rep_id] = geometry
+        held.seq = seq if seq is not None else held.seq
+
+
+def release(caught_up: Callable[[str], bool]) -> List[Tuple[str, str, List[dict], Optional[int]]]:
+    """
+    (sid, room, geometries, seq of the last one) for the clients that caught up, they are no longer held
+    """
+    with _lock:
+        ready = [sid for sid in _held if caught_up(sid)]
+        released = [_held.pop(sid) for sid in ready]
+    return [(sid, held.room, list(held.geometries.values()), held.seq) for sid, held in zip(ready, released)]
+
+
+def held() -> int:
+    with _lock:
+        return len(_held)
+
+
+def discard(representation_id: str) -> None:
+    rep_id = str(representation_id)
+    with _lock:
+        for held in _held.values():
+            held.geometries.pop(rep_id, None)
+
+
+def forget(sid: str) -> None:
+    with _lock:
+        _held.pop(sid, None)
+
+
+metrics.collect('slow_consumers_held', lambda: {(): held()}, 'Lagging clients with geometry updates held back')
+metrics.collect('slow_consumer_coalesced_total', lambda: {(): _coalesced},
+                'Geometry updates replaced by a newer one before a lagging client caught up', 'counter')
@@ -0,0 +1,263 @@
+from __future__ import annotations
+
+import sys
+from datetime import datetime
+from typing import Callable, Iterator, List, Optional, Union
+
+from bpr_data.models.model import FullModelRepresentation
+from bpr_data.repository import Collection
+from bson import ObjectId
+from pymongo import ReturnDocument, UpdateMany, UpdateOne
+from pymongo.errors import DocumentTooLarge, DuplicateKeyError, OperationFailure
+
+import settings
+from src.services import write_behind
+from src.util import metrics, mongo
+
+# TODO: Move to data module
+MongoId = Union[ObjectId, str]
+
+# one document per diagram with what joining it returns, so a join is a single read by _id:
+# {_id: diagram id, version, builtAt, stale, modelIds, representationIds,
+#  representations: {representation id: representation}, models: {model id: model without history}}
+SNAPSHOT_COLLECTION = 'diagramSnapshot'
+
+
+class Change:
+    """
+    An update of every snapshot showing a representation or model, with its paths already below that entry.
+    model_service builds them next to its own writes and hands them to write().
+    """
+    __slots__ = ('query', 'update', 'many', 'array_filters')
+
+    def __init__(self, query: dict, update: dict, many: bool = False, array_filters: List[dict] = None):
+        self.query = query
+        self.update = {**update, '$inc': {'version': 1}}
+        self.many = many
+        self.array_filters = array_filters
+
+
+def enabled() -> bool:
+    return settings.DIAGRAM_SNAPSHOTS
+
+
+def load(diagram_id: MongoId) -> Optional[List[dict]]:
+    """
+    the diagram's representations with their models, as the $lookup join returns them, or None when it has
+    no snapshot or a stale one
+    """
+    snapshot = mongo.get_collection(SNAPSHOT_COLLECTION).find_one({'_id': ObjectId(diagram_id)})
+    if snapshot is None:
+        metrics.inc('diagram_snapshot_loads_total', result='missing')
+        return None
+    models = snapshot['models']
+    if snapshot.get('stale') or any(str(r['modelId']) not in models for r in snapshot['representations'].values()):
+        metrics.inc('diagram_snapshot_loads_total', result='stale')
+        return None
+    metrics.inc('diagram_snapshot_loads_total', result='hit')
+    return [{**r, 'model': {**models[str(r['modelId'])], 'history': []}} for r in snapshot['representations'].values()]
+
+
+def load_chunks(diagram_id: MongoId, chunk_size: int,
+                join: Callable[[List[ObjectId]], List[dict]]) -> Optional[Iterator[List[dict]]]:
+    """
+    like load(), reading chunk_size representations and their models at a time, so the whole snapshot is never held;
+    join is called with the representation ids of a chunk whose models the snapshot lacks
+    """
+    collection = mongo.get_collection(SNAPSHOT_COLLECTION)
+    head = collection.find_one({'_id': ObjectId(diagram_id)}, projection={'stale': 1, 'representationIds': 1})
+    if head is None:
+        metrics.inc('diagram_snapshot_loads_total', result='missing')
+        return None
+    if head.get('stale'):
+        metrics.inc('diagram_snapshot_loads_total', result='stale')
+        return None
+    metrics.inc('diagram_snapshot_loads_total', result='hit')
+    return __chunks(ObjectId(diagram_id), head['representationIds'], chunk_size, join)
+
+
+def reserve(diagram_id: MongoId) -> Optional[int]:
+    """
+    marks the diagram's snapshot stale and makes it list the representations and models the diagram shows now, so
+    every change to them from here on increments its version; returns the version to pass to save() after the join,
+    None when another join reserved it at the same time
+    """
+    shown = list(mongo.get_collection(Collection.MODEL_REPRESENTATION).find({'diagramId': ObjectId(diagram_id)},
+                                                                            projection={'modelId': 1}))
+    try:
+        reserved = mongo.get_collection(SNAPSHOT_COLLECTION).find_one_and_update(
+            {'_id': ObjectId(diagram_id)},
+            {'$set': {'stale': True, 'modelIds': list({r['modelId'] for r in shown}),
+                      'representationIds': [r['_id'] for r in shown]},
+             '$setOnInsert': {'representations': {}, 'models': {}},
+             '$inc': {'version': 1}},
+            projection={'version': 1}, upsert=True, return_document=ReturnDocument.AFTER)
+    except DuplicateKeyError:
+        return None
+    return reserved['version']
+
+
+def save(diagram_id: MongoId, joined: List[dict], replaces: int) -> bool:
+    """
+    stores the joined representations as the diagram's snapshot, unless a change was applied to the snapshot
+    since reserve() returned the replaces version; returns whether it was stored
+    """
+    representations = {}
+    models = {}
+    for raw in joined:
+        representations[str(raw['_id'])] = {k: v for k, v in raw.items() if k != 'model'}
+        models[str(raw['modelId'])] = {k: v for k, v in raw['model'].items() if k != 'history'}
+    document = {
+        '_id': ObjectId(diagram_id),
+        'version': replaces + 1,
+        'builtAt': datetime.utcnow(),
+        'stale': False,
+        'modelIds': [ObjectId(i) for i in models],
+        'representationIds': [ObjectId(i) for i in representations],
+        'representations': representations,
+        'models': models,
+    }
+    try:
+        replaced = mongo.get_collection(SNAPSHOT_COLLECTION).replace_one({'_id': document['_id'], 'version': replaces},
+                                                                         document)
+        if replaced.matched_count == 0:
+            return False
+    except (DocumentTooLarge, OperationFailure) as e:
+        print(f'Could not store the snapshot of diagram {diagram_id}: {e!r}', flush=True)
+        return False
+    metrics.inc('diagram_snapshot_builds_total')
+    return True
+
+
+def write(changes: List[Change]) -> None:
+    """
+    applies the changes in order with one bulk write, or journals them when write-behind is on
+    """
+    if not enabled() or not changes:
+        return
+    if write_behind.enabled():
+        for change in changes:
+            journal = write_behind.update_many if change.many else write_behind.update_one
+            journal(SNAPSHOT_COLLECTION, change.query, change.update, change.array_filters)
+        return
+    requests = [(UpdateMany if c.many else UpdateOne)(c.query, c.update, array_filters=c.array_filters)
+                for c in changes]
+    try:
+        mongo.get_collection(SNAPSHOT_COLLECTION).bulk_write(requests, ordered=True)
+    except OperationFailure as e:
+        # most likely a snapshot outgrowing the document size limit, those diagrams go back to the join
+        print(f'Could not update diagram snapshots: {e!r}', flush=True)
+        mongo.get_collection(SNAPSHOT_COLLECTION).update_many(
+            {'$or': [c.query for c in changes]}, {'$set': {'stale': True}})
+
+
+def representation_added(diagram_id: MongoId, representation: FullModelRepresentation) -> List[Change]:
+    raw = {k: v for k, v in representation.as_dict().items() if k != 'model'}
+    model = {k: v for k, v in representation.model.as_dict().items() if k != 'history'}
+    model['version'] = getattr(representation.model, 'version', 0)
+    return [Change({'_id': ObjectId(diagram_id)},
+                   {'$set': {f'representations.{representation.id}': raw, f'models.{representation.model.id}': model},
+                    '$addToSet': {'modelIds': ObjectId(representation.model.id),
+                                  'representationIds': ObjectId(representation.id)}})]
+
+
+def representation_updated(representation_id: MongoId, update: dict, query: dict = None) -> List[Change]:
+    """
+    update and query as model_service applies them to the representation document
+    """
+    prefix = f'representations.{representation_id}.'
+    return [Change({'representationIds': ObjectId(representation_id), **__below(prefix, query or {})},
+                   {operator: __below(prefix, fields) for operator, fields in update.items()})]
+
+
+def model_patched(model_id: MongoId, query: dict, update: dict, version: int) -> List[Change]:
+    """
+    query and update as model_service applied them to the model document, which that took to version;
+    snapshots whose copy of the model is not at the version before are marked stale instead
+    """
+    prefix = f'models.{model_id}.'
+    array_filters = None
+    fields_query = {k: v for k, v in query.items() if k != '_id'}
+    below = {}
+    for operator, fields in update.items():
+        below[operator] = {}
+        for path, value in fields.items():
+            if path.endswith('.$'):
+                # the positional operator would match within modelIds, the array this query filters on first
+                field = path[:-len('.$')]
+                array_filters = [{'item._id': fields_query[f'{field}._id']}]
+                path = f'{field}.$[item]'
+            below[operator][prefix + path] = value
+    below['$set'] = {**below.get('$set', {}), f'{prefix}version': version}
+    previous = version - 1 if version - 1 else {'$in': [0, None]}
+    return [
+        Change({'modelIds': ObjectId(model_id), f'{prefix}version': previous, **__below(prefix, fields_query)},
+               below, many=True, array_filters=array_filters),
+        Change({'modelIds': ObjectId(model_id), f'{prefix}version': {'$not': {'$gte': version}}},
+               {'$set': {'stale': True}}, many=True),
+    ]
+
+
+def models_stale(model_ids: List[MongoId]) -> List[Change]:
+    if not model_ids:
+        return []
+    return [Change({'modelIds': {'$in': [ObjectId(i) for i in model_ids]}}, {'$set': {'stale': True}}, many=True)]
+
+
+def model_removed(model_id: MongoId, representation_ids: List[MongoId]) -> List[Change]:
+    return [Change({'modelIds': ObjectId(model_id)},
+                   {'$unset': {f'models.{model_id}': '', **{f'representations.{i}': '' for i in representation_ids}},
+                    '$pull': {'modelIds': ObjectId(model_id),
+                              'representationIds': {'$in': [ObjectId(i) for i in representation_ids]}}},
+                   many=True)]
+
+
+def representation_removed(representation_id: MongoId) -> List[Change]:
+    # the model stays in the snapshot's models, other representations may show it; load() ignores it otherwise
+    return [Change({'representationIds': ObjectId(representation_id)},
+                   {'$unset': {f'representations.{representation_id}': ''},
+                    '$pull': {'representationIds': ObjectId(representation_id)}})]
+
+
+def relation_representations_removed(representation_ids: List[MongoId],
+                                     relation_ids: List[ObjectId]) -> List[Change]:
+    return [Change({'representationIds': ObjectId(i)},
+                   {'$pull': {f'representations.{i}.relations': {'relationId': {'$in': relation_ids}}}})
+            for i in representation_ids]
+
+
+def __chunks(diagram_id: ObjectId, representation_ids: List[ObjectId], chunk_size: int,
+             join: Callable[[List[ObjectId]], List[dict]]) -> Iterator[List[dict]]:
+    collection = mongo.get_collection(SNAPSHOT_COLLECTION)
+    for start in range(0, len(representation_ids), chunk_size):
+        chunk = representation_ids[start:start + chunk_size]
+        found = collection.find_one({'_id': diagram_id}, projection={f'representations.{i}': 1 for i in chunk})
+        # representations removed since the head was read are gone from the snapshot as well
+        representations = list((found or {}).get('representations', {}).values())
+        if not representations:
+            continue
+        found = collection.find_one({'_id': diagram_id},
+                                    projection={f'models.{r["modelId"]}': 1 for r in representations})
+        models = (found or {}).get('models', {})
+        if any(str(r['modelId']) not in models for r in representations):
+            yield join([r['_id'] for r in representations])
+            continue
+        yield [{**r, 'model': {**models[str(r['modelId'])], 'history': []}} for r in representations]
+
+
+def __below(prefix: str, fields: dict) -> dict:
+    return {prefix + path: value for path, value in fields.items()}
+
+
+metrics.describe('diagram_snapshot_loads_total', 'Diagram snapshot reads by result: hit, stale or missing')
+metrics.describe('diagram_snapshot_builds_total', 'Diagram snapshots stored from the $lookup join')
+
+
+if __name__ == '__main__':
+    # python -m src.services.snapshot_service [diagram id ...], every diagram when none are given
+    from src.services import index_service, model_service
+    index_service.ensure_indexes()
+    diagram_ids = sys.argv[1:] or [str(d['_id']) for d in
+                                   mongo.get_collection(Collection.DIAGRAM).find({}, projection={'_id': 1})]
+    rebuilt = sum(model_service.rebuild_snapshot(diagram_id) for diagram_id in diagram_ids)
+    print(f'Rebuilt {rebuilt} of {len(diagram_ids)} diagram snapshots', flush=True)
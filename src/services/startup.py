@@ -0,0 +1,182 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from threading import Lock
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+import settings
+from src.services import auth_service, diagram_service, index_service, model_service, write_behind
+from src.util import metrics, mongo
+
+# the process counts as started when this module is first imported, which the servers do before anything else
+_started = time.monotonic()
+
+
+class _Step:
+    __slots__ = ('attempts', 'seconds', 'error')
+
+    def __init__(self):
+        self.attempts = 0
+        self.seconds: Optional[float] = None
+        self.error: Optional[str] = None
+
+
+_lock = Lock()
+_steps: Dict[str, _Step] = {}
+_ready_after: Optional[float] = None
+_first_join_seconds: Optional[float] = None
+_joined: Set[str] = set()
+_prewarmed = 0
+
+
+def steps() -> List[Tuple[str, Callable[[], None]]]:
+    """
+    the blocking start-up steps settings enable, in the order they run; auth is warmed apart,
+    as the asyncio server does that on its event loop
+    """
+    enabled = [('mongo', mongo.warm_up)]
+    if settings.ENSURE_INDEXES:
+        enabled.append(('indexes', index_service.ensure_indexes))
+    if settings.VERIFY_QUERY_PLANS:
+        enabled.append(('query_plans', index_service.verify_query_plans))
+    if settings.WRITE_BEHIND:
+        enabled.append(('write_behind', write_behind.replay))
+    if settings.PREWARM_DIAGRAMS or settings.PREWARM_RECENT > 0:
+        enabled.append(('prewarm', prewarm))
+    return enabled
+
+
+def run(sleep: Callable[[float], None]) -> None:
+    """
+    runs every step, retrying each until it succeeds, then marks the process ready
+    """
+    for name, step in [('auth', auth_service.warm_up)] + steps():
+        while not __attempt(name, step):
+            sleep(settings.STARTUP_RETRY_INTERVAL)
+    __ready()
+
+
+async def run_async(offload: Callable[..., Awaitable]) -> None:
+    """
+    run for the asyncio server, with the blocking steps handed to offload
+    """
+    while not await __attempt_async('auth', auth_service.warm_up_async):
+        await asyncio.sleep(settings.STARTUP_RETRY_INTERVAL)
+    for name, step in steps():
+        while not await __attempt_async(name, lambda s=step: offload(s)):
+            await asyncio.sleep(settings.STARTUP_RETRY_INTERVAL)
+    __ready()
+
+
+def prewarm() -> None:
+    """
+    loads PREWARM_DIAGRAMS, then the PREWARM_RECENT most recently edited diagrams, into the diagram cache
+    """
+    global _prewarmed
+    diagram_ids = list(settings.PREWARM_DIAGRAMS)
+    if settings.PREWARM_RECENT > 0:
+        recent = diagram_service.get_recently_active_diagram_ids(settings.PREWARM_RECENT)
+        diagram_ids += [i for i in recent if i not in diagram_ids]
+    for diagram_id in diagram_ids:
+        try:
+            model_service.get_full_model_representations_for_diagram(diagram_id)
+        except Exception as e:
+            # a diagram that cannot be loaded now is loaded by its first join, as without pre-warming
+            print(f'Could not pre-warm diagram {diagram_id}: {e!r}', flush=True)
+            continue
+        _prewarmed += 1
+
+
+def ready() -> bool:
+    return _ready_after is not None
+
+
+def joined(diagram_id: str, elapsed: float) -> None:
+    """
+    records how long a join_diagram took when it is the first one this process served for the diagram
+    """
+    global _first_join_seconds
+    with _lock:
+        if diagram_id in _joined:
+            return
+        _joined.add(diagram_id)
+        if _first_join_seconds is None:
+            _first_join_seconds = elapsed
+    metrics.observe('diagram_first_join_seconds', elapsed)
+
+
+def status() -> dict:
+    with _lock:
+        return {
+            'ready': _ready_after is not None,
+            'uptimeSeconds': time.monotonic() - _started,
+            'timeToReadySeconds': _ready_after,
+            'firstJoinSeconds': _first_join_seconds,
+            'prewarmedDiagrams': _prewarmed,
+            'steps': {name: {'done': step.seconds is not None, 'attempts': step.attempts,
+                             'seconds': step.seconds, 'error': step.error} for name, step in _steps.items()},
+        }
+
+
+def __attempt(name: str, step: Callable[[], None]) -> bool:
+    started = __begin(name)
+    try:
+        step()
+    except Exception as e:
+        return __failed(name, e)
+    return __done(name, started)
+
+
+async def __attempt_async(name: str, step: Callable[[], Awaitable]) -> bool:
+    started = __begin(name)
+    try:
+        await step()
+    except Exception as e:
+        return __failed(name, e)
+    return __done(name, started)
+
+
+def __begin(name: str) -> float:
+    with _lock:
+        _steps.setdefault(name, _Step()).attempts += 1
+    return time.perf_counter()
+
+
+def __failed(name: str, error: Exception) -> bool:
+    with _lock:
+        step = _steps[name]
+        repeated = step.error == repr(error)
+        step.error = repr(error)
+    if not repeated:
+        # once per distinct error rather than every STARTUP_RETRY_INTERVAL while Mongo is down
+        print(f'Start-up step {name} failed, retrying every {settings.STARTUP_RETRY_INTERVAL}s: {error!r}',
+              flush=True)
+    return False
+
+
+def __done(name: str, started: float) -> bool:
+    with _lock:
+        step = _steps[name]
+        step.seconds = time.perf_counter() - started
+        step.error = None
+    return True
+
+
+def __ready() -> None:
+    global _ready_after
+    with _lock:
+        _ready_after = time.monotonic() - _started
+    print(f'Ready after {_ready_after:.2f}s', flush=True)
+
+
+metrics.collect('startup_ready', lambda: {(): 1 if ready() else 0}, 'Whether start-up has finished')
+metrics.collect('startup_time_to_ready_seconds', lambda: {(): _ready_after} if _ready_after is not None else {},
+                'Seconds from process start until start-up finished')
+metrics.collect('startup_step_seconds',
+                lambda: {(('step', k),): s.seconds for k, s in list(_steps.items()) if s.seconds is not None},
+                'Seconds the successful attempt of each start-up step took')
+metrics.collect('startup_prewarmed_diagrams', lambda: {(): _prewarmed}, 'Diagrams loaded before traffic was admitted')
+metrics.collect('first_join_seconds', lambda: {(): _first_join_seconds} if _first_join_seconds is not None else {},
+                'Seconds the first join_diagram served by this process took')
+metrics.describe('diagram_first_join_seconds', 'Seconds the first join_diagram of each diagram in this process took')
@@ -0,0 +1,215 @@
+from __future__ import annotations
+
+import math
+from threading import Lock
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
+
+from bson import ObjectId
+
+import settings
+from src.util import metrics
+
+# TODO: Move to data module
+MongoId = Union[ObjectId, str]
+
+# x, y, w, h in diagram coordinates
+Rect = Tuple[float, float, float, float]
+
+
+class _Grid:
+    """
+    Uniform grid over rectangles, each key is listed in every cell its rectangle touches.
+    """
+    __slots__ = ('cell_size', 'cells', 'rects')
+
+    def __init__(self, cell_size: float):
+        self.cell_size = cell_size
+        self.cells: Dict[Tuple[int, int], Set[str]] = {}
+        self.rects: Dict[str, Rect] = {}
+
+    def put(self, key: str, rect: Rect) -> Optional[Rect]:
+        previous = self.remove(key)
+        self.rects[key] = rect
+        for cell in self.__cells(rect):
+            self.cells.setdefault(cell, set()).add(key)
+        return previous
+
+    def remove(self, key: str) -> Optional[Rect]:
+        rect = self.rects.pop(key, None)
+        if rect is not None:
+            for cell in self.__cells(rect):
+                keys = self.cells.get(cell)
+                keys.discard(key)
+                if not keys:
+                    del self.cells[cell]
+        return rect
+
+    def query(self, rect: Rect) -> Set[str]:
+        found = set()
+        for cell in self.__cells(rect):
+            for key in self.cells.get(cell, ()):
+                if key not in found and _intersects(self.rects[key], rect):
+                    found.add(key)
+        return found
+
+    def __cells(self, rect: Rect):
+        x, y, w, h = rect
+        for cx in range(math.floor(x / self.cell_size), math.floor((x + w) / self.cell_size) + 1):
+            for cy in range(math.floor(y / self.cell_size), math.floor((y + h) / self.cell_size) + 1):
+                yield cx, cy
+
+
+class _Room:
+    __slots__ = ('representations', 'models', 'viewports', 'members')
+
+    def __init__(self):
+        self.representations = _Grid(settings.VIEWPORT_CELL_SIZE)
+        # model id -> ids of its representations in the room
+        self.models: Dict[str, Set[str]] = {}
+        # sid -> viewport grown by VIEWPORT_MARGIN, members without one are sent everything
+        self.viewports = _Grid(settings.VIEWPORT_CELL_SIZE)
+        self.members: Set[str] = set()
+
+
+_lock = Lock()
+_rooms: Dict[str, _Room] = {}
+_skipped = 0
+
+
+def join(room: str, sid: str) -> None:
+    with _lock:
+        _rooms.setdefault(room, _Room()).members.add(sid)
+
+
+def leave(room: str, sid: str) -> None:
+    with _lock:
+        state = _rooms.get(room)
+        if state is None:
+            return
+        state.members.discard(sid)
+        state.viewports.remove(sid)
+        if not state.members:
+            del _rooms[room]
+
+
+def set_viewport(room: str, sid: str, viewport: Optional[dict]) -> Optional[Rect]:
+    """
+    returns the previous viewport, None when the member was sent everything so far
+    """
+    with _lock:
+        state = _rooms.get(room)
+        if state is None:
+            return None
+        if viewport is None:
+            return state.viewports.remove(sid)
+        return state.viewports.put(sid, __grow(rect_of(viewport), settings.VIEWPORT_MARGIN))
+
+
+def index(room: str, representations: Iterable) -> None:
+    """
+    representations are FullModelRepresentations or their dicts
+    """
+    with _lock:
+        state = _rooms.get(room)
+        if state is None:
+            return
+        for representation in representations:
+            rep_id, model_id = str(__field(representation, '_id')), str(__field(representation, 'modelId'))
+            state.representations.put(rep_id, rect_of(representation))
+            state.models.setdefault(model_id, set()).add(rep_id)
+
+
+def move(room: str, representation_id: MongoId, geometry: dict) -> List[Rect]:
+    """
+    returns where the representation was and where it is now, both matter to the viewers
+    """
+    rect = rect_of(geometry)
+    with _lock:
+        state = _rooms.get(room)
+        if state is None or str(representation_id) not in state.representations.rects:
+            return [rect]
+        previous = state.representations.put(str(representation_id), rect)
+    return [previous, rect]
+
+
+def model_rects(room: str, model_ids: Iterable[MongoId]) -> List[Rect]:
+    with _lock:
+        state = _rooms.get(room)
+        if state is None:
+            return []
+        rep_ids = set().union(*(state.models.get(str(m), ()) for m in model_ids))
+        return [state.representations.rects[r] for r in rep_ids]
+
+
+def visible(room: str, viewport: Optional[Rect]) -> Optional[Set[str]]:
+    """
+    ids of the representations within a viewport as returned by set_viewport, None for no viewport
+    """
+    if viewport is None:
+        return None
+    with _lock:
+        state = _rooms.get(room)
+        return state.representations.query(viewport) if state is not None else set()
+
+
+def viewport(room: str, sid: str) -> Optional[Rect]:
+    with _lock:
+        state = _rooms.get(room)
+        return state.viewports.rects.get(sid) if state is not None else None
+
+
+def outside(room: str, rects: List[Rect]) -> List[str]:
+    """
+    sids whose viewport misses all rects; nobody is left out when the rects are unknown
+    """
+    global _skipped
+    if not rects:
+        return []
+    with _lock:
+        state = _rooms.get(room)
+        if state is None or not state.viewports.rects:
+            return []
+        interested = set().union(*(state.viewports.query(r) for r in rects))
+        skipped = [sid for sid in state.viewports.rects if sid not in interested]
+        _skipped += len(skipped)
+        return skipped
+
+
+def remove_representation(representation_id: MongoId) -> None:
+    key = str(representation_id)
+    with _lock:
+        for state in _rooms.values():
+            if state.representations.remove(key) is not None:
+                for rep_ids in state.models.values():
+                    rep_ids.discard(key)
+
+
+def remove_model(model_id: MongoId) -> None:
+    key = str(model_id)
+    with _lock:
+        for state in _rooms.values():
+            for rep_id in state.models.pop(key, ()):
+                state.representations.remove(rep_id)
+
+
+def rect_of(representation) -> Rect:
+    return tuple(float(__field(representation, k)) for k in ('x', 'y', 'w', 'h'))
+
+
+def __field(representation, name: str):
+    if isinstance(representation, dict):
+        return representation[name]
+    return getattr(representation, 'id' if name == '_id' else name)
+
+
+def __grow(rect: Rect, margin: float) -> Rect:
+    x, y, w, h = rect
+    return x - margin, y - margin, w + 2 * margin, h + 2 * margin
+
+
+def _intersects(a: Rect, b: Rect) -> bool:
+    return a[0] <= b[0] + b[2] and b[0] <= a[0] + a[2] and a[1] <= b[1] + b[3] and b[1] <= a[1] + a[3]
+
+
+metrics.collect('viewport_skipped_deliveries_total', lambda: {(): _skipped},
+                'Room broadcasts not sent to a member because they were outside its viewport', 'counter')
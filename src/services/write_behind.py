@@ -0,0 +1,249 @@
+from __future__ import annotations
+
+import os
+import time
+from threading import Lock
+from typing import Any, Callable, Dict, List, Optional, Union
+
+from bpr_data.repository import Collection
+from bson import json_util
+from pymongo import InsertOne, UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError
+
+import settings
+from src.services import diagram_cache
+from src.util import metrics, mongo
+
+DUPLICATE_KEY = 11000
+
+
+class _Entry:
+    __slots__ = ('seq', 'collection', 'request', 'document_id', 'version')
+
+    def __init__(self, seq: int, collection: str, request: Union[InsertOne, UpdateOne, UpdateMany],
+                 document_id=None, version: Optional[int] = None):
+        self.seq = seq
+        self.collection = collection
+        self.request = request
+        # set for updates that move a document to a version, which must match exactly one document
+        self.document_id = document_id
+        self.version = version
+
+
+_lock = Lock()
+# one flush at a time, appends carry on meanwhile
+_flush_lock = Lock()
+_pending: List[_Entry] = []
+_seq = 0
+_journal = None
+_flushed_ops = 0
+_flushes = 0
+
+
+def enabled() -> bool:
+    return settings.WRITE_BEHIND
+
+
+def update_one(collection: Union[Collection, str], query: dict, update: dict,
+               array_filters: List[dict] = None) -> None:
+    """
+    update must be idempotent, a replay after a crash may apply it a second time
+    """
+    __append(collection, {'op': 'update', 'filter': query, 'update': update,
+                          **({'arrayFilters': array_filters} if array_filters else {})})
+
+
+def update_many(collection: Union[Collection, str], query: dict, update: dict,
+                array_filters: List[dict] = None) -> None:
+    """
+    like update_one, for every document the query matches
+    """
+    __append(collection, {'op': 'update_many', 'filter': query, 'update': update,
+                          **({'arrayFilters': array_filters} if array_filters else {})})
+
+
+def insert_one(collection: Union[Collection, str], document: dict) -> None:
+    """
+    document must carry its _id, so a replayed insert is dropped as a duplicate key
+    """
+    __append(collection, {'op': 'insert', 'document': document})
+
+
+def pending() -> int:
+    with _lock:
+        return len(_pending)
+
+
+def flush() -> int:
+    """
+    writes the pending operations with one bulk_write per collection, returns how many were written
+    """
+    return __flush(replaying=False)
+
+
+def replay() -> int:
+    """
+    flushes what a previous process journaled but did not get to write, returns how many operations that was
+    """
+    global _seq
+    with _lock:
+        records = __read_journal()
+        # rewritten without what was flushed or cut short, so new entries do not follow a torn line
+        __open_journal('w')
+        for record in records:
+            __write_line(record)
+        _seq = max([r['seq'] for r in records], default=_seq)
+        _pending[:0] = [__entry(r['seq'], r['collection'], r) for r in records]
+    replayed = __flush(replaying=True)
+    if replayed:
+        print(f'Replayed {replayed} journaled writes', flush=True)
+    return replayed
+
+
+def run(sleep: Callable[[float], Any]) -> None:
+    """
+    background loop, flushes every WRITE_BEHIND_INTERVAL seconds or as soon as WRITE_BEHIND_BATCH_SIZE are pending
+    """
+    last_flush = time.monotonic()
+    while True:
+        sleep(min(settings.WRITE_BEHIND_INTERVAL, 0.05))
+        if pending() >= settings.WRITE_BEHIND_BATCH_SIZE \
+                or time.monotonic() - last_flush >= settings.WRITE_BEHIND_INTERVAL:
+            try:
+                flush()
+            except Exception as e:
+                print(f'Write-behind flush failed, retrying: {e!r}', flush=True)
+            last_flush = time.monotonic()
+
+
+def stats() -> dict:
+    with _lock:
+        return {'pending': len(_pending), 'flushed': _flushed_ops, 'flushes': _flushes}
+
+
+def __flush(replaying: bool) -> int:
+    global _flushed_ops, _flushes
+    with _flush_lock:
+        with _lock:
+            batch = list(_pending)
+        if not batch:
+            return 0
+        started = time.perf_counter()
+        by_collection: Dict[str, List[_Entry]] = {}
+        for entry in batch:
+            by_collection.setdefault(entry.collection, []).append(entry)
+        for collection, entries in by_collection.items():
+            matched = __bulk_write(collection, [e.request for e in entries])
+            versioned = [e for e in entries if e.version is not None]
+            if versioned and matched < sum(isinstance(e.request, UpdateOne) for e in entries):
+                __resync(collection, versioned, replaying)
+        metrics.observe('write_behind_flush_seconds', time.perf_counter() - started)
+
+        with _lock:
+            del _pending[:len(batch)]
+            _flushed_ops += len(batch)
+            _flushes += 1
+            if _pending:
+                __write_line({'flushed': batch[-1].seq})
+            else:
+                # nothing left to recover, start the journal over
+                __open_journal('w')
+        return len(batch)
+
+
+def __append(collection: Union[Collection, str], operation: dict) -> None:
+    global _seq
+    name = collection.value if isinstance(collection, Collection) else collection
+    with _lock:
+        _seq += 1
+        entry = __entry(_seq, name, operation)
+        __write_line({'seq': _seq, 'collection': name, **operation})
+        _pending.append(entry)
+
+
+def __entry(seq: int, collection: str, operation: dict) -> _Entry:
+    if operation['op'] == 'insert':
+        return _Entry(seq, collection, InsertOne(operation['document']))
+    request = UpdateMany if operation['op'] == 'update_many' else UpdateOne
+    version = operation['update'].get('$set', {}).get('version') if request is UpdateOne else None
+    return _Entry(seq, collection, request(operation['filter'], operation['update'],
+                                           array_filters=operation.get('arrayFilters')),
+                  operation['filter'].get('_id'), version)
+
+
+def __bulk_write(collection: str, requests: List[Union[InsertOne, UpdateOne, UpdateMany]]) -> int:
+    """
+    returns how many documents the updates matched
+    """
+    # ordered, as later updates of a model are filtered on the version earlier ones set
+    matched = 0
+    while requests:
+        try:
+            return matched + mongo.get_collection(collection).bulk_write(requests, ordered=True).matched_count
+        except BulkWriteError as e:
+            matched += e.details['nMatched']
+            error = e.details['writeErrors'][0]
+            if error['code'] != DUPLICATE_KEY:
+                print(f'Dropping journaled write to {collection}: {error.get("errmsg")}', flush=True)
+                metrics.inc('write_behind_dropped_total', collection=collection)
+            requests = requests[error['index'] + 1:]
+    return matched
+
+
+def __resync(collection: str, entries: List[_Entry], replaying: bool) -> None:
+    # a versioned update matching nothing lost its edit to a write that did not go through the journal, and the
+    # cached copy no longer matches Mongo. The bulk result does not tell which one, so every document the batch
+    # moved is reloaded. A replay expects misses for what reached Mongo before the crash, and only reloads
+    # documents that are not at the version the journal leaves them at
+    expected = {e.document_id: e.version for e in entries}
+    if replaying:
+        found = {d['_id']: d.get('version', 0) for d in mongo.get_collection(collection).find(
+            {'_id': {'$in': list(expected)}}, projection={'version': 1})}
+        expected = {i: v for i, v in expected.items() if found.get(i) != v}
+    if not expected:
+        return
+    print(f'Journaled updates of {collection} matched nothing, reloading {len(expected)} documents', flush=True)
+    metrics.inc('write_behind_unmatched_total', len(expected), collection=collection)
+    for document_id in expected:
+        diagram_cache.evict_model(document_id)
+
+
+def __write_line(record: dict) -> None:
+    if _journal is None:
+        __open_journal('a')
+    _journal.write(json_util.dumps(record, json_options=json_util.RELAXED_JSON_OPTIONS) + '\n')
+    _journal.flush()
+    if settings.WRITE_BEHIND_FSYNC:
+        os.fsync(_journal.fileno())
+
+
+def __open_journal(mode: str) -> None:
+    global _journal
+    if _journal is not None:
+        _journal.close()
+    _journal = open(settings.WRITE_BEHIND_JOURNAL, mode)
+
+
+def __read_journal() -> List[dict]:
+    if not os.path.exists(settings.WRITE_BEHIND_JOURNAL):
+        return []
+    records: List[dict] = []
+    flushed = 0
+    with open(settings.WRITE_BEHIND_JOURNAL) as f:
+        for line in f:
+            try:
+                record = json_util.loads(line)
+            except ValueError:
+                # the line a crash cut short, it was never acknowledged to anyone
+                break
+            if 'flushed' in record:
+                flushed = record['flushed']
+            else:
+                records.append(record)
+    return [r for r in records if r['seq'] > flushed]
+
+
+metrics.collect('write_behind_pending', lambda: {(): pending()}, 'Journaled writes not yet flushed to Mongo')
+metrics.describe('write_behind_flush_seconds', 'Time spent writing one batch of journaled writes')
+metrics.describe('write_behind_dropped_total', 'Journaled writes Mongo rejected')
+metrics.describe('write_behind_unmatched_total', 'Documents reloaded as journaled updates of them matched nothing')
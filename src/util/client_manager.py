@@ -0,0 +1,320 @@
+from __future__ import annotations
+
+import asyncio
+import pickle
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import Client, Listener
+from typing import Callable, List, Tuple
+from urllib.parse import urlparse
+
+import socketio
+from socketio import packet
+from socketio.asyncio_pubsub_manager import AsyncPubSubManager
+
+import settings
+from src.services import diagram_cache, viewport_index, room_log, room_registry
+from src.util import serialization
+
+
+class RoomStateSyncMixin:
+    """
+    Applies room broadcasts published by other workers to this worker's diagram cache,
+    so a room whose members are spread across workers is served the same state everywhere.
+    """
+
+    def _handle_emit(self, message):
+        _sync_remote_emit(self, message)
+        super(RoomStateSyncMixin, self)._handle_emit(message)
+
+
+class EncodeOnceMixin:
+    """
+    Delivers a broadcast published by any worker with one packet encoding, instead of one per recipient.
+    """
+
+    def _handle_emit(self, message):
+        if message.get('callback') is not None:
+            return super(EncodeOnceMixin, self)._handle_emit(message)
+        _emit_encoded_once(self, message['event'], message['data'], message.get('namespace'),
+                           room=message.get('room'), skip_sid=message.get('skip_sid'))
+
+
+class AsyncRoomStateSyncMixin:
+    """
+    RoomStateSyncMixin for the asyncio server's managers.
+    """
+
+    async def _handle_emit(self, message):
+        _sync_remote_emit(self, message)
+        await super(AsyncRoomStateSyncMixin, self)._handle_emit(message)
+
+
+class AsyncEncodeOnceMixin:
+    """
+    EncodeOnceMixin for the asyncio server's managers.
+    """
+
+    async def _handle_emit(self, message):
+        if message.get('callback') is not None:
+            return await super(AsyncEncodeOnceMixin, self)._handle_emit(message)
+        await _emit_encoded_once_async(self, message['event'], message['data'], message.get('namespace'),
+                                       room=message.get('room'), skip_sid=message.get('skip_sid'))
+
+
+class LocalManager(socketio.BaseManager):
+    """
+    The single worker manager, encoding each broadcast once.
+    """
+
+    def emit(self, event, data, namespace, room=None, skip_sid=None, callback=None, **kwargs):
+        if callback is not None:
+            return super(LocalManager, self).emit(event, data, namespace, room=room, skip_sid=skip_sid,
+                                                  callback=callback, **kwargs)
+        _emit_encoded_once(self, event, data, namespace, room=room, skip_sid=skip_sid)
+
+
+class AsyncLocalManager(socketio.AsyncManager):
+    """
+    LocalManager for the asyncio server.
+    """
+
+    async def emit(self, event, data, namespace, room=None, skip_sid=None, callback=None, **kwargs):
+        if callback is not None:
+            return await super(AsyncLocalManager, self).emit(event, data, namespace, room=room, skip_sid=skip_sid,
+                                                             callback=callback, **kwargs)
+        await _emit_encoded_once_async(self, event, data, namespace, room=room, skip_sid=skip_sid)
+
+
+class _LoopbackPeers:
+    """
+    The sockets of loopback://<port>,<port>,...: this process listens on the first free port and publishes to all.
+    Peers authenticate with LOOPBACK_AUTHKEY before anything they send is unpickled.
+    """
+
+    def __init__(self, url: str):
+        if not settings.LOOPBACK_AUTHKEY:
+            raise ValueError('loopback:// needs LOOPBACK_AUTHKEY, a secret shared by its processes')
+        self.ports = [int(p) for p in urlparse(url).netloc.split(',')]
+        self.authkey = settings.LOOPBACK_AUTHKEY.encode()
+        self.peers = {}
+
+    def publish(self, payload: bytes) -> None:
+        for port in self.ports:
+            try:
+                if port not in self.peers:
+                    self.peers[port] = Client(('127.0.0.1', port), authkey=self.authkey)
+                self.peers[port].send_bytes(payload)
+            except (OSError, EOFError):
+                # that worker is not running, its clients are unreachable anyway
+                self.peers.pop(port, None)
+
+    def bind(self) -> Listener:
+        for port in self.ports:
+            try:
+                return Listener(('127.0.0.1', port), authkey=self.authkey)
+            except OSError:
+                continue
+        raise RuntimeError(f'No free loopback port among {self.ports}')
+
+    @staticmethod
+    def accept(listener: Listener, deliver: Callable[[bytes], None], start_task: Callable) -> None:
+        """
+        hands every message a peer publishes to deliver, each peer read by a task start_task starts
+        """
+        while True:
+            start_task(_LoopbackPeers.__receive, listener.accept(), deliver)
+
+    @staticmethod
+    def __receive(connection, deliver: Callable[[bytes], None]) -> None:
+        try:
+            while True:
+                deliver(connection.recv_bytes())
+        except (OSError, EOFError):
+            connection.close()
+
+
+class LoopbackManager(RoomStateSyncMixin, EncodeOnceMixin, socketio.PubSubManager):
+    """
+    Broker-less stand-in for local multi-process runs and tests: every process binds the first
+    free port of loopback://<port>,<port>,... and publishes to all of them over localhost.
+    """
+    name = 'loopback'
+
+    def __init__(self, url, channel='flask-socketio', write_only=False, logger=None):
+        self.loopback = _LoopbackPeers(url)
+        self.received = queue.Queue()
+        super(LoopbackManager, self).__init__(channel=channel, write_only=write_only, logger=logger)
+
+    def _publish(self, data):
+        self.loopback.publish(pickle.dumps(data))
+
+    def _listen(self):
+        self.server.start_background_task(self.loopback.accept, self.loopback.bind(), self.received.put,
+                                          self.server.start_background_task)
+        while True:
+            yield self.received.get()
+
+
+class AsyncLoopbackManager(AsyncRoomStateSyncMixin, AsyncEncodeOnceMixin, AsyncPubSubManager):
+    """
+    LoopbackManager for the asyncio server, interchangeable with it on the same ports: the sockets block, so
+    threads read them and hand the messages to the event loop, and one thread publishes.
+    """
+    name = 'loopback'
+
+    def __init__(self, url, channel='flask-socketio', write_only=False, logger=None):
+        self.loopback = _LoopbackPeers(url)
+        self.received = None
+        # a single thread, so two publishes never interleave on a peer's socket
+        self.publisher = ThreadPoolExecutor(max_workers=1, thread_name_prefix='loopback')
+        super(AsyncLoopbackManager, self).__init__(channel=channel, write_only=write_only, logger=logger)
+
+    async def _publish(self, data):
+        await asyncio.get_running_loop().run_in_executor(self.publisher, self.loopback.publish, pickle.dumps(data))
+
+    async def _listen(self):
+        if self.received is None:
+            self.received = asyncio.Queue()
+            loop = asyncio.get_running_loop()
+            _start_thread(self.loopback.accept, self.loopback.bind(),
+                          lambda message: loop.call_soon_threadsafe(self.received.put_nowait, message), _start_thread)
+        return await self.received.get()
+
+
+def create_client_manager(url: str, channel: str = 'flask-socketio') -> socketio.BaseManager:
+    """
+    returns a LocalManager for a single in-process worker
+    """
+    if not url:
+        return LocalManager()
+    if url.startswith('loopback://'):
+        return LoopbackManager(url, channel=channel)
+    if url.startswith(('redis://', 'rediss://')):
+        base = socketio.RedisManager
+    elif url.startswith('kafka://'):
+        base = socketio.KafkaManager
+    elif url.startswith('zmq'):
+        base = socketio.ZmqManager
+    else:
+        base = socketio.KombuManager
+    manager_class = type(f'RoomStateSync{base.__name__}', (RoomStateSyncMixin, EncodeOnceMixin, base), {})
+    return manager_class(url, channel=channel)
+
+
+def create_async_client_manager(url: str, channel: str = 'flask-socketio') -> socketio.AsyncManager:
+    """
+    create_client_manager for the asyncio server, which python-socketio has redis and AMQP managers for
+    """
+    if not url:
+        return AsyncLocalManager()
+    if url.startswith('loopback://'):
+        return AsyncLoopbackManager(url, channel=channel)
+    if url.startswith(('redis://', 'rediss://')):
+        base = socketio.AsyncRedisManager
+    elif url.startswith(('amqp://', 'amqps://')):
+        base = socketio.AsyncAioPikaManager
+    else:
+        raise ValueError(f'SOCKETIO_MESSAGE_QUEUE {urlparse(url).scheme}:// has no asyncio manager, '
+                         f'use redis://, amqp:// or loopback://')
+    manager_class = type(f'RoomStateSync{base.__name__}', (AsyncRoomStateSyncMixin, AsyncEncodeOnceMixin, base), {})
+    return manager_class(url, channel=channel)
+
+
+def _emit_encoded_once(manager: socketio.BaseManager, event: str, data, namespace: str,
+                       room: str = None, skip_sid=None) -> None:
+    for eio_sid, encoded_packet in _encoded_sends(manager, event, data, namespace, room, skip_sid):
+        manager.server.eio.send(eio_sid, encoded_packet)
+
+
+async def _emit_encoded_once_async(manager: socketio.AsyncManager, event: str, data, namespace: str,
+                                   room: str = None, skip_sid=None) -> None:
+    # the asyncio engine.io sends are coroutines
+    for eio_sid, encoded_packet in _encoded_sends(manager, event, data, namespace, room, skip_sid):
+        await manager.server.eio.send(eio_sid, encoded_packet)
+
+
+def _encoded_sends(manager: socketio.BaseManager, event: str, data, namespace: str, room: str,
+                   skip_sid) -> List[Tuple[str, object]]:
+    # BaseManager.emit without the ack ids, and with the packet encoded before the loop
+    if namespace not in manager.rooms:
+        return []
+    if not isinstance(skip_sid, list):
+        skip_sid = [skip_sid]
+    if isinstance(data, tuple):
+        data = list(data)
+    elif data is not None:
+        data = [data]
+    else:
+        data = []
+    encoded = manager.server.packet_class(packet.EVENT, namespace=namespace, data=[event] + data).encode()
+    if not isinstance(encoded, list):
+        encoded = [encoded]
+    return [(eio_sid, ep) for sid, eio_sid in manager.get_participants(namespace, room) if sid not in skip_sid
+            for ep in encoded]
+
+
+def _start_thread(target: Callable, *args) -> None:
+    threading.Thread(target=target, args=args, daemon=True).start()
+
+
+def _sync_remote_emit(manager, message: dict) -> None:
+    if message.get('host_id') != manager.host_id and message.get('room'):
+        data = message['data']
+        if message['event'] in room_log.LOGGED_EVENTS and isinstance(data, (tuple, list)):
+            # (payload, seq) numbered by the sending worker, renumbered in this worker's room log
+            message['data'] = data = (data[0], _log_remote(message, data[0], data[1]))
+        try:
+            _sync_room_state(message['room'], message['event'], data[0] if isinstance(data, tuple) else data)
+        except Exception as e:
+            print(f'Could not sync room state for {message["event"]}: {e!r}', flush=True)
+
+
+def _log_remote(message: dict, payload, seq: int) -> int:
+    room, _, payload_format = message['room'].partition('/')
+    if payload_format:
+        payloads = {payload_format: payload}
+    else:
+        payloads = {f: payload for f in serialization.enabled_formats()}
+    return room_log.append(room, message['event'], payloads, origin=(message['host_id'], seq))
+
+
+def _sync_room_state(room: str, event: str, data) -> None:
+    # a broadcast to the format sub-rooms (<diagram id>/<format>) arrives once per format, apply it once
+    room, _, payload_format = room.partition('/')
+    if payload_format and payload_format != serialization.enabled_formats()[0]:
+        return
+    if isinstance(data, (str, bytes)):
+        data = serialization.decode(data)
+    _apply_room_event(room, event, data)
+
+
+def _apply_room_event(room: str, event: str, data) -> None:
+    if event == 'batch_applied':
+        for op in data['ops']:
+            _apply_room_event(room, op['event'], op['data'])
+        for model_id in data['resync']:
+            diagram_cache.evict_model(model_id)
+    elif event == 'model_patched':
+        # sent to each room showing the model, so a worker with several of them gets it more than once
+        diagram_cache.apply_model_patch(data, only_newer=True)
+    elif event == 'model_rep_patched':
+        diagram_cache.update_geometry(data['_id'], {k: v for k, v in data.items() if k != '_id'})
+        viewport_index.move(room, data['_id'], data)
+    elif event == 'model_reps_moved':
+        for geometry in data:
+            diagram_cache.update_geometry(geometry['_id'], {k: v for k, v in geometry.items() if k != '_id'})
+            viewport_index.move(room, geometry['_id'], geometry)
+    elif event == 'model_rep_deleted':
+        diagram_cache.remove_representation(data['modelRepId'])
+        viewport_index.remove_representation(data['modelRepId'])
+        room_registry.remove_representation(data['modelRepId'])
+    elif event == 'model_deleted':
+        diagram_cache.remove_model(data['modelId'])
+        viewport_index.remove_model(data['modelId'])
+        room_registry.remove_model(data['modelId'])
+    elif event == 'model_added':
+        diagram_cache.evict(room)
+        viewport_index.index(room, [data])
+        room_registry.add_representations(room, [data])
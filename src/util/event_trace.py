@@ -0,0 +1,36 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import time
+from threading import Lock
+from typing import Optional, TextIO
+
+
+class EventTrace:
+    """
+    Appends every incoming socket event as one JSON line: seconds since the trace started, an opaque
+    client key, the event name and its arguments. bench/run.py --replay plays such a file back.
+    """
+
+    def __init__(self, path: str):
+        self.__file: TextIO = open(path, 'a', buffering=1)
+        self.__started = time.monotonic()
+        self.__lock = Lock()
+
+    def record(self, sid: str, event: str, args: tuple) -> None:
+        if event == 'connect':
+            # the connect arguments are the WSGI environ, which holds the Authorization header
+            args = ()
+        line = json.dumps({
+            't': round(time.monotonic() - self.__started, 6),
+            'client': hashlib.sha1(sid.encode()).hexdigest()[:12],
+            'event': event,
+            'args': list(args)
+        }, default=str)
+        with self.__lock:
+            self.__file.write(line + '\n')
+
+
+def open_trace(path: Optional[str]) -> Optional[EventTrace]:
+    return EventTrace(path) if path else None
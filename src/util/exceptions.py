@@ -21,3 +21,15 @@ class MissingPropertyException(Exception):
     def __init__(self, prop):
         self.prop = prop
         super(MissingPropertyException, self).__init__(f'Missing property: {self.prop}')
+
+
+class AuthenticationException(Exception):
+    def __init__(self, status_code):
+        self.status_code = status_code
+        super(AuthenticationException, self).__init__(f'Authentication failed with status: {self.status_code}')
+
+
+class QueryPlanException(Exception):
+    def __init__(self, access_paths):
+        self.access_paths = access_paths
+        super(QueryPlanException, self).__init__(f'Collection scan on: {", ".join(self.access_paths)}')
@@ -0,0 +1,160 @@
+from __future__ import annotations
+
+import random
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+from typing import Callable, Dict, Iterator, List, Tuple
+
+from pymongo import monitoring
+
+import settings
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BYTES_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+_lock = Lock()
+_histograms: Dict[str, Dict[Labels, Histogram]] = {}
+_counters: Dict[str, Dict[Labels, float]] = {}
+# name -> (type, callable returning {labels: value}), evaluated on scrape
+_collected: Dict[str, Tuple[str, Callable[[], Dict[Labels, float]]]] = {}
+_help: Dict[str, str] = {}
+
+
+def observe(name: str, value: float, buckets: Tuple[float, ...] = SECONDS_BUCKETS, **labels) -> None:
+    key = tuple(sorted(labels.items()))
+    with _lock:
+        series = _histograms.setdefault(name, {})
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = Histogram(buckets)
+        histogram.observe(value)
+
+
+def inc(name: str, amount: float = 1, **labels) -> None:
+    key = tuple(sorted(labels.items()))
+    with _lock:
+        series = _counters.setdefault(name, {})
+        series[key] = series.get(key, 0) + amount
+
+
+def collect(name: str, collector: Callable[[], Dict[Labels, float]], description: str, kind: str = 'gauge') -> None:
+    """
+    for values another module already keeps, such as cache statistics; kind is 'gauge' or 'counter'
+    """
+    _collected[name] = (kind, collector)
+    _help[name] = description
+
+
+def describe(name: str, description: str) -> None:
+    _help[name] = description
+
+
+def payload(event: str, data) -> None:
+    if isinstance(data, dict):
+        # a compressed payload, {'encoding': 'zlib', 'data': <bytes>}
+        data = data.get('data')
+    if isinstance(data, (str, bytes)):
+        observe('socket_payload_bytes', len(data), BYTES_BUCKETS, event=event)
+
+
+@contextmanager
+def timed(name: str, **labels) -> Iterator[None]:
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_duration(name, time.perf_counter() - started, **labels)
+
+
+def observe_duration(name: str, elapsed: float, **labels) -> None:
+    """
+    like observe, and hands durations above SLOW_EVENT_SECONDS to the sampled slow log
+    """
+    observe(name, elapsed, **labels)
+    if settings.SLOW_EVENT_SECONDS and elapsed >= settings.SLOW_EVENT_SECONDS \
+            and random.random() < settings.SLOW_EVENT_SAMPLE_RATE:
+        print(f'Slow {name} {labels}: {elapsed * 1000:.1f} ms', flush=True)
+
+
+def render() -> str:
+    """
+    Prometheus text exposition format
+    """
+    lines: List[str] = []
+    with _lock:
+        for name, series in sorted(_counters.items()):
+            __header(lines, name, 'counter')
+            for labels, value in series.items():
+                lines.append(f'{name}{__labels(labels)} {value}')
+        for name, series in sorted(_histograms.items()):
+            __header(lines, name, 'histogram')
+            for labels, histogram in series.items():
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{__labels(labels + (("le", str(bound)),))} {cumulative}')
+                lines.append(f'{name}_sum{__labels(labels)} {histogram.sum}')
+                lines.append(f'{name}_count{__labels(labels)} {histogram.count}')
+    for name, (kind, collector) in sorted(_collected.items()):
+        __header(lines, name, kind)
+        for labels, value in collector().items():
+            lines.append(f'{name}{__labels(labels)} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def __header(lines: List[str], name: str, kind: str) -> None:
+    if name in _help:
+        lines.append(f'# HELP {name} {_help[name]}')
+    lines.append(f'# TYPE {name} {kind}')
+
+
+def __labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{__escape(v)}"' for k, v in labels) + '}'
+
+
+def __escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class _MongoCommandListener(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        observe_duration('mongo_command_seconds', event.duration_micros / 1e6, command=event.command_name)
+
+    def failed(self, event):
+        observe_duration('mongo_command_seconds', event.duration_micros / 1e6, command=event.command_name)
+        inc('mongo_command_failures_total', command=event.command_name)
+
+
+# registered globally, so it only sees clients created after this module is imported, see app.py
+monitoring.register(_MongoCommandListener())
+
+describe('socket_event_seconds', 'Time spent handling an incoming socket event')
+describe('socket_payload_bytes', 'Size of outgoing socket payloads')
+describe('mongo_command_seconds', 'Round trip time of Mongo commands')
+describe('mongo_command_failures_total', 'Failed Mongo commands')
+describe('auth_upstream_seconds', 'Round trip time of the REST /users call')
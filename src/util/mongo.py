@@ -0,0 +1,56 @@
+from __future__ import annotations
+
+from threading import Lock
+from typing import Union
+
+from bpr_data.repository import Collection, Repository
+from pymongo import MongoClient
+from pymongo.collection import Collection as MongoCollection
+from pymongo.database import Database
+
+import settings
+
+
+# bpr_data.Repository only exposes single-document helpers, so operations that need
+# update operators, post-images or bulk writes go through this raw pymongo handle
+_client: MongoClient | None = None
+_repository: Repository | None = None
+# the asyncio server's thread pool and the write-behind thread may ask for a client at once, each gets the same one
+_lock = Lock()
+
+
+def get_database() -> Database:
+    global _client
+    conn = settings.MONGO_CONN
+    if _client is None:
+        with _lock:
+            if _client is None:
+                _client = MongoClient(
+                    f'{conn["protocol"]}://{conn["user"]}:{conn["pw"]}@{conn["host"]}/{conn["default_db"]}'
+                    f'?retryWrites=true&w=majority')
+    return _client[conn['default_db']]
+
+
+def get_collection(collection: Union[Collection, str]) -> MongoCollection:
+    name = collection.value if isinstance(collection, Collection) else collection
+    return get_database()[name]
+
+
+def get_repository() -> Repository:
+    """
+    the bpr_data repository, created on first use rather than when the services are imported
+    """
+    global _repository
+    if _repository is None:
+        with _lock:
+            if _repository is None:
+                _repository = Repository.get_instance(**settings.MONGO_CONN)
+    return _repository
+
+
+def warm_up() -> None:
+    """
+    creates both clients and waits for a round trip to the server, raises when it cannot be reached
+    """
+    get_repository()
+    get_database().command('ping')
@@ -0,0 +1,166 @@
+from __future__ import annotations
+
+import json
+import time
+import zlib
+from datetime import datetime
+from threading import Lock
+from typing import Any, Dict, Iterable, Optional, Union
+
+import settings
+from src.util import metrics
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+JSON = 'json'
+MSGPACK = 'msgpack'
+ZLIB = 'zlib'
+
+_lock = Lock()
+_compressed = 0
+_input_bytes = 0
+_output_bytes = 0
+_seconds = 0.0
+
+
+def available_formats() -> tuple:
+    return (JSON, MSGPACK) if msgpack is not None else (JSON,)
+
+
+def enabled_formats() -> list:
+    """
+    PAYLOAD_FORMATS that can be encoded here, the first one is the default;
+    with PAYLOAD_COMPRESSION each is followed by its compressed variant, <format>+zlib
+    """
+    formats = [f for f in settings.PAYLOAD_FORMATS if f in available_formats()] or [JSON]
+    if settings.PAYLOAD_COMPRESSION != ZLIB:
+        return formats
+    return [v for f in formats for v in (f, f'{f}+{ZLIB}')]
+
+
+def negotiate(requested_format: Optional[str], requested_compression: Optional[str]) -> str:
+    """
+    the enabled format closest to what a client asked for at connect
+    """
+    formats = enabled_formats()
+    payload_format = requested_format if requested_format in formats else formats[0]
+    compressed = f'{payload_format}+{requested_compression}'
+    return compressed if compressed in formats else payload_format
+
+
+def encode(data: Any, payload_format: str = JSON) -> Union[str, bytes, dict]:
+    """
+    json gives a str, as SerializableObject.as_json does; msgpack gives bytes, which Socket.IO
+    sends as a binary attachment instead of JSON-encoding it again per recipient;
+    a +zlib format compresses either above COMPRESSION_THRESHOLD
+    """
+    base, _, compression = payload_format.partition('+')
+    payload = __encode(to_plain(data), base)
+    return compress(payload) if compression == ZLIB else payload
+
+
+def encode_all(data: Any, formats: Iterable[str] = None) -> Dict[str, Union[str, bytes, dict]]:
+    """
+    format -> payload for a broadcast, each base format encoded once and compressed from that encoding
+    """
+    plain = to_plain(data)
+    encoded = {}
+    payloads = {}
+    for payload_format in formats or enabled_formats():
+        base, _, compression = payload_format.partition('+')
+        if base not in encoded:
+            encoded[base] = __encode(plain, base)
+        payloads[payload_format] = compress(encoded[base]) if compression == ZLIB else encoded[base]
+    return payloads
+
+
+def compress(payload: Union[str, bytes]) -> Union[str, bytes, dict]:
+    """
+    payloads of COMPRESSION_THRESHOLD bytes and more become {'encoding': 'zlib', 'data': <deflated bytes>},
+    sent as one binary attachment; smaller ones, and those deflate does not shrink, are returned as they are
+    """
+    global _compressed, _input_bytes, _output_bytes, _seconds
+    if len(payload) < settings.COMPRESSION_THRESHOLD:
+        return payload
+    raw = payload.encode() if isinstance(payload, str) else payload
+    started = time.perf_counter()
+    deflated = zlib.compress(raw, settings.COMPRESSION_LEVEL)
+    elapsed = time.perf_counter() - started
+    with _lock:
+        _compressed += 1
+        _input_bytes += len(raw)
+        _output_bytes += len(deflated)
+        _seconds += elapsed
+    metrics.observe('payload_compression_seconds', elapsed)
+    if len(deflated) >= len(raw):
+        return payload
+    return {'encoding': ZLIB, 'data': deflated}
+
+
+def compression_stats() -> dict:
+    with _lock:
+        return {
+            'payloads': _compressed,
+            'input_bytes': _input_bytes,
+            'output_bytes': _output_bytes,
+            'ratio': _input_bytes / _output_bytes if _output_bytes else None,
+            'cpu_seconds': _seconds,
+        }
+
+
+def __encode(plain: Any, payload_format: str) -> Union[str, bytes]:
+    if payload_format == MSGPACK:
+        return msgpack.packb(plain, default=__default, use_bin_type=True)
+    if orjson is not None:
+        return orjson.dumps(plain, default=__default, option=orjson.OPT_NON_STR_KEYS).decode()
+    return json.dumps(plain, default=__default)
+
+
+def to_plain(data: Any) -> Any:
+    # SerializableObjects (dataclasses) become the dicts they are stored as, ObjectIds stay for __default
+    if hasattr(data, 'as_dict'):
+        return data.as_dict()
+    if isinstance(data, (list, tuple)):
+        return [to_plain(d) for d in data]
+    if isinstance(data, dict):
+        return {k: to_plain(v) for k, v in data.items()}
+    return data
+
+
+def __default(value: Any) -> Any:
+    # ObjectId and anything else unknown is stringified, as json.dumps(..., default=str) did
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def decode(payload: Union[str, bytes, dict], payload_format: str = None) -> Any:
+    """
+    payload_format tells a deflated json payload from a deflated msgpack one, plain payloads do without it
+    """
+    if isinstance(payload, dict) and payload.get('encoding') == ZLIB:
+        payload = zlib.decompress(payload['data'])
+        if (payload_format or JSON).partition('+')[0] == JSON:
+            payload = payload.decode()
+    if isinstance(payload, (bytes, bytearray)):
+        return msgpack.unpackb(payload, raw=False)
+    if orjson is not None:
+        return orjson.loads(payload)
+    return json.loads(payload)
+
+
+metrics.collect('payload_compressed_total', lambda: {(): _compressed},
+                'Payloads over COMPRESSION_THRESHOLD deflated', 'counter')
+metrics.collect('payload_compression_input_bytes_total', lambda: {(): _input_bytes},
+                'Bytes of payloads before deflating', 'counter')
+metrics.collect('payload_compression_output_bytes_total', lambda: {(): _output_bytes},
+                'Bytes of payloads after deflating', 'counter')
+metrics.describe('payload_compression_seconds', 'CPU time deflating one payload')
@@ -0,0 +1,75 @@
+import os
+
+# settings reads these when imported, the tests never reach a real server
+for name, value in {'APP_PORT': '5000', 'REST_DOMAIN': 'http://localhost:1', 'MONGO_PROTOCOL': 'mongodb',
+                    'MONGO_DEFAULT_DB': 'test', 'MONGO_PW': 'test', 'MONGO_HOST': 'localhost',
+                    'MONGO_USER': 'test'}.items():
+    os.environ.setdefault(name, value)
+
+import mongomock  # noqa: E402
+import pytest  # noqa: E402
+from pymongo.collection import Collection  # noqa: E402
+
+from src.util import mongo  # noqa: E402
+
+
+class _CountedCollection:
+    """
+    A collection recording (collection, method) for every call that goes to the server.
+    """
+
+    def __init__(self, collection, calls: list):
+        self.__collection = collection
+        self.__calls = calls
+
+    def __getattr__(self, name):
+        attribute = getattr(self.__collection, name)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            result = attribute(*args, **kwargs)
+            if isinstance(result, (Collection, mongomock.Collection)):
+                # with_options and the like only configure the handle
+                return _CountedCollection(result, self.__calls)
+            self.__calls.append((self.__collection.name, name))
+            return result
+
+        return call
+
+
+def _with_positional_projection(find_one_and_update):
+    # mongomock has no positional projection ({'<list>.$': 1}), which model_service reads a replaced list item with
+    def call(self, filter, update, projection=None, **kwargs):
+        fields = [k[:-len('.$')] for k in projection or {} if k.endswith('.$')]
+        if fields:
+            projection = {**{k: v for k, v in projection.items() if not k.endswith('.$')}, **{f: 1 for f in fields}}
+        document = find_one_and_update(self, filter, update, projection=projection, **kwargs)
+        for field in fields if document is not None else []:
+            document[field] = [item for item in document[field] if item['_id'] == filter[f'{field}._id']][:1]
+        return document
+
+    return call
+
+
+@pytest.fixture
+def db(monkeypatch):
+    """
+    an in-memory database behind src.util.mongo
+    """
+    monkeypatch.setattr(mongo, '_client', mongomock.MongoClient())
+    monkeypatch.setattr(mongomock.Collection, 'find_one_and_update',
+                        _with_positional_projection(mongomock.Collection.find_one_and_update))
+    return mongo.get_database()
+
+
+@pytest.fixture
+def round_trips(db, monkeypatch):
+    """
+    the (collection, method) of every Mongo call made from then on, in order
+    """
+    calls = []
+    get_collection = mongo.get_collection
+    monkeypatch.setattr(mongo, 'get_collection', lambda collection: _CountedCollection(get_collection(collection),
+                                                                                       calls))
+    return calls
@@ -0,0 +1,90 @@
+import threading
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import pytest
+
+import settings
+from src.services import auth_service
+from src.util.exceptions import AuthenticationException
+
+
+@pytest.fixture
+def rest(monkeypatch):
+    """
+    stands in for the REST service: records the Authorization header of every request and answers with
+    status[header] (200 when unset) and a user document naming the header
+    """
+    monkeypatch.setattr(auth_service, '_cache', OrderedDict())
+    monkeypatch.setattr(auth_service, '_in_flight', {})
+    monkeypatch.setattr(settings, 'AUTH_CACHE_SIZE', 2)
+    monkeypatch.setattr(settings, 'AUTH_CACHE_TTL', 60.0)
+    calls = SimpleNamespace(headers=[], status={}, release=threading.Event(), started=threading.Event())
+    calls.release.set()
+
+    def post(url, headers, timeout):
+        calls.headers.append(headers['Authorization'])
+        calls.started.set()
+        calls.release.wait()
+        return SimpleNamespace(status_code=calls.status.get(headers['Authorization'], 200),
+                               json=lambda: {'_id': headers['Authorization']})
+
+    monkeypatch.setattr(auth_service._session, 'post', post)
+    return calls
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = SimpleNamespace(value=1000.0)
+    monkeypatch.setattr(auth_service.time, 'monotonic', lambda: now.value)
+    return now
+
+
+def test_a_cached_token_skips_the_request(rest):
+    assert auth_service.authenticate('a') == auth_service.authenticate('a') == {'_id': 'a'}
+    assert rest.headers == ['a']
+
+
+def test_a_token_is_requested_again_after_the_ttl(rest, clock):
+    auth_service.authenticate('a')
+    clock.value += 59
+    auth_service.authenticate('a')
+    clock.value += 2
+    auth_service.authenticate('a')
+
+    assert rest.headers == ['a', 'a']
+
+
+def test_the_least_recently_used_token_is_evicted(rest):
+    for token in ('a', 'b', 'a', 'c', 'a', 'b'):
+        auth_service.authenticate(token)
+
+    # c pushed out b, used before a; b coming back pushed out c
+    assert rest.headers == ['a', 'b', 'c', 'b']
+    assert list(auth_service._cache) == ['a', 'b']
+
+
+def test_concurrent_connections_with_one_token_make_one_request(rest):
+    rest.release.clear()
+    users = []
+    threads = [threading.Thread(target=lambda: users.append(auth_service.authenticate('a'))) for _ in range(8)]
+    threads[0].start()
+    assert rest.started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    rest.release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert rest.headers == ['a']
+    assert users == [{'_id': 'a'}] * 8
+
+
+def test_a_refused_token_is_not_cached(rest):
+    rest.status['a'] = 401
+    for _ in range(2):
+        with pytest.raises(AuthenticationException):
+            auth_service.authenticate('a')
+
+    assert rest.headers == ['a', 'a']
+    assert 'a' not in auth_service._cache
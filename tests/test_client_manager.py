@@ -0,0 +1,90 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from bson import ObjectId
+from socketio import packet
+
+import settings
+from src.services import diagram_cache, model_service
+from src.util import client_manager
+
+
+@pytest.fixture
+def rooms(db, monkeypatch):
+    """
+    two cached diagram rooms showing the same model, as (room ids, model id)
+    """
+    monkeypatch.setattr(diagram_cache, '_rooms', {})
+    monkeypatch.setattr(diagram_cache, '_by_model', {})
+    model_id = db.model.insert_one({'type': 'class', 'path': '/', 'title': 'A', 'version': 3, 'attributes': [],
+                                    'relations': []}).inserted_id
+    diagram_ids = [ObjectId(), ObjectId()]
+    for diagram_id in diagram_ids:
+        db.modelRepresentation.insert_one({'diagramId': diagram_id, 'modelId': model_id, 'x': 0, 'y': 0, 'w': 10,
+                                           'h': 10, 'relations': []})
+        model_service.get_full_model_representations_for_diagram(diagram_id)
+    return [str(i) for i in diagram_ids], model_id
+
+
+def __cached_attributes(room):
+    return [rep.model.attributes for rep in diagram_cache.get(room)]
+
+
+def test_patch_broadcast_to_every_room_applies_once(rooms):
+    room_ids, model_id = rooms
+    patch = {'op': 'attribute_added', 'modelId': str(model_id), 'version': 4, 'item': {'_id': str(ObjectId())}}
+
+    for room in room_ids:
+        client_manager._sync_room_state(room, 'model_patched', patch)
+
+    assert [__cached_attributes(room) for room in room_ids] == [[[patch['item']]], [[patch['item']]]]
+
+
+def test_patches_apply_in_version_order(rooms):
+    room_ids, model_id = rooms
+    items = [{'_id': str(ObjectId())} for _ in range(2)]
+    for room in room_ids:
+        for version, item in zip((4, 5), items):
+            client_manager._sync_room_state(room, 'batch_applied', {
+                'ops': [{'event': 'model_patched',
+                         'data': {'op': 'attribute_added', 'modelId': str(model_id), 'version': version,
+                                  'item': item}}],
+                'resync': []})
+
+    assert __cached_attributes(room_ids[0]) == [items]
+    assert diagram_cache.get_model(model_id).version == 5
+
+
+def test_async_manager_encodes_a_broadcast_once():
+    sent = []
+    encodings = []
+
+    class Packet(packet.Packet):
+        def encode(self):
+            encodings.append(self.data)
+            return super(Packet, self).encode()
+
+    class Eio:
+        def generate_id(self):
+            return str(ObjectId())
+
+        async def send(self, eio_sid, encoded_packet):
+            sent.append((eio_sid, encoded_packet))
+
+    manager = client_manager.create_async_client_manager('')
+    manager.set_server(SimpleNamespace(packet_class=Packet, eio=Eio()))
+    sids = [manager.connect(eio_sid, '/') for eio_sid in ('a', 'b', 'c')]
+
+    asyncio.run(manager.emit('model_patched', ('{}', 4), '/', skip_sid=sids[2]))
+
+    assert encodings == [['model_patched', '{}', 4]]
+    assert sent == [('a', '2["model_patched","{}",4]'), ('b', '2["model_patched","{}",4]')]
+
+
+@pytest.mark.parametrize('create', [client_manager.create_client_manager, client_manager.create_async_client_manager])
+def test_loopback_queue_refuses_to_start_without_a_secret(create, monkeypatch):
+    monkeypatch.setattr(settings, 'LOOPBACK_AUTHKEY', '')
+
+    with pytest.raises(ValueError):
+        create('loopback://7001,7002')
@@ -0,0 +1,48 @@
+from types import SimpleNamespace
+
+import pytest
+from bson import ObjectId
+
+from src.services import diagram_cache
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    """
+    an empty cache, with two rooms showing one model once it is loaded, as (room ids, model id)
+    """
+    for name in ('_rooms', '_by_model', '_members', '_touched'):
+        monkeypatch.setattr(diagram_cache, name, type(getattr(diagram_cache, name))())
+    model = SimpleNamespace(id=ObjectId(), version=1, attributes=[], relations=[])
+    rooms = [str(ObjectId()), str(ObjectId())]
+    for room in rooms:
+        diagram_cache.put(room, [SimpleNamespace(id=ObjectId(), diagramId=room, modelId=model.id, model=model),
+                                 SimpleNamespace(id=ObjectId(), diagramId=room, modelId=ObjectId(), model=None)],
+                          diagram_cache.generation())
+        diagram_cache.add_member(room)
+    return rooms, model.id
+
+
+def test_models_are_found_through_the_index(cache):
+    rooms, model_id = cache
+
+    assert diagram_cache.next_version(model_id) == 2
+    assert len(diagram_cache._by_model[str(model_id)]) == 2
+
+    diagram_cache.remove_member(rooms[0])
+    assert {room for room, _ in diagram_cache._by_model[str(model_id)]} == {rooms[1]}
+    assert diagram_cache.get_model(model_id).version == 2
+
+
+def test_removed_representations_leave_the_index(cache):
+    rooms, model_id = cache
+    other = [r for r in diagram_cache.get(rooms[0]) if r.modelId != model_id][0]
+
+    diagram_cache.remove_representation(other.id)
+    diagram_cache.remove_model(model_id)
+
+    assert str(other.modelId) not in diagram_cache._by_model
+    assert str(model_id) not in diagram_cache._by_model
+    assert diagram_cache.get_model(model_id) is None
+    diagram_cache.evict_model(model_id)
+    assert len(diagram_cache.get(rooms[1])) == 1
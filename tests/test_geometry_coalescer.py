@@ -0,0 +1,68 @@
+from bson import ObjectId
+
+from src.services import model_service
+from src.services.geometry_coalescer import GeometryCoalescer
+
+
+def test_rapid_updates_collapse_into_one_write(db, round_trips):
+    rep_id = db.modelRepresentation.insert_one({'x': 0, 'y': 0, 'w': 10, 'h': 10}).inserted_id
+    broadcasts = []
+    coalescer = GeometryCoalescer(persist=model_service.update_model_reps,
+                                  broadcast=lambda room, geometries: broadcasts.append((room, geometries)))
+
+    for i in range(50):
+        coalescer.submit('room', {'_id': str(rep_id), 'x': i, 'y': 2 * i, 'w': 10, 'h': 10})
+    coalescer.tick()
+    coalescer.flush()
+
+    assert round_trips == [('modelRepresentation', 'bulk_write')]
+    assert db.modelRepresentation.find_one({'_id': rep_id}, projection={'_id': 0, 'geometrySeq': 0}) == \
+        {'x': 49, 'y': 98, 'w': 10, 'h': 10}
+    assert broadcasts == [('room', [{'_id': str(rep_id), 'x': 49, 'y': 98, 'w': 10, 'h': 10}])]
+
+
+def test_flush_without_updates_writes_nothing(db, round_trips):
+    coalescer = GeometryCoalescer(persist=model_service.update_model_reps, broadcast=lambda room, geometries: None)
+    coalescer.submit('room', {'_id': str(ObjectId()), 'x': 1, 'y': 1, 'w': 1, 'h': 1})
+    coalescer.flush()
+    coalescer.flush()
+
+    assert round_trips == [('modelRepresentation', 'bulk_write')]
+
+
+def test_discarded_representation_is_not_written(db, round_trips):
+    rep_id = str(ObjectId())
+    coalescer = GeometryCoalescer(persist=model_service.update_model_reps, broadcast=lambda room, geometries: None)
+    coalescer.submit('room', {'_id': rep_id, 'x': 1, 'y': 1, 'w': 1, 'h': 1})
+    coalescer.discard(rep_id)
+    coalescer.tick()
+    coalescer.flush()
+
+    assert round_trips == []
+
+
+def test_dirty_representations_are_written_with_one_bulk_write(db, round_trips):
+    rep_ids = db.modelRepresentation.insert_many([{'x': 0, 'y': 0, 'w': 10, 'h': 10} for _ in range(3)]).inserted_ids
+    coalescer = GeometryCoalescer(persist=model_service.update_model_reps, broadcast=lambda room, geometries: None)
+    for i, rep_id in enumerate(rep_ids):
+        coalescer.submit('room', {'_id': str(rep_id), 'x': i, 'y': i, 'w': 10, 'h': 10})
+    coalescer.flush()
+
+    assert round_trips == [('modelRepresentation', 'bulk_write')]
+    assert [r['x'] for r in db.modelRepresentation.find({'_id': {'$in': rep_ids}})] == [0, 1, 2]
+
+
+def test_flush_taken_before_the_drag_end_does_not_overwrite_it(db):
+    rep_id = str(db.modelRepresentation.insert_one({'x': 0, 'y': 0, 'w': 10, 'h': 10}).inserted_id)
+
+    def persist(geometries):
+        # the drag ends after the flush took its geometry and before that reaches the server
+        coalescer.discard(rep_id)
+        model_service.update_model_rep({'_id': rep_id, 'x': 99, 'y': 99, 'w': 10, 'h': 10})
+        model_service.update_model_reps(geometries)
+
+    coalescer = GeometryCoalescer(persist=persist, broadcast=lambda room, geometries: None)
+    coalescer.submit('room', {'_id': rep_id, 'x': 1, 'y': 1, 'w': 10, 'h': 10})
+    coalescer.flush()
+
+    assert db.modelRepresentation.find_one({'_id': ObjectId(rep_id)})['x'] == 99
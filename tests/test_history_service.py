@@ -0,0 +1,50 @@
+from bson import ObjectId
+
+from src.services import history_service
+
+
+def _entries(db, model_id, count, timestamp='2021-11-01 10:00:00.000000'):
+    db[history_service.HISTORY_COLLECTION].insert_many(
+        [{'_id': ObjectId(), 'modelId': model_id, 'timestamp': timestamp, 'action': 'x'} for _ in range(count)])
+
+
+def test_pages_through_entries_sharing_a_timestamp(db):
+    model_id = ObjectId()
+    _entries(db, model_id, 120)
+
+    seen = []
+    before = None
+    while True:
+        page = history_service.get_page(model_id, before=before, limit=50)
+        seen += [item['_id'] for item in page['items']]
+        if page['next'] is None:
+            break
+        before = page['next']
+
+    assert len(seen) == 120
+    assert len(set(seen)) == 120
+
+
+def test_pages_are_newest_first(db):
+    model_id = ObjectId()
+    _entries(db, model_id, 2, timestamp='2021-11-01 10:00:00.000000')
+    _entries(db, model_id, 2, timestamp='2021-11-02 10:00:00.000000')
+
+    first = history_service.get_page(model_id, limit=3)
+    second = history_service.get_page(model_id, before=first['next'], limit=3)
+
+    assert [i['timestamp'][:10] for i in first['items']] == ['2021-11-02', '2021-11-02', '2021-11-01']
+    assert [i['timestamp'][:10] for i in second['items']] == ['2021-11-01']
+    assert second['next'] is None
+
+
+def test_migration_cut_short_does_not_duplicate_entries(db):
+    model_id = db.model.insert_one({'history': [{'timestamp': str(i), 'action': 'x'} for i in range(3)]}).inserted_id
+    history_service.migrate_embedded_history()
+    # as if the run had stopped between copying the entries and clearing the array
+    db.model.update_one({'_id': model_id}, {'$set': {'history': [{'timestamp': str(i), 'action': 'x'}
+                                                                 for i in range(3)]}})
+
+    assert history_service.migrate_embedded_history() == 1
+    assert db[history_service.HISTORY_COLLECTION].count_documents({'modelId': model_id}) == 3
+    assert db.model.find_one({'_id': model_id})['history'] == []
@@ -0,0 +1,22 @@
+import pytest
+
+from src.namespaces import shared
+from src.namespaces.main import MainNamespace
+from src.util import metrics
+
+
+def test_unknown_events_share_one_series(monkeypatch):
+    monkeypatch.setattr(metrics, '_histograms', {})
+    namespace = MainNamespace('')
+
+    for event in ('made_up_1', 'made_up_2', 'made_up_3'):
+        namespace.trigger_event(event, 'sid')
+
+    assert list(metrics._histograms['socket_event_seconds']) == [(('event', 'unknown'),)]
+
+
+@pytest.mark.parametrize('data, seq', [({'lastSeq': 7}, 7), ({'lastSeq': '7'}, 7), ({}, None), ({'lastSeq': 'x'}, None),
+                                       ({'lastSeq': None}, None), ({'lastSeq': [7]}, None), ({'lastSeq': -1}, None),
+                                       ({'lastSeq': 7.5}, None), ({'lastSeq': True}, None)])
+def test_a_bad_last_seq_loads_in_full(data, seq):
+    assert shared.last_seq(data) == seq
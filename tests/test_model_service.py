@@ -0,0 +1,210 @@
+from types import SimpleNamespace
+
+import mongomock
+import pytest
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+
+from src.services import model_service
+
+FIELD = {'kind': 'field', 'name': 'id', 'type': 'int', 'accessModifier': 'private'}
+
+
+@pytest.fixture
+def diagram(db):
+    """
+    a diagram showing one model with one attribute and one relation, as (diagram, representation id, model id,
+    attribute id, relation id)
+    """
+    diagram_id, representation_id, model_id, attribute_id, relation_id = (ObjectId() for _ in range(5))
+    db.model.insert_one({'_id': model_id, 'type': 'class', 'path': '/', 'title': 'A', 'version': 3,
+                         'attributes': [{'_id': attribute_id, **FIELD}],
+                         'relations': [{'_id': relation_id, 'target': ObjectId()}]})
+    db.modelRepresentation.insert_one({'_id': representation_id, 'diagramId': diagram_id, 'modelId': model_id,
+                                       'x': 0, 'y': 0, 'w': 10, 'h': 10, 'relations': []})
+    db.diagram.insert_one({'_id': diagram_id, 'projectId': ObjectId(), 'models': [representation_id]})
+    return SimpleNamespace(id=diagram_id, projectId=ObjectId()), representation_id, model_id, attribute_id, relation_id
+
+
+def test_add_attribute_is_one_update_and_its_history(diagram, round_trips, db):
+    _, _, model_id, _, _ = diagram
+    patch = model_service.add_attribute(model_id, ObjectId(), dict(FIELD, name='added'))
+
+    assert round_trips == [('model', 'find_one_and_update'), ('modelHistory', 'insert_many')]
+    assert patch['version'] == 4
+    assert [a['name'] for a in db.model.find_one({'_id': model_id})['attributes']] == ['id', 'added']
+
+
+def test_update_attribute_reads_the_old_item_with_the_update(diagram, round_trips, db):
+    _, _, model_id, attribute_id, _ = diagram
+    patch = model_service.update_attribute(model_id, ObjectId(), dict(FIELD, _id=attribute_id, name='renamed'))
+
+    assert round_trips == [('model', 'find_one_and_update'), ('modelHistory', 'insert_many')]
+    assert patch['version'] == 4
+    history = db.modelHistory.find_one({'modelId': ObjectId(model_id)})
+    assert history['oldItem']['name'] == 'id' and history['newItem']['name'] == 'renamed'
+
+
+def test_remove_attribute_is_one_update_and_its_history(diagram, round_trips):
+    _, _, model_id, attribute_id, _ = diagram
+    model_service.remove_attribute(model_id, attribute_id, ObjectId())
+
+    assert round_trips == [('model', 'find_one_and_update'), ('modelHistory', 'insert_many')]
+
+
+def test_missing_attribute_costs_one_round_trip(diagram, round_trips):
+    _, _, model_id, _, _ = diagram
+    assert model_service.remove_attribute(model_id, ObjectId(), ObjectId()) is None
+    assert round_trips == [('model', 'find_one_and_update')]
+
+
+def test_update_relation_reads_the_old_item_with_the_update(diagram, round_trips):
+    _, _, model_id, _, relation_id = diagram
+    model_service.update_relation(model_id, ObjectId(), {'_id': relation_id, 'target': ObjectId()})
+
+    assert round_trips == [('model', 'find_one_and_update'), ('modelHistory', 'insert_many')]
+
+
+def test_create_relation_writes_model_representation_and_history(diagram, round_trips):
+    _, representation_id, model_id, _, _ = diagram
+    model_service.create_relation(model_id, representation_id, ObjectId(), {'target': ObjectId()})
+
+    assert round_trips == [('model', 'find_one_and_update'), ('modelRepresentation', 'update_one'),
+                           ('modelHistory', 'insert_many')]
+
+
+def test_missing_model_is_none(db):
+    assert model_service.get_model(ObjectId()) is None
+
+
+def test_delete_relation_the_representation_does_not_show_is_none(diagram, round_trips, db):
+    _, representation_id, model_id, _, relation_id = diagram
+
+    assert model_service.delete_relation(model_id, representation_id, relation_id, True, ObjectId()) is None
+    assert round_trips == [('modelRepresentation', 'update_one')]
+    assert len(db.model.find_one({'_id': model_id})['relations']) == 1
+
+
+def test_update_model_rep_is_one_update(diagram, round_trips):
+    _, representation_id, _, _, _ = diagram
+    model_service.update_model_rep({'_id': representation_id, 'x': 1, 'y': 2, 'w': 3, 'h': 4})
+
+    assert round_trips == [('modelRepresentation', 'update_one')]
+
+
+def test_batch_costs_one_write_per_collection(diagram, round_trips):
+    diagram, representation_id, model_id, attribute_id, _ = diagram
+    ops = [{'event': 'update_model_rep', 'args': [{'_id': representation_id, 'x': i, 'y': i, 'w': 1, 'h': 1}]}
+           for i in range(20)]
+    ops += [{'event': 'add_model_attribute', 'args': [{'modelId': model_id}, dict(FIELD, name=f'a{i}')]}
+            for i in range(5)]
+    ops.append({'event': 'remove_model_attribute', 'args': [{'modelId': model_id, 'attributeId': attribute_id}]})
+
+    batch = model_service.apply_batch(ops, diagram, ObjectId())
+
+    assert all(r['ok'] for r in batch.results)
+    assert round_trips == [('model', 'find'), ('model', 'bulk_write'), ('modelRepresentation', 'bulk_write'),
+                           ('modelHistory', 'insert_many')]
+
+
+def test_batch_fails_the_ops_of_a_model_another_writer_changed(diagram, db, monkeypatch):
+    diagram, _, model_id, _, _ = diagram
+    other_id = db.model.insert_one({'type': 'class', 'path': '/', 'title': 'B', 'version': 0, 'attributes': [],
+                                    'relations': []}).inserted_id
+    bulk_write = mongomock.Collection.bulk_write
+
+    def concurrent_bulk_write(collection, requests, **kwargs):
+        if collection.name == 'model':
+            collection.update_one({'_id': model_id}, {'$inc': {'version': 1}})
+        return bulk_write(collection, requests, **kwargs)
+
+    monkeypatch.setattr(mongomock.Collection, 'bulk_write', concurrent_bulk_write)
+    ops = [{'event': 'add_model_attribute', 'args': [{'modelId': i}, dict(FIELD, name=f'a{n}')]}
+           for n, i in enumerate([model_id, other_id, model_id])]
+
+    batch = model_service.apply_batch(ops, diagram, ObjectId())
+
+    assert [r['ok'] for r in batch.results] == [False, True, False]
+    assert batch.resync == [str(model_id)]
+    assert [data['modelId'] for _, data in batch.applied] == [str(other_id)]
+    assert db.modelHistory.distinct('modelId') == [other_id]
+
+
+@pytest.fixture
+def rejected(monkeypatch):
+    """
+    rejected[collection name] = position makes bulk_write reject that request as Mongo would, writing the others
+    """
+    positions = {}
+    bulk_write = mongomock.Collection.bulk_write
+
+    def rejecting_bulk_write(collection, requests, **kwargs):
+        if collection.name not in positions:
+            return bulk_write(collection, requests, **kwargs)
+        position = positions[collection.name]
+        others = [r for p, r in enumerate(requests) if p != position]
+        matched = bulk_write(collection, others, **kwargs).matched_count if others else 0
+        raise BulkWriteError({'writeErrors': [{'index': position, 'code': 121, 'errmsg': 'failed validation'}],
+                              'nMatched': matched})
+
+    monkeypatch.setattr(mongomock.Collection, 'bulk_write', rejecting_bulk_write)
+    return positions
+
+
+def test_batch_fails_the_ops_of_a_rejected_model_update(diagram, db, rejected):
+    diagram, representation_id, model_id, _, _ = diagram
+    ops = [{'event': 'add_model_attribute', 'args': [{'modelId': model_id}, dict(FIELD, name='a')]},
+           {'event': 'create_model', 'args': [{'type': 'class', 'path': '/'}, {'x': 0, 'y': 0, 'w': 1, 'h': 1}]},
+           {'event': 'update_model_rep', 'args': [{'_id': representation_id, 'x': 5, 'y': 5, 'w': 1, 'h': 1}]}]
+    # the insert of create_model goes first, then the update of the patched model
+    rejected['model'] = 1
+
+    batch = model_service.apply_batch(ops, diagram, ObjectId())
+
+    assert [r['ok'] for r in batch.results] == [False, True, True]
+    assert batch.results[0]['error_type'] == 'update_model_error'
+    assert batch.resync == [str(model_id)]
+    assert [event for event, _ in batch.applied] == ['model_added', 'model_rep_patched']
+    assert db.modelHistory.count_documents({'modelId': model_id}) == 0
+    assert len(db.diagram.find_one({'_id': diagram.id})['models']) == 2
+
+
+def test_batch_drops_the_representation_of_a_rejected_model_insert(diagram, db, rejected):
+    diagram, representation_id, model_id, _, _ = diagram
+    ops = [{'event': 'create_model', 'args': [{'type': 'class', 'path': '/'}, {'x': 0, 'y': 0, 'w': 1, 'h': 1}]},
+           {'event': 'update_model_rep', 'args': [{'_id': representation_id, 'x': 5, 'y': 5, 'w': 1, 'h': 1}]}]
+    rejected['model'] = 0
+
+    batch = model_service.apply_batch(ops, diagram, ObjectId())
+
+    assert [r['ok'] for r in batch.results] == [False, True]
+    assert batch.results[0]['error_type'] == 'model_error'
+    assert [event for event, _ in batch.applied] == ['model_rep_patched']
+    assert db.modelRepresentation.count_documents({}) == 1
+    assert db.diagram.find_one({'_id': diagram.id})['models'] == [representation_id]
+
+
+def test_batch_fails_a_rejected_representation_update(diagram, db, rejected):
+    diagram, representation_id, model_id, _, _ = diagram
+    ops = [{'event': 'update_model_rep', 'args': [{'_id': representation_id, 'x': i, 'y': i, 'w': 1, 'h': 1}]}
+           for i in range(3)]
+    rejected['modelRepresentation'] = 2
+
+    batch = model_service.apply_batch(ops, diagram, ObjectId())
+
+    assert [r['ok'] for r in batch.results] == [True, True, False]
+    assert [data['x'] for _, data in batch.applied] == [0, 1]
+
+
+def test_delete_model_deletes_its_history(diagram, db, round_trips):
+    _, _, model_id, attribute_id, _ = diagram
+    model_service.update_attribute(model_id, ObjectId(), dict(FIELD, _id=attribute_id, name='renamed'))
+    model_service.remove_attribute(model_id, attribute_id, ObjectId())
+    del round_trips[:]
+
+    assert model_service.delete_model(model_id) is not None
+
+    assert db.modelHistory.count_documents({'modelId': model_id}) == 0
+    assert round_trips == [('model', 'find_one_and_delete'), ('modelHistory', 'delete_many'),
+                           ('modelRepresentation', 'find'), ('diagram', 'update_many'),
+                           ('modelRepresentation', 'delete_many'), ('modelRepresentation', 'update_many')]
@@ -0,0 +1,94 @@
+import json
+import os
+import secrets
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+import requests
+import socketio
+from bson import ObjectId
+
+from bench import stub_rest
+
+WORKER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'worker.py')
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def workers():
+    """
+    two server processes sharing a loopback message queue, as (url, url), both showing the same diagram
+    """
+    rest = stub_rest.start()
+    ids = [str(ObjectId()) for _ in range(3)]
+    ports = [_free_port() for _ in range(2)]
+    queue_ports = ','.join(str(_free_port()) for _ in range(2))
+    env = {**os.environ, 'REST_DOMAIN': f'http://127.0.0.1:{rest.server_port}', 'ENSURE_INDEXES': 'false',
+           'SOCKETIO_MESSAGE_QUEUE': f'loopback://{queue_ports}', 'LOOPBACK_AUTHKEY': secrets.token_hex(16),
+           'STARTUP_RETRY_INTERVAL': '0.1'}
+    processes = [subprocess.Popen([sys.executable, WORKER, str(port), *ids], env=env,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) for port in ports]
+    try:
+        urls = [f'http://127.0.0.1:{port}' for port in ports]
+        for url, process in zip(urls, processes):
+            __wait_until_ready(url, process)
+        yield urls, ids
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait(10)
+        rest.shutdown()
+
+
+def __wait_until_ready(url: str, process: subprocess.Popen) -> None:
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        assert process.poll() is None, 'worker exited'
+        try:
+            if requests.get(f'{url}/ready', timeout=1).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.1)
+    pytest.fail(f'{url} did not become ready')
+
+
+def _join(url: str, name: str, diagram_id: str) -> socketio.Client:
+    client = socketio.Client()
+    joined = threading.Event()
+    client.on('all_diagram_models', lambda payload: joined.set())
+    client.connect(url, headers={'Authorization': f'Bearer {name}'}, transports=['polling'])
+    client.emit('join_diagram', {'diagramId': diagram_id})
+    assert joined.wait(10), f'{name} did not get the diagram'
+    return client
+
+
+def test_update_on_one_worker_reaches_a_client_on_the_other(workers):
+    (first, second), (diagram_id, representation_id, _) = workers
+    sender = _join(first, 'alice', diagram_id)
+    receiver = _join(second, 'bob', diagram_id)
+    received = []
+    patched = threading.Event()
+
+    def on_patched(payload, seq):
+        received.append(json.loads(payload))
+        patched.set()
+
+    receiver.on('model_rep_patched', on_patched)
+    try:
+        sender.emit('update_model_rep', {'_id': representation_id, 'x': 10, 'y': 20, 'w': 100, 'h': 50})
+
+        assert patched.wait(10), 'the broadcast did not reach the other worker'
+        assert received == [{'_id': representation_id, 'x': 10, 'y': 20, 'w': 100, 'h': 50}]
+    finally:
+        sender.disconnect()
+        receiver.disconnect()
@@ -0,0 +1,17 @@
+import pytest
+
+import settings
+from src.services import rate_limiter
+
+
+@pytest.fixture(autouse=True)
+def limits(monkeypatch):
+    monkeypatch.setattr(settings, 'RATE_LIMITS', {'edit': (4.0, 2.0)})
+    monkeypatch.setattr(rate_limiter, '_buckets', {})
+
+
+def test_the_event_past_the_burst_waits_for_the_next_token(monkeypatch):
+    monkeypatch.setattr(rate_limiter.time, 'monotonic', lambda: 100.0)
+
+    assert [rate_limiter.acquire('sid', 'create_model') for _ in range(3)] == [None, None, 0.25]
+    assert rate_limiter.acquire('sid', 'join_diagram') is None
@@ -0,0 +1,58 @@
+import json
+
+import pytest
+from socketio import packet
+
+import settings
+from bench.serialization import diagram_models
+from src.util import serialization
+
+# a 500 model diagram as all_diagram_models sends it, well over COMPRESSION_THRESHOLD
+DIAGRAM = diagram_models(500)
+
+
+@pytest.fixture(autouse=True)
+def compression(monkeypatch):
+    monkeypatch.setattr(settings, 'PAYLOAD_COMPRESSION', serialization.ZLIB)
+
+
+def __expected():
+    # what json.dumps(..., default=str) made of it before the serializer
+    return json.loads(json.dumps(DIAGRAM, default=lambda v: v.isoformat() if hasattr(v, 'isoformat') else str(v)))
+
+
+def __over_socket_io(payload):
+    # one event packet with its binary attachments, as a client receives it
+    encoded = packet.Packet(packet.EVENT, data=['all_diagram_models', payload]).encode()
+    encoded = encoded if isinstance(encoded, list) else [encoded]
+    received = packet.Packet(encoded_packet=encoded[0])
+    for attachment in encoded[1:]:
+        received.add_attachment(attachment)
+    return received.data[1]
+
+
+@pytest.mark.parametrize('payload_format', serialization.available_formats())
+def test_large_diagram_round_trips_compressed(payload_format):
+    compressed_format = f'{payload_format}+{serialization.ZLIB}'
+    plain = serialization.encode(DIAGRAM, payload_format)
+    compressed = serialization.encode(DIAGRAM, compressed_format)
+
+    assert compressed['encoding'] == serialization.ZLIB
+    assert len(compressed['data']) * 3 < len(plain)
+    assert serialization.decode(__over_socket_io(compressed), compressed_format) == __expected()
+
+
+def test_broadcast_encodings_decode_alike():
+    payloads = serialization.encode_all(DIAGRAM)
+
+    assert sorted(payloads) == sorted(serialization.enabled_formats())
+    for payload_format, payload in payloads.items():
+        assert serialization.decode(__over_socket_io(payload), payload_format) == __expected()
+
+
+def test_small_payloads_are_not_compressed():
+    geometry = {'_id': str(DIAGRAM[0]['_id']), 'x': 1, 'y': 2, 'w': 3, 'h': 4}
+    payload = serialization.encode(geometry, f'{serialization.JSON}+{serialization.ZLIB}')
+
+    assert isinstance(payload, str)
+    assert serialization.decode(__over_socket_io(payload)) == geometry
@@ -0,0 +1,75 @@
+import pytest
+from bson import ObjectId
+
+import settings
+from src.services import model_service, snapshot_service
+
+
+@pytest.fixture
+def diagram(db, monkeypatch):
+    """
+    a diagram of five representations, each showing its own model, as (diagram id, representation ids)
+    """
+    monkeypatch.setattr(settings, 'DIAGRAM_SNAPSHOTS', True)
+    diagram_id = ObjectId()
+    representation_ids = []
+    for i in range(5):
+        model_id = db.model.insert_one({'type': 'class', 'path': '/', 'title': f'M{i}', 'version': 1,
+                                        'attributes': [], 'relations': []}).inserted_id
+        representation_ids.append(db.modelRepresentation.insert_one({
+            'diagramId': diagram_id, 'modelId': model_id, 'x': i, 'y': i, 'w': 10, 'h': 10, 'relations': []
+        }).inserted_id)
+    db.diagram.insert_one({'_id': diagram_id, 'projectId': ObjectId(), 'models': representation_ids})
+    return diagram_id, representation_ids
+
+
+def __streamed(diagram_id, chunk_size):
+    return [[(r.id, r.x) for r in chunk]
+            for chunk in model_service.iter_full_model_representations_for_diagram(diagram_id, chunk_size)]
+
+
+def test_join_stores_the_snapshot(diagram):
+    diagram_id, representation_ids = diagram
+    model_service.get_full_model_representations_for_diagram(diagram_id)
+
+    assert [r['_id'] for r in snapshot_service.load(diagram_id)] == representation_ids
+
+
+def test_change_during_the_join_is_not_saved_stale(diagram, monkeypatch):
+    diagram_id, representation_ids = diagram
+    reserve = snapshot_service.reserve
+
+    def reserve_then_move(reserved_diagram_id):
+        version = reserve(reserved_diagram_id)
+        # another worker moves a box before the join reads it
+        model_service.update_model_rep({'_id': representation_ids[0], 'x': 100, 'y': 0, 'w': 10, 'h': 10})
+        return version
+
+    monkeypatch.setattr(snapshot_service, 'reserve', reserve_then_move)
+    model_service.get_full_model_representations_for_diagram(diagram_id)
+
+    assert snapshot_service.load(diagram_id) is None
+    monkeypatch.setattr(snapshot_service, 'reserve', reserve)
+    assert model_service.rebuild_snapshot(diagram_id)
+    assert snapshot_service.load(diagram_id)[0]['x'] == 100
+
+
+def test_stream_reads_the_snapshot_in_chunks(diagram, round_trips):
+    diagram_id, representation_ids = diagram
+    assert model_service.rebuild_snapshot(diagram_id)
+    round_trips.clear()
+
+    assert __streamed(diagram_id, 2) == [[(i, n) for n, i in enumerate(representation_ids)][s:s + 2]
+                                         for s in range(0, 5, 2)]
+    # the ids first, then the representations and their models per chunk
+    assert round_trips == [('diagramSnapshot', 'find_one')] * 7
+
+
+def test_stream_joins_a_chunk_the_snapshot_lacks_models_of(diagram, db):
+    diagram_id, representation_ids = diagram
+    assert model_service.rebuild_snapshot(diagram_id)
+    model_id = db.modelRepresentation.find_one({'_id': representation_ids[3]})['modelId']
+    db.diagramSnapshot.update_one({'_id': diagram_id}, {'$unset': {f'models.{model_id}': ''}})
+
+    assert __streamed(diagram_id, 2) == [[(i, n) for n, i in enumerate(representation_ids)][s:s + 2]
+                                         for s in range(0, 5, 2)]
@@ -0,0 +1,128 @@
+import shutil
+
+import pytest
+from bson import ObjectId
+
+import settings
+from src.services import diagram_cache, model_service, write_behind
+from src.util import metrics
+
+FIELD = {'kind': 'field', 'name': 'id', 'type': 'int', 'accessModifier': 'private'}
+
+
+@pytest.fixture
+def journal(db, tmp_path, monkeypatch):
+    """
+    write-behind on, journaling to a fresh file, as (journal path, diagram id, representation id, model id) of a
+    diagram with one model held in the room cache
+    """
+    path = str(tmp_path / 'write_behind.journal')
+    monkeypatch.setattr(settings, 'WRITE_BEHIND', True)
+    monkeypatch.setattr(settings, 'WRITE_BEHIND_JOURNAL', path)
+    monkeypatch.setattr(write_behind, '_pending', [])
+    monkeypatch.setattr(write_behind, '_journal', None)
+    monkeypatch.setattr(diagram_cache, '_rooms', {})
+    monkeypatch.setattr(diagram_cache, '_by_model', {})
+    monkeypatch.setattr(diagram_cache, '_members', {})
+
+    diagram_id, representation_id, model_id = ObjectId(), ObjectId(), ObjectId()
+    db.model.insert_one({'_id': model_id, 'type': 'class', 'path': '/', 'title': 'A', 'version': 3,
+                         'attributes': [], 'relations': []})
+    db.modelRepresentation.insert_one({'_id': representation_id, 'diagramId': diagram_id, 'modelId': model_id,
+                                       'x': 0, 'y': 0, 'w': 10, 'h': 10, 'relations': []})
+    model_service.get_full_model_representations_for_diagram(diagram_id)
+    diagram_cache.add_member(diagram_id)
+    yield path, diagram_id, representation_id, model_id
+    if write_behind._journal is not None:
+        write_behind._journal.close()
+
+
+@pytest.fixture
+def counters(monkeypatch):
+    """
+    the counters incremented meanwhile, as [(name, labels)]
+    """
+    counted = []
+    monkeypatch.setattr(metrics, 'inc', lambda name, amount=1, **labels: counted.append((name, labels)))
+    return counted
+
+
+def __attribute_names(db, model_id):
+    return [a['name'] for a in db.model.find_one({'_id': model_id})['attributes']]
+
+
+def __crash():
+    # what a restart keeps is the journal file
+    write_behind._journal.close()
+    write_behind._journal = None
+    write_behind._pending.clear()
+
+
+def test_edits_of_a_cached_model_wait_for_the_flush(journal, db):
+    _, _, _, model_id = journal
+    model_service.add_attribute(model_id, ObjectId(), dict(FIELD, name='a'))
+
+    assert __attribute_names(db, model_id) == []
+    assert write_behind.flush() == 2
+    assert __attribute_names(db, model_id) == ['a']
+    assert db.model.find_one({'_id': model_id})['version'] == 4
+
+
+def test_replay_after_a_crash_applies_the_journal_once(journal, db, tmp_path, counters):
+    path, _, _, model_id = journal
+    model_service.add_attribute(model_id, ObjectId(), dict(FIELD, name='a'))
+    model_service.add_attribute(model_id, ObjectId(), dict(FIELD, name='b'))
+    __crash()
+    shutil.copy(path, tmp_path / 'copy')
+
+    assert write_behind.replay() == 4
+    assert __attribute_names(db, model_id) == ['a', 'b']
+    assert db.modelHistory.count_documents({'modelId': model_id}) == 2
+
+    # crashed again before the flush made it to the journal
+    __crash()
+    shutil.copy(tmp_path / 'copy', path)
+
+    assert write_behind.replay() == 4
+    assert __attribute_names(db, model_id) == ['a', 'b']
+    assert db.model.find_one({'_id': model_id})['version'] == 5
+    assert db.modelHistory.count_documents({'modelId': model_id}) == 2
+    assert counters == []
+
+
+def test_flush_writes_each_collection_once(journal, db, round_trips):
+    _, _, representation_id, model_id = journal
+    for i in range(10):
+        model_service.update_model_rep({'_id': representation_id, 'x': i, 'y': i, 'w': 10, 'h': 10})
+        model_service.add_attribute(model_id, ObjectId(), dict(FIELD, name=f'a{i}'))
+
+    assert round_trips == []
+    assert write_behind.flush() == 30
+    assert sorted(round_trips) == [('model', 'bulk_write'), ('modelHistory', 'bulk_write'),
+                                   ('modelRepresentation', 'bulk_write')]
+    assert len(__attribute_names(db, model_id)) == 10
+    assert db.modelRepresentation.find_one({'_id': representation_id})['x'] == 9
+
+
+def test_direct_write_after_eviction_keeps_the_journaled_edit(journal, db):
+    _, diagram_id, _, model_id = journal
+    model_service.add_attribute(model_id, ObjectId(), dict(FIELD, name='journaled'))
+    diagram_cache.remove_member(diagram_id)
+
+    patch = model_service.add_attribute(model_id, ObjectId(), dict(FIELD, name='direct'))
+
+    assert patch['version'] == 5
+    assert __attribute_names(db, model_id) == ['journaled', 'direct']
+    assert db.model.find_one({'_id': model_id})['version'] == 5
+
+
+def test_unmatched_update_resyncs_the_model(journal, db, counters):
+    _, diagram_id, _, model_id = journal
+    model_service.add_attribute(model_id, ObjectId(), dict(FIELD, name='journaled'))
+    # another writer got there first
+    db.model.update_one({'_id': model_id}, {'$inc': {'version': 1}})
+
+    write_behind.flush()
+
+    assert counters == [('write_behind_unmatched_total', {'collection': 'model'})]
+    assert diagram_cache.get(diagram_id) is None
@@ -0,0 +1,56 @@
+"""
+A server process for the multi-worker tests: app.py over an in-memory Mongo seeded with one diagram showing one model.
+
+python tests/worker.py <port> <diagram id> <representation id> <model id>, with the settings in the environment
+"""
+try:
+    # what the gunicorn gevent worker does, so the loopback queue's sockets yield to the server
+    from gevent import monkey
+
+    monkey.patch_all()
+except ImportError:
+    pass
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mongomock  # noqa: E402
+from bpr_data.repository import Collection  # noqa: E402
+from bson import ObjectId  # noqa: E402
+
+from src.util import mongo  # noqa: E402
+
+
+class _Repository:
+    """
+    The part of bpr_data's Repository the socket server reads through, over the in-memory database.
+    """
+
+    def __init__(self, db):
+        self.__db = db
+
+    def find_one(self, collection: Collection, id=None):
+        return self.__db[collection.value].find_one({'_id': ObjectId(id)})
+
+
+def main(port: str, diagram_id: str, representation_id: str, model_id: str) -> None:
+    mongo._client = mongomock.MongoClient()
+    db = mongo.get_database()
+    mongo._repository = _Repository(db)
+    db[Collection.DIAGRAM.value].insert_one({'_id': ObjectId(diagram_id), 'title': 'diagram', 'projectId': ObjectId(),
+                                             'models': [ObjectId(representation_id)]})
+    db[Collection.MODEL.value].insert_one({'_id': ObjectId(model_id), 'type': 'class', 'path': '/', 'title': 'model',
+                                           'attributes': [], 'relations': [], 'version': 0})
+    db[Collection.MODEL_REPRESENTATION.value].insert_one({'_id': ObjectId(representation_id),
+                                                          'diagramId': ObjectId(diagram_id),
+                                                          'modelId': ObjectId(model_id),
+                                                          'x': 0, 'y': 0, 'w': 100, 'h': 50, 'relations': []})
+
+    import app
+    app.socket_io.run(app.app, port=int(port))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])